@@ -0,0 +1,381 @@
+#!/user/bin/env python3
+
+# Benchmark suite for `to-accointing.py`.  See the "Benchmarks" section of TO-ACCOINTING.md.
+# Generates synthetic exports for every header in IDENTIFY_MAP, runs the full conversion pipeline and the individual
+# mappers, reports rows/sec and peak RSS per source, and optionally compares the results with a saved baseline.
+
+import argparse
+import csv
+import datetime
+import importlib.util
+import json
+import os
+import os.path
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+SCRIPT_PATH = os.path.join(SCRIPT_DIR, "to-accointing.py")
+
+#
+# -------- DEFINITIONS --------
+#
+
+DEFAULT_ROWS = [10000]
+DEFAULT_ENGINES = ['row', 'columnar']
+DEFAULT_TOLERANCE = 0.20   # Fractional rows/sec drop (relative to the baseline) that counts as a regression.
+RANDOM_SEED = 20230731
+
+FIRST_TIMESTAMP = datetime.datetime(2021, 1, 1)
+TIMESTAMP_SPAN_SECONDS = 3 * 365 * 24 * 60 * 60
+
+ASSETS = ['BTC', 'ETH', 'USDC', 'ADA', 'SOL', 'DOGE']
+
+
+def load_converter():
+
+    # `to-accointing.py` is not an importable module name, so load it from its path.
+    spec = importlib.util.spec_from_file_location("to_accointing", SCRIPT_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+#
+# -------- SYNTHETIC DATA --------
+#
+
+def random_timestamp(rng):
+
+    return FIRST_TIMESTAMP + datetime.timedelta(seconds=rng.randrange(TIMESTAMP_SPAN_SECONDS))
+
+
+def random_amount(rng, scale=10.0, places=8):
+
+    return "{:.{}f}".format(rng.random() * scale, places)
+
+
+def gen_binance_us(ta, rng, rowCount):
+
+    userId = "12345678"
+    orderId = 100000000
+    txId = 500000000
+    simpleTypes = [('Deposit', 'USD Deposit'), ('Deposit', 'Crypto Deposit'), ('Distribution', 'Staking Rewards'),
+                   ('Withdrawal', 'USD Withdrawal'), ('Withdrawal', 'Crypto Withdrawal')]
+    orderTypes = [('Buy', 'Buy'), ('Sell', 'Sell'), ('Spot Trading', 'Buy'), ('Spot Trading', 'Sell'), ('Convert', 'Convert')]
+
+    rows = 0
+    while rows < rowCount:
+        timeStr = random_timestamp(rng).strftime(ta.BINANCE_US_DATETIME_FORMAT)
+        orderId += 1
+
+        if rng.random() < 0.3:
+            category, operation = rng.choice(simpleTypes)
+            asset = 'USD' if operation.startswith('USD') else rng.choice(ASSETS)
+            txId += 1
+            rows += 1
+            yield [userId, timeStr, category, operation, "", str(txId), asset, random_amount(rng), random_amount(rng, 1000, 2),
+                   "", "", "", "", "", "", "", "", "", "ACH" if asset == 'USD' else "", "", ""]
+            continue
+
+        # Orders have one or more fills that share the order id and (usually) the same second.
+        category, operation = rng.choice(orderTypes)
+        baseAsset = rng.choice(ASSETS[:2] + ASSETS[3:])
+        fillCount = rng.choice([1, 1, 1, 2, 3, 5, 8]) if category == 'Spot Trading' else 1
+        for _ in range(min(fillCount, rowCount - rows)):
+            txId += 1
+            rows += 1
+            yield [userId, timeStr, category, operation, str(orderId), str(txId), "", "", "", baseAsset, random_amount(rng),
+                   random_amount(rng, 1000, 2), 'USD', random_amount(rng, 1000, 2), random_amount(rng, 1000, 2), 'BNB',
+                   random_amount(rng, 0.01), random_amount(rng, 1, 2), "", "", "Filled" if rng.random() < 0.1 else ""]
+
+
+def gen_blockfi(ta, rng, rowCount):
+
+    singleTypes = sorted(ta.BLOCKFI_DEPOSIT_TYPES) + sorted(ta.BLOCKFI_WITHDRAWAL_TYPES)
+
+    rows = 0
+    while rows < rowCount:
+        timeStr = random_timestamp(rng).strftime(ta.BLOCKFI_DATETIME_FORMAT)
+        asset = rng.choice(ASSETS)
+        kind = rng.random()
+
+        if kind < 0.1 and rows + 2 <= rowCount:
+            # A trade is exported as an "in" line and an "out" line with the same time.
+            rows += 2
+            yield [rng.choice(ASSETS), random_amount(rng), 'Trade', timeStr]
+            yield [asset, "-" + random_amount(rng), 'Trade', timeStr]
+        elif kind < 0.2 and rows + 2 <= rowCount:
+            # A withdrawal and its fee are exported as separate lines with the same time.
+            rows += 2
+            yield [asset, "-" + random_amount(rng), 'Withdrawal', timeStr]
+            yield [asset, "-" + random_amount(rng, 0.001), 'Withdrawal Fee', timeStr]
+        else:
+            txType = rng.choice(singleTypes)
+            sign = "-" if txType in ta.BLOCKFI_WITHDRAWAL_TYPES else ""
+            rows += 1
+            yield [asset, sign + random_amount(rng), txType, timeStr]
+
+
+def gen_celsius(ta, rng, rowCount):
+
+    txTypes = sorted(ta.CELSIUS_DEPOSIT_TYPES) + sorted(ta.CELSIUS_WITHDRAWAL_TYPES) + [""]
+
+    for i in range(rowCount):
+        txType = rng.choice(txTypes)
+        sign = "-" if (txType in ta.CELSIUS_WITHDRAWAL_TYPES or (txType == "" and rng.random() < 0.5)) else ""
+        coin = rng.choice(ASSETS)
+        isReward = txType == 'Reward'
+        yield ["{:08x}-{:04x}".format(rng.getrandbits(32), i & 0xffff),
+               random_timestamp(rng).strftime(ta.CELSIUS_DATETIME_FORMAT), txType, coin, sign + random_amount(rng),
+               random_amount(rng, 1000, 2), "CEL" if isReward else "", random_amount(rng) if isReward else "", "Yes"]
+
+
+def gen_coinbase(ta, rng, rowCount):
+
+    txTypes = sorted(ta.COINBASE_DEPOSIT_TYPES) + sorted(ta.COINBASE_WITHDRAWAL_TYPES) + sorted(ta.COINBASE_ORDER_TYPES)
+
+    for _ in range(rowCount):
+        txType = rng.choice(txTypes)
+        asset = rng.choice(ASSETS)
+        quantity = random_amount(rng)
+        subtotal = random_amount(rng, 5000, 2)
+        fee = random_amount(rng, 20, 2) if txType in ta.COINBASE_ORDER_TYPES else ""
+
+        if txType == 'Convert':
+            # Amounts with thousands separators exercise the "[$,]" stripping done before the regex match.
+            notes = "Converted {} {} to {:,.6f} {}".format(quantity, asset, rng.random() * 100000, rng.choice(ASSETS))
+        elif txType == 'Receive' and rng.random() < 0.2:
+            notes = "Received {} {} {}".format(quantity, asset, ta.COINBASE_REFERRAL_SUFFIX)
+        elif txType in ('Buy', 'Sell'):
+            notes = "{} {} {} for ${:,.2f} USD".format("Bought" if txType == 'Buy' else "Sold", quantity, asset, float(subtotal))
+        else:
+            notes = "{} {} {}".format(txType, quantity, asset)
+
+        yield [random_timestamp(rng).strftime(ta.COINBASE_DATETIME_FORMAT), txType, asset, quantity, 'USD',
+               random_amount(rng, 50000, 2), subtotal, subtotal, fee, notes]
+
+
+def gen_ts_nontrade(ta, rng, rowCount):
+
+    txTypes = sorted(ta.TS_NONTRADE_DEPOSIT_TYPES) + sorted(ta.TS_NONTRADE_WITHDRAWAL_TYPES)
+
+    for i in range(rowCount):
+        timestamp = random_timestamp(rng)
+        txType = rng.choice(txTypes)
+        asset = rng.choice(ASSETS)
+        yield ["11AAA111", timestamp.strftime("%m/%d/%Y"), "" if rng.random() < 0.5 else timestamp.strftime("%I:%M:%S %p"),
+               txType, asset, random_amount(rng), asset, "{} {}".format(txType, asset), "tx{:010d}".format(i),
+               "confirm-{}.pdf".format(i // 10) if rng.random() < 0.5 else ""]
+
+
+def gen_ts_trade(ta, rng, rowCount):
+
+    symbols = sorted(ta.get_pair_map().keys())
+
+    for i in range(rowCount):
+        timestamp = random_timestamp(rng)
+        quantity = random_amount(rng)
+        price = random_amount(rng, 50000, 2)
+        yield ["11AAA111", timestamp.strftime("%m/%d/%Y"), timestamp.strftime("%I:%M:%S %p"), rng.choice(['BOUGHT', 'SOLD']),
+               quantity, rng.choice(symbols), price, 'USD', "{:.2f}".format(float(quantity) * float(price)), 'USD',
+               random_amount(rng, 5, 2), 'USD', "TX{:010d}".format(i), "confirm-{}.pdf".format(i // 10)]
+
+
+def generator_map(ta):
+
+    return {
+        (ta.TxSource.BINANCE_US, ta.TxType.COMMON): gen_binance_us,
+        (ta.TxSource.BLOCKFI, ta.TxType.COMMON): gen_blockfi,
+        (ta.TxSource.CELSIUS, ta.TxType.COMMON): gen_celsius,
+        (ta.TxSource.COINBASE, ta.TxType.COMMON): gen_coinbase,
+        (ta.TxSource.TRADESTATION, ta.TxType.NONTRADE): gen_ts_nontrade,
+        (ta.TxSource.TRADESTATION, ta.TxType.TRADE): gen_ts_trade
+    }
+
+
+def source_name(idTuple):
+
+    return "{}.{}".format(idTuple[0].name, idTuple[1].name)
+
+
+def generate_file(ta, idTuple, header, rowCount, dataDir):
+
+    filename = os.path.join(dataDir, "{}-{}.csv".format(source_name(idTuple), rowCount))
+    if os.path.isfile(filename):
+        return filename   # Generation is deterministic, so an existing file can be reused.
+
+    rng = random.Random("{}-{}".format(RANDOM_SEED, source_name(idTuple)))
+    tempFilename = filename + ".tmp"
+    with open(tempFilename, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(header)
+        writer.writerows(generator_map(ta)[idTuple](ta, rng, rowCount))
+    os.replace(tempFilename, filename)
+
+    return filename
+
+
+#
+# -------- BENCHMARKS --------
+#
+
+def bench_pipeline(filename, engine, rowCount):
+
+    # Run the full `main()` pipeline in a child process so that its peak RSS can be measured on its own.
+    outFd, outFilename = tempfile.mkstemp(suffix=".csv")
+    os.close(outFd)
+    try:
+        start = time.perf_counter()
+        proc = subprocess.Popen([sys.executable, SCRIPT_PATH, "-e", engine, "-i", filename, "-o", outFilename],
+                                cwd=SCRIPT_DIR, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        stderrData = proc.stderr.read()
+        _, status, rusage = os.wait4(proc.pid, 0)
+        elapsed = time.perf_counter() - start
+        proc.returncode = os.waitstatus_to_exitcode(status)
+    finally:
+        os.remove(outFilename)
+
+    if proc.returncode != 0:
+        raise Exception("Conversion of '{}' failed:\n{}".format(filename, stderrData.decode(errors='replace')))
+
+    return {'rows': rowCount, 'seconds': elapsed, 'rowsPerSec': rowCount / elapsed, 'peakRssKiB': rusage.ru_maxrss}
+
+
+def bench_row_mapper(ta, ctx, rowCount):
+
+    # Materialize the petl records first so that only the mapper calls are timed.
+    table = iter(ctx['table'])
+    fields = list(next(table))
+    records = [ta.etl.util.base.Record(row, fields) for row in table]
+    rowmapper = ctx['rowmapper']
+
+    start = time.perf_counter()
+    for record in records:
+        rowmapper(record)
+    elapsed = time.perf_counter() - start
+
+    return {'rows': rowCount, 'seconds': elapsed, 'rowsPerSec': rowCount / elapsed}
+
+
+def bench_columnar_mapper(ta, ctx, rowCount):
+
+    chunks = list(ta.read_columns(ctx['filename'], ctx['header']))
+    columnarMapper = ta.bind_mapper(ta.COLUMNAR_MAPPER_MAP[(ctx['source'], ctx['type'])], ctx['converter'])
+
+    start = time.perf_counter()
+    for cols in chunks:
+        columnarMapper(cols)
+    elapsed = time.perf_counter() - start
+
+    return {'rows': rowCount, 'seconds': elapsed, 'rowsPerSec': rowCount / elapsed}
+
+
+def new_converter(ta, idTuple):
+
+    # A converter set up as `main()` does for a single source (fresh caches and order counter).
+    return ta.Converter("us", ta.TZ_DEFAULT_MAP.get(idTuple[0], None))
+
+
+def run_benchmarks(ta, rowCounts, engines, dataDir, sources):
+
+    results = {}
+    for rowCount in rowCounts:
+        for header, idTuple in ta.IDENTIFY_MAP.items():
+            name = source_name(idTuple)
+            if sources and name not in sources:
+                continue
+
+            sys.stderr.write("Generating {} rows for {}\n".format(rowCount, name))
+            filename = generate_file(ta, idTuple, header, rowCount, dataDir)
+
+            for engine in engines:
+                sys.stderr.write("Benchmarking pipeline ({}) for {}\n".format(engine, name))
+                results["pipeline/{}/{}/{}".format(engine, name, rowCount)] = bench_pipeline(filename, engine, rowCount)
+
+            sys.stderr.write("Benchmarking mappers for {}\n".format(name))
+            with new_converter(ta, idTuple) as conv:
+                ctx = ta.get_file_context(conv, filename)
+                results["mapper/row/{}/{}".format(name, rowCount)] = bench_row_mapper(ta, ctx, rowCount)
+            with new_converter(ta, idTuple) as conv:
+                ctx = ta.get_file_context(conv, filename)
+                results["mapper/columnar/{}/{}".format(name, rowCount)] = bench_columnar_mapper(ta, ctx, rowCount)
+
+    return results
+
+
+#
+# -------- REPORTING --------
+#
+
+def write_report(results, baseline, tolerance):
+
+    # Returns the list of benchmark keys that regressed relative to the baseline.
+    regressions = []
+    sys.stdout.write("{:<52} {:>10} {:>14} {:>12} {:>10}\n".format("benchmark", "seconds", "rows/sec", "peak RSS MiB", "vs base"))
+    for key, result in results.items():
+        peakRss = "{:.1f}".format(result['peakRssKiB'] / 1024) if 'peakRssKiB' in result else "-"
+        comparison = "-"
+        if baseline and key in baseline:
+            ratio = result['rowsPerSec'] / baseline[key]['rowsPerSec']
+            comparison = "{:+.1%}".format(ratio - 1)
+            if ratio < 1 - tolerance:
+                regressions.append(key)
+                comparison += " !"
+        sys.stdout.write("{:<52} {:>10.3f} {:>14,.0f} {:>12} {:>10}\n".format(key, result['seconds'], result['rowsPerSec'], peakRss, comparison))
+
+    return regressions
+
+
+#
+# -------- MAIN --------
+#
+
+def main() -> int:
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--rows", help="Number of rows per synthetic export (may be given more than once).", type=int, action="extend", nargs="+")
+    parser.add_argument("-e", "--engine", help="Conversion engine(s) used for the pipeline benchmarks.", action="extend", nargs="+", choices=DEFAULT_ENGINES)
+    parser.add_argument("-s", "--source", help="Only benchmark the given source(s), e.g. 'BLOCKFI.COMMON'.", action="extend", nargs="+")
+    parser.add_argument("-d", "--data-dir", help="Directory for the synthetic exports (reused between runs).")
+    parser.add_argument("-b", "--baseline", help="Baseline JSON file to compare against.")
+    parser.add_argument("--save-baseline", help="Write the results as a baseline JSON file.")
+    parser.add_argument("--tolerance", help="Allowed fractional rows/sec drop before a result counts as a regression.", type=float, default=DEFAULT_TOLERANCE)
+
+    args = parser.parse_args()
+
+    # The converter reads its `config/*.json` files relative to the working directory.
+    os.chdir(SCRIPT_DIR)
+    ta = load_converter()
+
+    dataDir = args.data_dir if args.data_dir else os.path.join(tempfile.gettempdir(), "bench-accointing")
+    os.makedirs(dataDir, exist_ok=True)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    results = run_benchmarks(ta, args.rows if args.rows else DEFAULT_ROWS, args.engine if args.engine else DEFAULT_ENGINES,
+                             dataDir, set(args.source) if args.source else None)
+    regressions = write_report(results, baseline, args.tolerance)
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(results, f, indent=4)
+        sys.stderr.write("Saved baseline: '{}'\n".format(args.save_baseline))
+
+    if regressions:
+        sys.stderr.write("ERROR: {} benchmark(s) slower than the baseline by more than {:.0%}:\n".format(len(regressions), args.tolerance))
+        for key in regressions:
+            sys.stderr.write("  {}\n".format(key))
+        return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
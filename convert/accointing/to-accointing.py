@@ -4,16 +4,61 @@
 # One-off scrypt for converting some CSV formats to a CSV format based on the Accointing template.
 
 import argparse
+import array
+import copy
+import csv
+import datetime
+import fnmatch
+import glob
+import gzip
+import hashlib
+import heapq
+import io
+import itertools
 import json
+import locale
+import math
+import mmap
+import operator
 import os.path
 import sys
-from collections import OrderedDict
+from bisect import bisect_left, bisect_right
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+from functools import lru_cache, partial, update_wrapper
 from csv import QUOTE_NONNUMERIC, QUOTE_ALL
+from decimal import Context, Decimal, InvalidOperation, MAX_PREC
 from enum import Enum
 from pytz import timezone             # pytz: https://pythonhosted.org/pytz/#tzinfo-api
 import pytz
 import petl as etl                    # PETL: https://petl.readthedocs.io/en/stable/index.html
+from petl.util.base import Record
+import queue
 import re
+import shutil
+import signal
+import socketserver
+import stat
+try:
+    import resource                   # Peak memory for `--stats`; not available on Windows.
+except ImportError:
+    resource = None
+import tempfile
+import threading
+import time
+import zipfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+try:
+    import zstandard                  # zstandard: https://python-zstandard.readthedocs.io (only for `--compress zstd`)
+except ImportError:
+    zstandard = None
+try:
+    import pyarrow                    # PyArrow: https://arrow.apache.org/docs/python/ (only for `--arrow-output`)
+    import pyarrow.compute
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
 
 #
 # -------- DEFINITIONS --------
@@ -61,533 +106,4705 @@ TZ_DEFAULT_MAP = {
 ACCOINTING_HEADER_ROW = ['transactionType','date','inBuyAmount','inBuyAsset','outSellAmount','outSellAsset','feeAmount (optional)','feeAsset (optional)','classification (optional)','operationId (optional)','comments (optional)']
 ACCOINTING_DATETIME_FORMAT = "%m/%d/%Y %H:%M:%S"
 
-REGION = None
-CLASSIFY_MAP = {}
-PAIR_MAP = {}
-INPUT_TZ = None   # `None` implies pass-through (no conversion).
+# Number of distinct raw timestamp strings remembered by each `*_dt_xform` function.  Fills from a single order
+# usually share the same second, so even a small cache absorbs most of the repeated conversions.
+DT_CACHE_SIZE = 65536
+
+CLASSIFY_FILENAME = 'config/classify.json'
+PAIR_FILENAME = 'config/pairs.json'
+CONFIG_CACHE = {}   # See `load_config()`.
+CONFIG_LOCK = threading.Lock()
+
+# Order ids held in memory by the exact order counter before a sorted run is spilled to disk.
+ORDER_COUNT_SPILL_SIZE = 250000
+# Register index bits for the approximate (HyperLogLog) order counter: 2^14 registers (16 KiB) give a standard error of
+# 1.04 / sqrt(2^14) ~= 0.81%, i.e. the estimate is within +/-1.6% of the true count about 95% of the time.
+ORDER_COUNT_HLL_BITS = 14
+
+
+# Row keys held in memory by the dedup index before a sorted run is spilled to disk (16 bytes per key on disk).
+DEDUP_SPILL_SIZE = 1000000
+DEDUP_MAX_RUNS = 8   # Spilled runs are merged into one when there are more than this, to keep lookups cheap.
+DEDUP_KEY_BYTES = 16
+
+AGGREGATE_SPILL_SIZE = 100000   # Partially aggregated orders held in memory before they are spilled to disk.
+
+# Rows sorted in memory per run by `--sort-by-date` for inputs that are not in date order.
+SORT_RUN_SIZE = 100000
+SORT_MAX_MERGE = 128   # Maximum number of files merged at once; more are merged in several passes.
+
+SHARD_WRITERS = 4   # Writer threads; each shard is always written by the same thread.
+SHARD_BUFFER_SIZE = 1 << 20   # Characters of CSV text buffered per shard before they are handed to its writer thread.
+SHARD_QUEUE_SIZE = 16   # Buffers queued per writer thread before the conversion waits for it.
+
+ARROW_BATCH_SIZE = 65536   # Rows per record batch (and Parquet row group).
+
+#
+# -------- CONFIG FUNCTIONS --------
+#
+
+def get_classify_map(regionStr):
+
+    f = open(CLASSIFY_FILENAME)
+    jsonDict = json.load(f)
+    f.close()
+
+    if not regionStr in jsonDict:
+        raise Exception("Specified region '{}' not found in classify.json".format(regionStr))
+
+    return jsonDict[regionStr]
+
+
+def get_pair_map():
+    
+    f = open(PAIR_FILENAME)
+    jsonDict = json.load(f)
+    f.close()
+
+    return jsonDict
+
+
+def load_config(regionStr):
+
+    # Returns (classifyMap, pairMap, dispatchPlans, dispatchPlanErrors) for `regionStr`.  The result is cached until
+    # one of the config files changes, so a long-running `--serve` process only pays for it once per region.  The
+    # cached maps are shared by every conversion of the region and are never modified.
+    key = (regionStr, os.path.getmtime(CLASSIFY_FILENAME), os.path.getmtime(PAIR_FILENAME))
+    with CONFIG_LOCK:
+        if key not in CONFIG_CACHE:
+            classifyMap = get_classify_map(regionStr)
+            CONFIG_CACHE[key] = (classifyMap,) + compile_dispatch_plans(regionStr, classifyMap, get_pair_map())
+        return CONFIG_CACHE[key]
+
+#
+# -------- UTILITY FUNCTIONS --------
+#
+
+def separate_pair(conv, tradingPairStr):
+
+    pair = conv.pairMap.get(tradingPairStr, None)
+    if pair is None:
+        conv.unknownPairs[tradingPairStr] = conv.unknownPairs.get(tradingPairStr, 0) + 1
+        return ("???", "???")
+    return pair
+
+
+def parse_decimal(value):
+
+    # An amount or value of a converted row (which passes the amounts of the input through unchanged).  Raises
+    # ValueError if it is not a (finite) number.
+    try:
+        number = Decimal(value)
+    except InvalidOperation:
+        raise ValueError("Invalid number: '{}'".format(value))
+    if not number.is_finite():
+        raise ValueError("Invalid number: '{}'".format(value))
+    return number
+
+
+
+#
+# -------- TIMESTAMP FUNCTIONS --------
+#
+# Every row goes through a `*_dt_xform` function, so the generic strptime -> pytz -> strftime path is replaced with:
+#   1) A parser specialized for each fixed `*_DATETIME_FORMAT` (regex + int(), with strptime as the fallback).
+#   2) A table of local-time UTC offsets precomputed from the input timezone's transitions (no per-row pytz call).
+#   3) A bounded LRU cache keyed on the raw timestamp string.
+# The output is identical to `tz.localize(dt, is_dst=True).astimezone(pytz.utc).strftime(...)`.  Each `Converter`
+# builds its own `*_dt_xform` functions for its input timezone; the parsers and offset tables are shared.
+
+DT_DIRECTIVE_PATTERNS = {
+    '%Y': r'(?P<Y>\d{4})',
+    '%m': r'(?P<m>\d{1,2})',
+    '%d': r'(?P<d>\d{1,2})',
+    '%H': r'(?P<H>\d{1,2})',
+    '%I': r'(?P<I>\d{1,2})',
+    '%M': r'(?P<M>\d{1,2})',
+    '%S': r'(?P<S>\d{1,2})',
+    '%p': r'(?P<p>[AaPp][Mm])',
+    '%B': r'(?P<B>[A-Za-z]+)'
+}
+
+MONTH_NAME_MAP = {name.lower(): idx for idx, name in enumerate(
+    ['January', 'February', 'March', 'April', 'May', 'June', 'July', 'August', 'September', 'October', 'November',
+     'December'], start=1)}
+
+
+def compile_dt_parser(dateTimeFormat):
+
+    # Build a regex for the format.  Anything the regex does not handle is passed on to strptime (via petl), so
+    # unusual-but-valid input and error messages behave exactly as before.
+    fallbackParser = etl.util.parsers.datetimeparser(dateTimeFormat)
+
+    pattern = ""
+    for token in re.split(r'(%.)', dateTimeFormat):
+        if token.startswith('%'):
+            if token not in DT_DIRECTIVE_PATTERNS:
+                raise Exception("Unsupported directive '{}' in datetime format '{}'.".format(token, dateTimeFormat))
+            pattern += DT_DIRECTIVE_PATTERNS[token]
+        else:
+            pattern += r'\s+' if token.isspace() else re.escape(token)
+    matcher = re.compile(pattern).fullmatch
+
+    def parser(dateTimeStr):
+
+        match = matcher(dateTimeStr.strip())
+        if not match:
+            return fallbackParser(dateTimeStr)
+
+        fields = match.groupdict()
+        if 'B' in fields:
+            month = MONTH_NAME_MAP.get(fields['B'].lower())
+            if not month:
+                return fallbackParser(dateTimeStr)
+        else:
+            month = int(fields['m'])
+
+        if 'I' in fields:
+            hour = int(fields['I'])
+            if not (1 <= hour <= 12):
+                return fallbackParser(dateTimeStr)
+            hour = (hour % 12) + (12 if fields['p'].upper() == 'PM' else 0)
+        else:
+            hour = int(fields['H'])
+
+        try:
+            return datetime.datetime(int(fields['Y']), month, int(fields['d']), hour, int(fields['M']),
+                                     int(fields.get('S', 0)))
+        except ValueError:
+            return fallbackParser(dateTimeStr)   # Let strptime report the error in its usual form.
+
+    return parser
+
+
+@lru_cache(maxsize=None)   # The tables are never modified, so they are shared between conversions and `--serve` runs.
+def build_tz_offset_table(tz):
+
+    # Returns (localStarts, offsets): `offsets[i]` is the UTC offset for local (wall clock) times from `localStarts[i]`
+    # up to the next entry.  Gaps and overlaps around each transition get their own entry, resolved once by pytz with
+    # `is_dst=True` so the table matches `tz.localize(dt, is_dst=True)` everywhere.
+    if tz is None:
+        return None
+
+    utcTransitions = getattr(tz, '_utc_transition_times', None)
+    if not utcTransitions:
+        return ([datetime.datetime.min], [tz.utcoffset(datetime.datetime(2000, 1, 1))])
+
+    transitionOffsets = [info[0] for info in tz._transition_info]
+
+    localStarts = [datetime.datetime.min]
+    offsets = [transitionOffsets[0]]
+    for i in range(1, len(utcTransitions)):
+        prevOffset = transitionOffsets[i - 1]
+        nextOffset = transitionOffsets[i]
+        if prevOffset == nextOffset:
+            continue
+        windowStart = utcTransitions[i] + min(prevOffset, nextOffset)
+        windowEnd = utcTransitions[i] + max(prevOffset, nextOffset)
+        localStarts.append(windowStart)
+        offsets.append(tz.localize(windowStart, is_dst=True).utcoffset())
+        localStarts.append(windowEnd)
+        offsets.append(nextOffset)
+
+    return (localStarts, offsets)
+
+
+def format_accointing_dt(dt) -> str:
+
+    if dt.year < 1000:   # strftime does not zero-pad years below 1000 on all platforms.
+        return dt.strftime(ACCOINTING_DATETIME_FORMAT)
+    return "{:02d}/{:02d}/{:04d} {:02d}:{:02d}:{:02d}".format(dt.month, dt.day, dt.year, dt.hour, dt.minute, dt.second)
+
+
+def local_to_utc(loc_dt, tzTable):
+
+    if tzTable is None:
+        return loc_dt
+
+    localStarts, offsets = tzTable
+    return loc_dt - offsets[bisect_right(localStarts, loc_dt) - 1]
+
+
+DT_PARSER_MAP = {}   # Datetime format -> parser.  See `make_dt_xform()`.
+
+def make_dt_xform(dateTimeFormat, tzTable):
+
+    # Returns a cached conversion of timestamp strings in `dateTimeFormat` (local times of the timezone `tzTable` was
+    # built for) to Accointing UTC timestamps.
+    parser = DT_PARSER_MAP.get(dateTimeFormat)
+    if parser is None:
+        parser = DT_PARSER_MAP[dateTimeFormat] = compile_dt_parser(dateTimeFormat)
+
+    @lru_cache(maxsize=DT_CACHE_SIZE)
+    def dt_xform(dateTimeStr) -> str:
+        return format_accointing_dt(local_to_utc(parser(dateTimeStr), tzTable))
+
+    return dt_xform
+
+
+#
+# -------- ORDER COUNTING --------
+#
+# The Binance.US CSV stores one line per fill, so the number of unique `Order_Id` values is reported at the end of a
+# conversion.  Both counters below use a fixed amount of memory no matter how large the input is.  Their state can be
+# exported from a `--jobs` worker and merged into the parent's counter.
+
+class ExactOrderCounter:
+
+    def __init__(self, spillDir=None):
+        self.buffer = set()
+        self.runFilenames = []
+        self.spillDir = spillDir
+        self.ownsSpillDir = False
+
+    def add(self, orderId):
+        self.buffer.add(orderId)
+        if len(self.buffer) >= ORDER_COUNT_SPILL_SIZE:
+            self.spill()
+
+    def spill_dir(self):
+        if not self.spillDir:
+            self.spillDir = tempfile.mkdtemp(prefix="to-accointing-orders-")
+            self.ownsSpillDir = True
+        return self.spillDir
+
+    def spill(self):
+        # Write the buffered ids as a sorted run, one escaped id per line.  'unicode_escape' keeps the encoding
+        # one-to-one while guaranteeing that an id never contains a newline.
+        if not self.buffer:
+            return
+        fd, runFilename = tempfile.mkstemp(prefix="run-", suffix=".txt", dir=self.spill_dir())
+        with os.fdopen(fd, 'wb') as runFile:
+            runFile.writelines(sorted(orderId.encode('unicode_escape') + b'\n' for orderId in self.buffer))
+        self.runFilenames.append(runFilename)
+        self.buffer = set()
+
+    def export_state(self):
+        self.spill()
+        runFilenames = self.runFilenames
+        self.runFilenames = []
+        return runFilenames
+
+    def merge_state(self, runFilenames):
+        self.runFilenames.extend(runFilenames)
+
+    def count(self):
+        if not self.runFilenames:
+            return len(self.buffer)
+
+        self.spill()
+        runFiles = [open(runFilename, 'rb') for runFilename in self.runFilenames]
+        try:
+            total = 0
+            previous = None
+            for line in heapq.merge(*runFiles):
+                if line != previous:
+                    total += 1
+                    previous = line
+        finally:
+            for runFile in runFiles:
+                runFile.close()
+        return total
+
+    def close(self):
+        for runFilename in self.runFilenames:
+            os.remove(runFilename)
+        self.runFilenames = []
+        if self.ownsSpillDir:
+            shutil.rmtree(self.spillDir, ignore_errors=True)
+            self.spillDir = None
+            self.ownsSpillDir = False
+
+
+class ApproxOrderCounter:
+
+    def __init__(self, spillDir=None):
+        self.registers = bytearray(1 << ORDER_COUNT_HLL_BITS)
+
+    def add(self, orderId):
+        hashValue = int.from_bytes(hashlib.blake2b(orderId.encode('utf-8'), digest_size=8).digest(), 'big')
+        index = hashValue >> (64 - ORDER_COUNT_HLL_BITS)
+        remainingBits = 64 - ORDER_COUNT_HLL_BITS
+        rank = remainingBits - (hashValue & ((1 << remainingBits) - 1)).bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def spill_dir(self):
+        return None
+
+    def export_state(self):
+        return bytes(self.registers)
+
+    def merge_state(self, registers):
+        self.registers = bytearray(max(a, b) for a, b in zip(self.registers, registers))
+
+    def count(self):
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * m and zeros > 0:
+            estimate = m * math.log(m / zeros)   # Linear counting for small cardinalities.
+        return int(round(estimate))
+
+    def close(self):
+        pass
+
+
+ORDER_COUNTER_MAP = {
+    'exact': ExactOrderCounter,
+    'approx': ApproxOrderCounter
+}
+
+def make_order_counter(mode, spillDir=None):
+
+    return ORDER_COUNTER_MAP[mode](spillDir)
+
+
+#
+# -------- DEDUPLICATION --------
+#
+# With `--dedup`, converted rows that were already written (e.g. from overlapping exports) are dropped.  Rows are keyed
+# by the id the source provides, or by the whole (normalized) output row for sources without one.  Keys are 16-byte
+# digests held in a set until DEDUP_SPILL_SIZE, then spilled to sorted run files that are searched through mmap.
+
+# (TxSource, TxType) -> Output columns that identify a transaction.  Binance.US fills of one order share the
+# 'Order_Id', so the comments (which hold the 'Transaction_Id') are part of the key.
+DEDUP_KEY_COLUMNS = {
+    (TxSource.BINANCE_US, TxType.COMMON): (ACCOINTING_HEADER_ROW.index('operationId (optional)'), ACCOINTING_HEADER_ROW.index('comments (optional)')),
+    (TxSource.CELSIUS, TxType.COMMON): (ACCOINTING_HEADER_ROW.index('operationId (optional)'),),
+    (TxSource.TRADESTATION, TxType.NONTRADE): (ACCOINTING_HEADER_ROW.index('operationId (optional)'),),
+    (TxSource.TRADESTATION, TxType.TRADE): (ACCOINTING_HEADER_ROW.index('operationId (optional)'),)
+}
+
+def dedup_key(idTuple, row):
+
+    # `None` and "" are the same in the output CSV, so rows read back from CSV get the same key.
+    values = ["" if value is None else str(value).strip() for value in row]
+    keyColumns = DEDUP_KEY_COLUMNS.get(idTuple, None)
+    if keyColumns and all(values[column] for column in keyColumns):
+        values = [values[column] for column in keyColumns]
+    material = "{}/{}\x1f{}".format(idTuple[0], idTuple[1], "\x1f".join(values))
+    return hashlib.blake2b(material.encode('utf-8'), digest_size=DEDUP_KEY_BYTES).digest()
+
+
+class DedupRun:
+
+    # A sorted run of fixed-size keys on disk.  Acts as a sequence so `bisect` can search it in place.
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.file = open(filename, 'rb')
+        self.count = os.path.getsize(filename) // DEDUP_KEY_BYTES
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) if self.count else b""
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        offset = index * DEDUP_KEY_BYTES
+        return self.map[offset:offset + DEDUP_KEY_BYTES]
+
+    def __contains__(self, key):
+        index = bisect_left(self, key)
+        return index < self.count and self[index] == key
+
+    def __iter__(self):
+        return (self[index] for index in range(self.count))
+
+    def close(self):
+        if self.count:
+            self.map.close()
+        self.file.close()
+        os.remove(self.filename)
+
+
+class DedupIndex:
+
+    def __init__(self):
+        self.keys = set()
+        self.runs = []
+        self.spillDir = None
+        self.duplicates = 0
+
+    def add(self, key):
+        # Returns `True` if `key` was not seen before.
+        if key in self.keys or any(key in run for run in self.runs):
+            self.duplicates += 1
+            return False
+        self.keys.add(key)
+        if len(self.keys) >= DEDUP_SPILL_SIZE:
+            self.spill()
+        return True
+
+    def file_filter(self, idTuple):
+
+        # Returns a predicate for the rows of one file that is `False` for rows already seen.  Identical rows within the
+        # file (e.g. two equal payments in the same second) are numbered by occurrence, so only copies of them from
+        # another file are dropped.  Files are never split between workers with `--dedup`, so one predicate sees a whole
+        # file.
+        occurrences = Counter()
+
+        def keep(row):
+            key = dedup_key(idTuple, row)
+            occurrence = occurrences[key]
+            occurrences[key] = occurrence + 1
+            if occurrence:
+                key = hashlib.blake2b(key + str(occurrence).encode('ascii'), digest_size=DEDUP_KEY_BYTES).digest()
+            return self.add(key)
+
+        return keep
+
+    def new_run_filename(self):
+        if not self.spillDir:
+            self.spillDir = tempfile.mkdtemp(prefix="to-accointing-dedup-")
+        fd, runFilename = tempfile.mkstemp(prefix="run-", suffix=".bin", dir=self.spillDir)
+        os.close(fd)
+        return runFilename
+
+    def spill(self):
+        runFilename = self.new_run_filename()
+        with open(runFilename, 'wb') as runFile:
+            runFile.write(b"".join(sorted(self.keys)))
+        self.runs.append(DedupRun(runFilename))
+        self.keys = set()
+
+        if len(self.runs) > DEDUP_MAX_RUNS:
+            runFilename = self.new_run_filename()
+            with open(runFilename, 'wb') as runFile:
+                runFile.writelines(heapq.merge(*self.runs))
+            for run in self.runs:
+                run.close()
+            self.runs = [DedupRun(runFilename)]
+
+    def close(self):
+        for run in self.runs:
+            run.close()
+        self.runs = []
+        if self.spillDir:
+            shutil.rmtree(self.spillDir, ignore_errors=True)
+            self.spillDir = None
+
+
+class DedupTable(etl.Table):
+
+    # Drops the rows of the converted table of `ctx` that are already in the dedup index of its run.
+
+    def __init__(self, table, ctx):
+        self.table = table
+        self.ctx = ctx
+
+    def __iter__(self):
+        it = iter(self.table)
+        header = next(it, None)
+        if header is None:
+            return
+        yield header
+        yield from filter(self.ctx['converter'].run.dedup_filter(self.ctx), it)
+
+
+#
+# -------- RECONCILIATION --------
+#
+# With `--reconcile REPORT`, the converted rows are tallied per input file and asset as they are written: the sum of
+# 'inBuyAmount', 'outSellAmount' and 'feeAmount', and the balance (in - out - fee), all in exact decimal arithmetic.
+# Rows containing "???" (unknown transaction types or trading pairs) and the trading pairs missing from the pairs
+# config are counted per file.  The report lists each file and asset, followed by the totals per asset, so that the
+# balances can be compared with those Accointing shows after the import.
+
+RECONCILE_CONTEXT = Context(prec=MAX_PREC)   # Additions are exact at any precision.
+RECONCILE_AMOUNT_COLUMNS = ((2, 3, 0), (4, 5, 1), (6, 7, 2))   # (amount column, asset column, total index)
+RECONCILE_TOTAL_FILE = "*"
+RECONCILE_CSV_HEADER = ['file', 'source', 'asset', 'rows', 'inAmount', 'outAmount', 'feeAmount', 'balance', 'unknownRows', 'unknownPairs']
+
+class Reconciler:
+
+    def __init__(self):
+        self.files = OrderedDict()   # Filename -> file record.  The byte ranges of a split file share a record.
+
+    def file_record(self, ctx):
+        record = self.files.get(ctx['filename'])
+        if record is None:
+            record = self.files[ctx['filename']] = {'source': "{} {}".format(ctx['source'], ctx['type']), 'rows': 0,
+                                                    'unknownRows': 0, 'invalidAmounts': 0, 'unknownPairs': {}, 'assets': {}}
+        return record
+
+    def observe(self, ctx, rows):
+
+        # Yields `rows` (converted rows, with `None` or "" for empty values) while adding them to the balances.
+        record = self.file_record(ctx)
+        assets = record['assets']
+        add = RECONCILE_CONTEXT.add
+        for row in rows:
+            record['rows'] += 1
+            if "???" in row:
+                record['unknownRows'] += 1
+            touched = set()
+            for amountColumn, assetColumn, index in RECONCILE_AMOUNT_COLUMNS:
+                amount = row[amountColumn]
+                if not amount:
+                    continue
+                asset = row[assetColumn] or ""
+                totals = assets.get(asset)
+                if totals is None:
+                    totals = assets[asset] = [Decimal(0), Decimal(0), Decimal(0), 0]
+                try:
+                    totals[index] = add(totals[index], Decimal(amount))
+                except InvalidOperation:
+                    record['invalidAmounts'] += 1
+                touched.add(asset)
+            for asset in touched:
+                assets[asset][3] += 1
+            yield row
+
+    def add_unknown_pairs(self, ctx, pairs):
+
+        unknownPairs = self.file_record(ctx)['unknownPairs']
+        for pair, count in (pairs or {}).items():
+            unknownPairs[pair] = unknownPairs.get(pair, 0) + count
+
+    def asset_totals(self):
+
+        # Totals per asset over all files.
+        totals = {}
+        for record in self.files.values():
+            for asset, values in record['assets'].items():
+                total = totals.setdefault(asset, [Decimal(0), Decimal(0), Decimal(0), 0])
+                for i in range(3):
+                    total[i] = RECONCILE_CONTEXT.add(total[i], values[i])
+                total[3] += values[3]
+        return totals
+
+    def write_report(self, filename):
+
+        if filename.lower().endswith(".json"):
+            self.write_json_report(filename)
+        else:
+            self.write_csv_report(filename)
+
+    def write_json_report(self, filename):
+
+        def asset_entries(assets):
+            return {asset: {'rows': values[3], 'inAmount': format(values[0], 'f'), 'outAmount': format(values[1], 'f'),
+                            'feeAmount': format(values[2], 'f'), 'balance': format(reconcile_balance(values), 'f')}
+                    for asset, values in sorted(assets.items())}
+
+        report = {
+            'files': [{'file': name, 'source': record['source'], 'rows': record['rows'], 'unknownRows': record['unknownRows'],
+                       'invalidAmounts': record['invalidAmounts'], 'unknownPairs': record['unknownPairs'],
+                       'assets': asset_entries(record['assets'])} for name, record in self.files.items()],
+            'assets': asset_entries(self.asset_totals())
+        }
+        with open(filename, 'w') as f:
+            json.dump(report, f, indent=4)
+
+    def write_csv_report(self, filename):
+
+        # Per file: a summary row (empty asset), then one row per asset.  Then one total row per asset.
+        with open(filename, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(RECONCILE_CSV_HEADER)
+            for name, record in self.files.items():
+                writer.writerow([name, record['source'], "", record['rows'], "", "", "", "", record['unknownRows'],
+                                 "; ".join("{} ({})".format(pair, count) for pair, count in sorted(record['unknownPairs'].items()))])
+                for asset, values in sorted(record['assets'].items()):
+                    writer.writerow(reconcile_csv_row(name, record['source'], asset, values))
+            for asset, values in sorted(self.asset_totals().items()):
+                writer.writerow(reconcile_csv_row(RECONCILE_TOTAL_FILE, "", asset, values))
+
+    def summary(self):
+
+        return "{} asset(s), {} row(s) with '???', {} unknown trading pair(s), {} invalid amount(s)".format(
+            len(self.asset_totals()), sum(record['unknownRows'] for record in self.files.values()),
+            len(set().union(*[record['unknownPairs'] for record in self.files.values()])),
+            sum(record['invalidAmounts'] for record in self.files.values()))
+
+
+def reconcile_balance(values):
+
+    return RECONCILE_CONTEXT.subtract(RECONCILE_CONTEXT.subtract(values[0], values[1]), values[2])
+
+
+def reconcile_csv_row(name, source, asset, values):
+
+    return [name, source, asset, values[3], format(values[0], 'f'), format(values[1], 'f'), format(values[2], 'f'),
+            format(reconcile_balance(values), 'f'), "", ""]
+
+
+class ReconcileTable(etl.Table):
+
+    # Adds the rows of a converted table to the balances, and the file's unknown trading pairs once it is converted.
+
+    def __init__(self, table, ctx):
+        self.table = table
+        self.ctx = ctx
+
+    def __iter__(self):
+        conv = self.ctx['converter']
+        conv.take_unknown_pairs()
+        it = iter(self.table)
+        header = next(it, None)
+        if header is None:
+            return
+        yield header
+        yield from conv.run.reconciler.observe(self.ctx, it)
+        conv.run.reconciler.add_unknown_pairs(self.ctx, conv.take_unknown_pairs())
+
+
+#
+# -------- LOT MATCHING --------
+#
+# With `--gains REPORT`, the converted rows are matched against the open tax lots of each asset as they are written, in
+# date order (`--gains` implies `--sort-by-date`).  An order disposes of the asset sold and opens a lot of the asset
+# bought, both at the trade's value: its USD side, or else the `fiatValue` of `--prices`.  A USD fee of an order is added
+# to the cost of the lot bought (or taken from the proceeds of a sale), while a fee in any other asset is a disposal of
+# that asset at its value (with `--prices`).  The classification of a deposit or withdrawal selects its kind in
+# LOT_CLASSIFICATION_KINDS: deposits of 'income' (e.g. "staking" and "bounty") open a lot at their value, while other
+# deposits ('funds', e.g. "add funds" and unclassified rows) open a lot whose cost basis is unknown.  Withdrawals of a
+# 'disposal' (e.g. "fee") realize a gain, while other withdrawals just remove lots.  Rows of the 'skip' kind ("ignored"),
+# transfers between own wallets ('transfer', "internal") and rows with "???" leave the lots unchanged.  Every
+# classification of classify.json must have a kind (see `lot_classification_kinds()`).  USD itself has no lots.
+#
+# Each match of a disposal with (part of) a lot is written to REPORT when it happens, and the lots still open at the end
+# are written to the open lot report.  The lots of an asset are kept in parallel lists (acquisition time, remaining
+# amount and cost basis) and taken first in first out, last in first out, or highest unit cost first through a heap
+# (`--lot-method`), so each row takes constant (HIFO: logarithmic) time and memory only grows with the open lots.
+# Amounts and values are decimals, as in the reconciliation: amounts are exact, and a value is only rounded (to
+# LOT_SPLIT_CONTEXT) when it is split between lots, with the last part taking the rest, so that the parts always add up
+# to the whole.  A value that is not known is NaN and written empty.
+
+LOT_METHODS = ('fifo', 'lifo', 'hifo')
+LOT_CLASSIFICATION_KINDS = {
+    '': 'funds',   # Unclassified rows.
+    'add funds': 'funds',
+    'remove funds': 'funds',
+    'staking': 'income',
+    'bounty': 'income',
+    'income': 'income',
+    'airdrop': 'income',
+    'mined': 'income',
+    'lending_income': 'income',
+    'fee': 'disposal',
+    'payment': 'disposal',
+    'internal': 'transfer',
+    'ignored': 'skip'
+}
+LOT_LONG_TERM_SECONDS = 365 * 86400   # Lots held longer than this are long-term.
+LOT_CONTEXT = RECONCILE_CONTEXT   # Additions, subtractions and multiplications are exact.
+LOT_SPLIT_CONTEXT = Context(prec=34)   # Divisions, for the share of a value in a part of a lot.
+LOT_UNKNOWN = Decimal('NaN')
+LOT_COMPACT_MIN = 4096   # Taken lots kept in a queue's arrays before they are compacted away.
+LOT_FIAT_VALUE = len(ACCOINTING_HEADER_ROW)   # Index of FIAT_VALUE_COLUMN.
+LOT_GAINS_HEADER = ['asset', 'acquired', 'disposed', 'amount', 'proceeds', 'costBasis', 'gain', 'term', 'kind', 'operationId']
+LOT_OPEN_HEADER = ['asset', 'acquired', 'amount', 'costBasis']
+
+class LotQueue:
+
+    # The lots of one asset, appended in date order.  `costs[i]` is the cost basis of the remaining `amounts[i]`; a taken
+    # lot has amount 0 until it is compacted away.
+
+    def __init__(self, method):
+
+        self.method = method
+        self.times = array.array('q')
+        self.amounts = []
+        self.costs = []
+        self.head = 0   # FIFO: no lot before this one is open.
+        self.heap = []   # HIFO: (-unit cost, lot index) of the open lots; unknown costs count as 0.
+        self.taken = 0   # Taken lots still in the arrays.
+
+    def add(self, seconds, amount, cost):
+
+        if self.method == 'hifo':
+            heapq.heappush(self.heap, (lot_unit_cost_key(amount, cost), len(self.amounts)))
+        self.times.append(seconds)
+        self.amounts.append(amount)
+        self.costs.append(cost)
+
+    def next_lot(self):
+
+        # The index of the lot to take from, or -1 when no lot is open.
+        if self.method == 'fifo':
+            if self.head < len(self.amounts):
+                return self.head
+        elif self.method == 'lifo':
+            if self.amounts:
+                return len(self.amounts) - 1
+        elif self.heap:
+            return self.heap[0][1]
+        return -1
+
+    def close_lot(self, i):
+
+        self.amounts[i] = Decimal(0)
+        self.costs[i] = Decimal(0)
+        if self.method == 'fifo':
+            self.head += 1
+            self.taken += 1
+        elif self.method == 'lifo':
+            del self.times[-1], self.amounts[-1], self.costs[-1]
+        else:
+            heapq.heappop(self.heap)
+            self.taken += 1
+
+    def take(self, amount):
+
+        # Yields the (acquisition time, amount, cost basis) of the lot parts that make up `amount`, followed by
+        # (None, amount, NaN) for the part that no open lot covers.
+        while amount > 0:
+            i = self.next_lot()
+            if i < 0:
+                yield (None, amount, LOT_UNKNOWN)
+                break
+            lotAmount = self.amounts[i]
+            lotCost = self.costs[i]
+            if lotAmount <= amount:
+                yield (self.times[i], lotAmount, lotCost)
+                self.close_lot(i)
+                amount = LOT_CONTEXT.subtract(amount, lotAmount)
+            else:
+                cost = lot_share(lotCost, amount, lotAmount)
+                yield (self.times[i], amount, cost)
+                self.amounts[i] = LOT_CONTEXT.subtract(lotAmount, amount)
+                self.costs[i] = LOT_CONTEXT.subtract(lotCost, cost)
+                amount = Decimal(0)
+        if self.taken > LOT_COMPACT_MIN and self.taken * 2 > len(self.amounts):
+            self.compact()
+
+    def compact(self):
+
+        keep = [i for i in range(self.head, len(self.amounts)) if self.amounts[i] > 0]
+        self.times = array.array('q', map(self.times.__getitem__, keep))
+        self.amounts = list(map(self.amounts.__getitem__, keep))
+        self.costs = list(map(self.costs.__getitem__, keep))
+        self.head = 0
+        self.taken = 0
+        if self.method == 'hifo':
+            self.heap = [(lot_unit_cost_key(amount, cost), i) for i, (amount, cost) in enumerate(zip(self.amounts, self.costs))]
+            heapq.heapify(self.heap)
+
+    def open_lots(self):
+
+        # (acquisition time, amount, cost basis) of the open lots, in acquisition order.
+        for i in range(self.head, len(self.amounts)):
+            if self.amounts[i] > 0:
+                yield (self.times[i], self.amounts[i], self.costs[i])
+
+
+class LotMatcher:
+
+    # `prices` is the `PriceStore` that values fees paid in other assets (or `None`), and `classifyMap` the classify map
+    # of the converted rows (see `lot_classification_kinds()`; `None` accepts every classification with a kind).
+
+    def __init__(self, method, gainsFilename, lotsFilename, prices=None, classifyMap=None):
+
+        self.method = method
+        self.lotsFilename = lotsFilename
+        self.prices = prices
+        self.kinds = lot_classification_kinds(classifyMap) if classifyMap is not None else LOT_CLASSIFICATION_KINDS
+        self.queues = {}   # Asset -> LotQueue
+        self.gainsFile = open(gainsFilename, 'w', newline='')
+        self.gainsWriter = csv.writer(self.gainsFile)
+        self.gainsWriter.writerow(LOT_GAINS_HEADER)
+        self.gainsFile.flush()   # Nothing may be left buffered when the `--jobs` worker processes are forked.
+        self.matches = 0
+        self.realized = {'short': Decimal(0), 'long': Decimal(0)}
+        self.income = Decimal(0)
+        self.uncovered = 0       # Matches without an open lot.
+        self.unknownValues = 0   # Matches and income rows without a known value.
+        self.skippedRows = 0     # Ignored, internal and "???" rows.
+        self.invalidRows = 0
+
+    def observe(self, rows):
+
+        # Yields `rows` (converted rows in date order) while matching them.  A row with an amount or date that does not
+        # parse is counted as invalid and leaves the lots unchanged.
+        for row in rows:
+            try:
+                self.add_row(row)
+            except ValueError:
+                self.invalidRows += 1
+            yield row
+
+    def add_row(self, row):
+
+        transactionType, date, inAmount, inAsset, outAmount, outAsset, feeAmount, feeAsset, classification = row[:9]
+        kind = self.kinds.get(classification or '')   # Unclassified rows have `None` before they are written.
+        if kind == 'skip' or kind == 'transfer' or "???" in row:
+            self.skippedRows += 1
+            return
+        if kind is None:
+            raise ValueError("Classification without a lot kind: '{}'".format(classification))
+
+        # Everything is parsed before any lot is changed, so that an invalid row does not match half an order.
+        seconds = accointing_utc_seconds(date)
+        value = lot_row_value(row)
+        inAmount = parse_decimal(inAmount) if inAmount else Decimal(0)
+        outAmount = parse_decimal(outAmount) if outAmount else Decimal(0)
+        feeAmount = parse_decimal(feeAmount) if feeAmount else Decimal(0)
+        operationId = row[9]
+        fiatFee = feeAmount if (feeAsset == FIAT_CURRENCY and transactionType == "order") else Decimal(0)
+        if inAsset == FIAT_CURRENCY:
+            inAsset = None
+        if outAsset == FIAT_CURRENCY:
+            outAsset = None
+
+        if transactionType == "order":
+            if outAsset and outAmount:
+                self.dispose(outAsset, outAmount, value if inAsset else LOT_CONTEXT.subtract(value, fiatFee), seconds, date, "order", operationId)
+            if inAsset and inAmount:
+                self.acquire(inAsset, inAmount, LOT_CONTEXT.add(value, fiatFee), seconds)
+        elif transactionType == "deposit":
+            if inAsset and inAmount:
+                income = kind == 'income'
+                if income:
+                    if value.is_nan():
+                        self.unknownValues += 1
+                    else:
+                        self.income = LOT_CONTEXT.add(self.income, value)
+                self.acquire(inAsset, inAmount, value if income else LOT_UNKNOWN, seconds)
+        elif transactionType == "withdraw":
+            if outAsset and outAmount:
+                if kind == 'disposal':
+                    self.dispose(outAsset, outAmount, value, seconds, date, classification, operationId)
+                else:
+                    for lotSeconds, amount, cost in self.queue(outAsset).take(outAmount):
+                        self.uncovered += lotSeconds is None
+
+        if feeAsset and feeAsset != FIAT_CURRENCY and feeAmount:
+            price = self.prices.price(feeAsset, seconds) if self.prices else None
+            feeValue = LOT_CONTEXT.multiply(feeAmount, Decimal(repr(price))) if price is not None else LOT_UNKNOWN
+            self.dispose(feeAsset, feeAmount, feeValue, seconds, date, "fee", operationId)
+
+    def queue(self, asset):
+
+        queue = self.queues.get(asset)
+        if queue is None:
+            queue = self.queues[asset] = LotQueue(self.method)
+        return queue
+
+    def acquire(self, asset, amount, cost, seconds):
+
+        if amount > 0:
+            self.queue(asset).add(seconds, amount, cost)
+
+    def dispose(self, asset, amount, proceeds, seconds, date, kind, operationId):
+
+        # The proceeds are shared between the lots in proportion to the amounts taken from them; the last lot gets the
+        # rest of the proceeds.
+        for lotSeconds, lotAmount, cost in self.queue(asset).take(amount):
+            lotProceeds = proceeds if lotAmount == amount else lot_share(proceeds, lotAmount, amount)
+            amount = LOT_CONTEXT.subtract(amount, lotAmount)
+            proceeds = LOT_CONTEXT.subtract(proceeds, lotProceeds)
+            gain = LOT_CONTEXT.subtract(lotProceeds, cost)
+            term = "" if lotSeconds is None else ("long" if seconds - lotSeconds > LOT_LONG_TERM_SECONDS else "short")
+            self.matches += 1
+            if lotSeconds is None:
+                self.uncovered += 1
+            elif gain.is_nan():
+                self.unknownValues += 1
+            else:
+                self.realized[term] = LOT_CONTEXT.add(self.realized[term], gain)
+            self.gainsWriter.writerow([asset, format_lot_time(lotSeconds), date, format_lot_amount(lotAmount),
+                                       format_lot_value(lotProceeds), format_lot_value(cost), format_lot_value(gain), term,
+                                       kind, operationId or ""])
+
+    def close(self):
+
+        # Writes the open lot report.
+        self.gainsFile.close()
+        with open(self.lotsFilename, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(LOT_OPEN_HEADER)
+            for asset in sorted(self.queues):
+                for seconds, amount, cost in self.queues[asset].open_lots():
+                    writer.writerow([asset, format_lot_time(seconds), format_lot_amount(amount), format_lot_value(cost)])
+
+    def summary(self):
+
+        openLots = {asset: sum(1 for _ in queue.open_lots()) for asset, queue in self.queues.items()}
+        return ("{} match(es), realized gain {:.2f} {} (short-term {:.2f}, long-term {:.2f}), income {:.2f} {}, {} open lot(s) in {} asset(s), "
+                "{} uncovered match(es), {} unknown value(s), {} skipped and {} invalid row(s)").format(
+            self.matches, LOT_CONTEXT.add(self.realized['short'], self.realized['long']), FIAT_CURRENCY, self.realized['short'], self.realized['long'],
+            self.income, FIAT_CURRENCY, sum(openLots.values()), sum(1 for count in openLots.values() if count), self.uncovered,
+            self.unknownValues, self.skippedRows, self.invalidRows)
+
+
+def lot_classification_kinds(classifyMap):
+
+    # Returns the kind in LOT_CLASSIFICATION_KINDS of each classification in `classifyMap` (a region of classify.json),
+    # and of those the script assigns itself (none, and Coinbase's "income").  Raises ValueError for classifications
+    # without a kind.
+    kinds = {classification: LOT_CLASSIFICATION_KINDS[classification] for classification in ('', 'income')}
+    unknown = set()
+    for fieldMap in classifyMap.values():
+        for valueMap in fieldMap.values():
+            for classification in valueMap.values():
+                if classification in LOT_CLASSIFICATION_KINDS:
+                    kinds[classification] = LOT_CLASSIFICATION_KINDS[classification]
+                else:
+                    unknown.add(classification)
+    if unknown:
+        raise ValueError("Classification(s) in classify.json without a lot kind for --gains: {} (expected one of: {})".format(
+            ", ".join("'{}'".format(classification) for classification in sorted(unknown)),
+            ", ".join("'{}'".format(classification) for classification in LOT_CLASSIFICATION_KINDS if classification)))
+    return kinds
+
+
+def lot_share(value, amount, totalAmount):
+
+    # The share of `value` (of `totalAmount`) in `amount`.
+    return LOT_SPLIT_CONTEXT.divide(LOT_CONTEXT.multiply(value, amount), totalAmount)
+
+
+def lot_unit_cost_key(amount, cost):
+
+    # The HIFO heap key of a lot: the negated unit cost, 0 if the cost is unknown.
+    return Decimal(0) if cost.is_nan() else LOT_SPLIT_CONTEXT.minus(LOT_SPLIT_CONTEXT.divide(cost, amount))
+
+
+def lot_row_value(row):
+
+    # The value of a row in FIAT_CURRENCY: its USD side, or else its FIAT_VALUE_COLUMN (NaN if neither is known).
+    if row[3] == FIAT_CURRENCY and row[2]:
+        return parse_decimal(row[2])
+    if row[5] == FIAT_CURRENCY and row[4]:
+        return parse_decimal(row[4])
+    if len(row) > LOT_FIAT_VALUE and row[LOT_FIAT_VALUE]:
+        return parse_decimal(row[LOT_FIAT_VALUE])
+    return LOT_UNKNOWN
+
+
+def format_lot_time(seconds):
+
+    return time.strftime(ACCOINTING_DATETIME_FORMAT, time.gmtime(seconds)) if seconds is not None else ""
+
+
+def format_lot_amount(amount):
+
+    text = format(amount, 'f')
+    return (text.rstrip('0').rstrip('.') if '.' in text else text) or "0"
+
+
+def format_lot_value(value):
+
+    return "" if value.is_nan() else FIAT_VALUE_FORMAT.format(value)
+
+
+def lot_rows(run, rows):
+
+    # The final output rows (in date order), also matched against the lots with `--gains`.
+    return run.lots.observe(rows) if run.lots else rows
+
+
+#
+# -------- REJECTED ROWS --------
+#
+# With `--keep-going`, a row that cannot be converted (e.g. an unhandled transaction type or an unparsable Coinbase
+# 'Notes' field) no longer aborts the conversion.  The row is left out of the output and written to the reject file
+# with its input file, line number and the error, as are the rows whose conversion contains "???" (unknown transaction
+# types or trading pairs).  The script then exits with REJECT_EXIT_CODE and reports the number of rejected rows.  Line
+# numbers are the physical line a row starts on, counting the header as line 1 (a quoted field may span lines), so the
+# input is read through `csv.reader` rather than the memory-mapped reader.  With `--jobs`, each worker writes the
+# rejects of its part to a file that is appended to the reject file in input order.
+
+REJECT_HEADER = ['file', 'line', 'error']
+REJECT_UNKNOWN_ERROR = "Converted row contains '???' (unknown transaction type or trading pair)."
+REJECT_EXIT_CODE = 2
+
+class RejectLog:
+
+    def __init__(self, filename, header=True):
+
+        self.file = open(filename, 'w', newline='')
+        self.writer = csv.writer(self.file)
+        if header:
+            self.writer.writerow(REJECT_HEADER)
+        self.file.flush()   # Nothing may be left buffered when the `--jobs` worker processes are forked.
+        self.count = 0
+
+    def add(self, ctx, lineNumber, error):
+
+        self.writer.writerow([ctx['filename'], lineNumber, error])
+        self.count += 1
+
+    def append_part(self, partFilename, count):
+
+        with open(partFilename, 'r', newline='') as partFile:
+            shutil.copyfileobj(partFile, self.file)
+        self.count += count
+
+    def close(self):
+
+        self.file.close()
+
+
+def lines_before_range(ctx):
+
+    # The number of lines before the byte range of `ctx` (0 when the file is read from its start).
+    byteRange = ctx.get('byteRange')
+    if not byteRange or not byteRange[0]:
+        return 0
+    lines = 0
+    remaining = byteRange[0]
+    with open(ctx['filename'], 'rb') as f:
+        while remaining > 0:
+            chunk = f.read(min(remaining, MMAP_CHUNK_SIZE))
+            if not chunk:
+                break
+            lines += chunk.count(b'\n')
+            remaining -= len(chunk)
+    return lines
+
+
+def read_numbered_chunks(ctx):
+
+    # Yields the rows of `ctx` in chunks, each row a tuple of its line number and the values of the mapper fields.  The
+    # line number is the line the record starts on: quoted fields may span several lines, so the reader's count of the
+    # lines read so far is used rather than the number of records.
+    fields = mapper_fields(ctx['converter'], (ctx['source'], ctx['type']))
+    project = operator.itemgetter(*[ctx['header'].index(field) for field in fields])
+    if len(fields) == 1:
+        project = lambda row, project=project: (project(row),)
+    width = len(ctx['header'])
+    byteRange = ctx.get('byteRange')
+    firstLine = lines_before_range(ctx) + 1
+
+    with open_text_range(ctx['filename'], byteRange) as inFile:
+        reader = csv.reader(inFile)
+        if not byteRange or not byteRange[0]:
+            next(reader, None)
+        linesRead = reader.line_num
+        while True:
+            chunk = []
+            for row in itertools.islice(reader, COLUMNAR_CHUNK_SIZE):
+                if len(row) < width:
+                    row += [None] * (width - len(row))
+                chunk.append((firstLine + linesRead,) + project(row))
+                linesRead = reader.line_num
+            if not chunk:
+                return
+            yield chunk
+
+
+class NumberedTable(etl.Table):
+
+    # petl table over the rows of `ctx` with their line numbers (see `read_numbered_chunks()`) in a first 'line' field.
+
+    def __init__(self, ctx):
+        self.ctx = ctx
+
+    def __iter__(self):
+        yield ('line',) + tuple(mapper_fields(self.ctx['converter'], (self.ctx['source'], self.ctx['type'])))
+        for chunk in read_numbered_chunks(self.ctx):
+            yield from chunk
+
+
+def input_table(ctx):
+
+    # The input table of `ctx` for the row engine.  With `--keep-going` its rows are numbered for the reject file.
+    return NumberedTable(ctx) if ctx['converter'].run.rejects else ctx['table']
+
+
+class RejectTable(etl.Table):
+
+    # Like `etl.rowmap()` over a `NumberedTable`, except that rows which fail to convert, or convert to "???", are
+    # rejected and skipped.
+
+    def __init__(self, table, rowmapper, ctx):
+        self.table = table
+        self.rowmapper = rowmapper
+        self.ctx = ctx
+
+    def __iter__(self):
+        it = iter(self.table)
+        header = next(it, None)
+        if header is None:
+            return
+        conv = self.ctx['converter']
+        rejects = conv.run.rejects
+        yield tuple(output_header_row(conv))
+        fields = list(map(str, header[1:]))
+        for row in it:
+            lineNumber = row[0]
+            try:
+                outRow = tuple(self.rowmapper(Record(row[1:], fields)))
+            except Exception as e:
+                rejects.add(self.ctx, lineNumber, str(e))
+                continue
+            if "???" in outRow:
+                rejects.add(self.ctx, lineNumber, REJECT_UNKNOWN_ERROR)
+                continue
+            yield outRow
+
+
+def row_table(ctx, inTable, rowmapper):
+
+    # The converted table of `ctx` for the row engine.  `inTable` is from `input_table()`.
+    if ctx['converter'].run.rejects:
+        return RejectTable(inTable, rowmapper, ctx)
+    return etl.rowmap(inTable, rowmapper, header=output_header_row(ctx['converter']), failonerror=True)
+
+
+def read_numbered_columns(ctx):
+
+    # Yields one ({fieldName: [values]}, [lineNumbers]) pair per chunk of `ctx` for the columnar engine.
+    fields = mapper_fields(ctx['converter'], (ctx['source'], ctx['type']))
+    for chunk in read_numbered_chunks(ctx):
+        columns = list(zip(*chunk))
+        yield dict(zip(fields, columns[1:])), columns[0]
+
+
+def reject_columns(ctx, columnarMapper, cols, lineNumbers):
+
+    # Maps a chunk for the columnar engine, without its rejected rows.  When the chunk fails as a whole, its rows are
+    # mapped one at a time to find the ones that fail.  `lineNumbers` are the line numbers of the chunk's rows.
+    errors = {}
+    try:
+        outRows = list(zip(*columnarMapper(cols)))
+    except Exception:
+        outRows = []
+        for i in range(len(lineNumbers)):
+            try:
+                outRows.extend(zip(*columnarMapper({name: values[i:i + 1] for name, values in cols.items()})))
+            except Exception as e:
+                errors[i] = str(e)
+                outRows.append(None)
+
+    rejects = ctx['converter'].run.rejects
+    keptRows = []
+    for i, row in enumerate(outRows):
+        if i in errors:
+            rejects.add(ctx, lineNumbers[i], errors[i])
+        elif "???" in row:
+            rejects.add(ctx, lineNumbers[i], REJECT_UNKNOWN_ERROR)
+        else:
+            keptRows.append(row)
+    return [list(col) for col in zip(*keptRows)] if keptRows else [[] for _ in output_header_row(ctx['converter'])]
+
+
+#
+# -------- STATISTICS --------
+#
+# With `--stats` the conversion records per-file and per-stage wall time, row counts and peak memory, plus call counts
+# and cumulative time for each mapper and the timestamp conversions.  The counters are plain
+# `time.perf_counter()` sums that are only installed when statistics are requested, so a normal run pays nothing.  The
+# statistics of a conversion are kept in its `ConversionRun` (see `new_stats()`).
+
+def new_stats():
+
+    # The statistics of a conversion.  'counters' are shared by the timestamp conversion wrappers of its converters (see
+    # `Converter.set_timezone()`).
+    return {'files': [], 'mappers': {}, 'counters': {}}
+
+
+def new_file_stats(stats, filename, byteRange=None):
+
+    fileStats = {'filename': filename, 'rowsIn': 0, 'rowsOut': 0, 'seconds': 0.0, 'readSeconds': 0.0,
+                 'mapSeconds': 0.0, 'writeSeconds': 0.0}
+    if byteRange:
+        fileStats['byteRange'] = list(byteRange)
+    stats['files'].append(fileStats)
+    return fileStats
+
+
+def stats_counter(counters, name, func):
+
+    perf = time.perf_counter
+    counter = counters.setdefault(name, {'calls': 0, 'seconds': 0.0})
+
+    def counted(*args):
+        start = perf()
+        try:
+            return func(*args)
+        finally:
+            counter['seconds'] += perf() - start
+            counter['calls'] += 1
+
+    counted.__name__ = func.__name__
+    return counted
+
+
+def stats_rowmapper(stats, rowmapper, fileStats):
+
+    perf = time.perf_counter
+    counter = stats['mappers'].setdefault(rowmapper.__name__, {'calls': 0, 'seconds': 0.0})
+
+    def counted(tx):
+        start = perf()
+        try:
+            return rowmapper(tx)
+        finally:
+            elapsed = perf() - start
+            counter['seconds'] += elapsed
+            counter['calls'] += 1
+            fileStats['mapSeconds'] += elapsed
+            fileStats['rowsOut'] += 1
+
+    return counted
+
+
+class StatsTable(etl.Table):
+
+    # Times each `next()` of the wrapped table.  On an input table this is the reading time.  On a mapped output table
+    # it is reading plus mapping, and the rest of the wall time spent consuming the table is writing.
+
+    def __init__(self, table, fileStats, isInput):
+        self.table = table
+        self.fileStats = fileStats
+        self.isInput = isInput
+
+    def __iter__(self):
+        perf = time.perf_counter
+        it = iter(self.table)
+        producedSeconds = 0.0
+        rows = -1   # Don't count the header.
+        firstStart = None
+        while True:
+            start = perf()
+            if firstStart is None and rows == 0:
+                firstStart = start   # Tables may be opened (and their headers read) long before their rows.
+            try:
+                row = next(it)
+            except StopIteration:
+                break
+            finally:
+                if self.isInput or rows >= 0:
+                    producedSeconds += perf() - start   # The output header is outside of the wall time below.
+            rows += 1
+            yield row
+
+        if self.isInput:
+            self.fileStats['readSeconds'] += producedSeconds
+            self.fileStats['rowsIn'] += max(rows, 0)
+        elif firstStart is not None:
+            wallSeconds = perf() - firstStart
+            self.fileStats['seconds'] += wallSeconds
+            self.fileStats['writeSeconds'] += wallSeconds - producedSeconds
+
+
+def stats_row_table(ctx):
+
+    # Returns the mapped output table for `ctx` with statistics collection wrapped around reading and mapping.
+    stats = ctx['converter'].run.stats
+    fileStats = new_file_stats(stats, ctx['filename'], ctx.get('byteRange'))
+    inTable = StatsTable(input_table(ctx), fileStats, isInput=True)
+    outTable = row_table(ctx, inTable, stats_rowmapper(stats, ctx['rowmapper'], fileStats))
+    return StatsTable(outTable, fileStats, isInput=False)
+
+
+def export_stats(stats):
+
+    # Returns a copy of the statistics gathered so far and zeroes them (used by `--jobs` workers, which may convert
+    # several files).  Counters are zeroed in place because the installed wrappers hold references to them.
+    exported = json.loads(json.dumps(stats))
+    stats['files'] = []
+    for counter in list(stats['counters'].values()) + list(stats['mappers'].values()):
+        counter['calls'] = 0
+        counter['seconds'] = 0.0
+    return exported
+
+
+def merge_stats(stats, workerStats):
+
+    stats['files'].extend(workerStats['files'])
+    for group in ('mappers', 'counters'):
+        for name, workerCounter in workerStats[group].items():
+            counter = stats[group].setdefault(name, {'calls': 0, 'seconds': 0.0})
+            counter['calls'] += workerCounter['calls']
+            counter['seconds'] += workerCounter['seconds']
+
+
+def peak_memory_kib():
+
+    if resource is None:
+        return None
+    # `ru_maxrss` is in KiB on Linux and in bytes on macOS.
+    scale = 1024 if sys.platform == 'darwin' else 1
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) // scale
+
+
+def finish_stats(stats, totalSeconds, identifySeconds, outputSeconds):
+
+    # `outputSeconds` is writing that is not attributed to any file (e.g. merging `--jobs` parts).
+    files = stats['files']
+    rowsIn = sum(fileStats['rowsIn'] for fileStats in files)
+    rowsOut = sum(fileStats['rowsOut'] for fileStats in files)
+    stats['total'] = {'seconds': totalSeconds, 'rowsIn': rowsIn, 'rowsOut': rowsOut,
+                      'rowsPerSec': rowsIn / totalSeconds if totalSeconds > 0 else None, 'peakMemoryKiB': peak_memory_kib()}
+    stats['stages'] = {
+        'identify': identifySeconds,
+        'read': sum(fileStats['readSeconds'] for fileStats in files),
+        'map': sum(fileStats['mapSeconds'] for fileStats in files),
+        'timestamp': stats['counters'].get('timestamp', {}).get('seconds', 0.0),
+        'write': sum(fileStats['writeSeconds'] for fileStats in files) + outputSeconds
+    }
+    for fileStats in files:
+        fileStats['rowsPerSec'] = fileStats['rowsIn'] / fileStats['seconds'] if fileStats['seconds'] > 0 else None
+
+
+def write_stats_summary(stats):
+
+    total = stats['total']
+    stages = stats['stages']
+    sys.stderr.write("Stats: {:.3f}s total, {} rows in, {} rows out, {} rows/sec, peak memory {}\n".format(
+        total['seconds'], total['rowsIn'], total['rowsOut'],
+        "{:,.0f}".format(total['rowsPerSec']) if total['rowsPerSec'] else "-",
+        "{:.1f} MiB".format(total['peakMemoryKiB'] / 1024) if total['peakMemoryKiB'] else "unknown"))
+    sys.stderr.write("Stats: stages: identify {:.3f}s, read {:.3f}s, map {:.3f}s (timestamp {:.3f}s), write {:.3f}s\n".format(
+        stages['identify'], stages['read'], stages['map'], stages['timestamp'], stages['write']))
+    for fileStats in stats['files']:
+        sys.stderr.write("Stats: file '{}'{}: {} rows in, {} rows out, {:.3f}s (read {:.3f}s, map {:.3f}s, write {:.3f}s), {} rows/sec\n".format(
+            fileStats['filename'], " bytes {}-{}".format(*fileStats['byteRange']) if 'byteRange' in fileStats else "", fileStats['rowsIn'], fileStats['rowsOut'], fileStats['seconds'], fileStats['readSeconds'],
+            fileStats['mapSeconds'], fileStats['writeSeconds'],
+            "{:,.0f}".format(fileStats['rowsPerSec']) if fileStats['rowsPerSec'] else "-"))
+    for name, counter in sorted(stats['mappers'].items()) + sorted(stats['counters'].items()):
+        sys.stderr.write("Stats: {} {} calls, {:.3f}s\n".format(name, counter['calls'], counter['seconds']))
+
+
+#
+# -------- FIAT VALUES --------
+#
+# With `--prices DIR`, every output row gets a FIAT_VALUE_COLUMN with its value in FIAT_CURRENCY: the fiat side of a
+# trade, otherwise the value of what was received (or else given, or else paid as fee).  A USD value from the source row
+# (Binance.US `*_In_USD_Value`, Celsius `USD Value`) is used as is.  Other assets are valued with the close of the last
+# candle in DIR/<ASSET>.csv that starts at or before the row's time, if it is no older than PRICE_MAX_AGE seconds.
+#
+# The price files are read once into a PriceStore: one binary file per asset with the candle start times (int64 UTC
+# seconds, ascending) followed by the close prices (float64).  The files are memory-mapped and searched through typed
+# memoryviews, so `--jobs` workers share them, and a lookup allocates neither a dict nor a datetime.  No prices are ever
+# fetched from the network.
+
+FIAT_CURRENCY = "USD"
+FIAT_VALUE_COLUMN = 'fiatValue'
+FIAT_VALUE_FORMAT = "{:.2f}"
+PRICE_FILE_SUFFIXES = (".csv", ".csv.gz", ".csv.zst")   # Compressed price files are read like compressed inputs.
+PRICE_STORE_SUFFIX = ".prices"
+PRICE_MAX_AGE = 2 * 86400   # Enough for daily candles.
+PRICE_MILLISECONDS_ABOVE = 100000000000   # Larger Unix times in price files are in milliseconds (i.e. after 1973).
+PRICE_TIME_PATTERN = re.compile(r'(\d{4})-(\d{2})-(\d{2})(?:[T ](\d{2}):(\d{2})(?::(\d{2}))?(?:\.\d*)?)?Z?')
+
+# Source -> (asset, amount, USD value) field names of the source rows that carry USD values.
+FIAT_SOURCE_VALUE_FIELDS = {
+    (TxSource.BINANCE_US, TxType.COMMON): (
+        ('Primary_Asset', 'Realized_Amount_For_Primary_Asset', 'Realized_Amount_For_Primary_Asset_In_USD_Value'),
+        ('Base_Asset', 'Realized_Amount_For_Base_Asset', 'Realized_Amount_For_Base_Asset_In_USD_Value'),
+        ('Quote_Asset', 'Realized_Amount_For_Quote_Asset', 'Realized_Amount_For_Quote_Asset_In_USD_Value'),
+        ('Fee_Asset', 'Realized_Amount_For_Fee_Asset', 'Realized_Amount_For_Fee_Asset_In_USD_Value')),
+    (TxSource.CELSIUS, TxType.COMMON): (('Coin type', 'Coin amount', 'USD Value'),)
+}
+
+def output_header_row(conv):
+
+    # The output header of the rows converted by `conv`.
+    return ACCOINTING_HEADER_ROW + [FIAT_VALUE_COLUMN] if conv.prices else ACCOINTING_HEADER_ROW
+
+
+def utc_seconds(year, month, day, hour, minute, second):
+
+    # Seconds since the Unix epoch, from the days since 1970-01-01 of the proleptic Gregorian date (see
+    # http://howardhinnant.github.io/date_algorithms.html#days_from_civil).
+    year -= month <= 2
+    era = year // 400
+    yearOfEra = year - era * 400
+    dayOfYear = (153 * (month + (-3 if month > 2 else 9)) + 2) // 5 + day - 1
+    dayOfEra = yearOfEra * 365 + yearOfEra // 4 - yearOfEra // 100 + dayOfYear
+    return (era * 146097 + dayOfEra - 719468) * 86400 + hour * 3600 + minute * 60 + second
+
+
+@lru_cache(maxsize=DT_CACHE_SIZE)
+def accointing_utc_seconds(dateStr):
+
+    # The Unix time of an Accointing (UTC) timestamp.
+    datePart, timePart = dateStr.split(' ')
+    month, day, year = datePart.split('/')
+    hour, minute, second = timePart.split(':')
+    return utc_seconds(int(year), int(month), int(day), int(hour), int(minute), int(second))
+
+
+def price_time_seconds(value):
+
+    # Candle times are UTC dates or times ("2023-01-31", "2023-01-31 14:00", "2023-01-31T14:00:00Z") or Unix times.
+    match = PRICE_TIME_PATTERN.fullmatch(value.strip())
+    if match:
+        return utc_seconds(*(int(v) if v else 0 for v in match.groups()))
+    seconds = float(value)
+    return int(seconds / 1000 if seconds > PRICE_MILLISECONDS_ABOVE else seconds)
+
+
+def read_price_file(filename):
+
+    # Returns {time: close} for a price file with a header row, the candle start time in the first column and a
+    # 'close' column.
+    with open_input_text(filename) as inFile:
+        reader = csv.reader(inFile)
+        header = [name.strip().lower() for name in next(reader, [])]
+        if 'close' not in header:
+            raise ValueError("no 'close' column in '{}'".format(filename))
+        closeIndex = header.index('close')
+        closes = {}
+        for lineNumber, row in enumerate(reader, 2):
+            if not row or not row[0].strip():
+                continue
+            try:
+                closes[price_time_seconds(row[0])] = float(row[closeIndex])
+            except (ValueError, IndexError):
+                raise ValueError("invalid price in '{}' line {}: {}".format(filename, lineNumber, ",".join(row)))
+    return closes
+
+
+class PriceStore:
+
+    # `storeDir` holds the store files written by `build()`.  The store directory is removed on `close()` when `owner`
+    # is True.
+
+    def __init__(self, storeDir, owner=False):
+
+        self.storeDir = storeDir
+        self.owner = owner
+        self.series = {}   # Asset -> (times, closes)
+        self.buffers = []   # (mmap, views) of each store file, released on `close()`.
+        for name in sorted(os.listdir(storeDir)):
+            asset, suffix = os.path.splitext(name)
+            if suffix != PRICE_STORE_SUFFIX:
+                continue
+            with open(os.path.join(storeDir, name), 'rb') as f:
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            count = len(mm) // 16
+            view = memoryview(mm)
+            timesView = view[:count * 8]
+            closesView = view[count * 8:]
+            times = timesView.cast('q')
+            closes = closesView.cast('d')
+            self.series[asset] = (times, closes)
+            self.buffers.append((mm, (times, closes, timesView, closesView, view)))
+
+    @classmethod
+    def build(cls, priceDir):
+
+        # Reads the price files in `priceDir` once into a new store in a temporary directory.  Raises ValueError for a
+        # missing directory or an invalid price file.
+        if not os.path.isdir(priceDir):
+            raise ValueError("price directory does not exist: '{}'".format(priceDir))
+
+        storeDir = tempfile.mkdtemp(prefix="to-accointing-prices-")
+        try:
+            assets = set()
+            for name in sorted(os.listdir(priceDir)):
+                if not name.lower().endswith(PRICE_FILE_SUFFIXES):
+                    continue
+                asset = name.split('.')[0].upper()
+                if asset in assets:
+                    raise ValueError("more than one price file for '{}' in '{}'".format(asset, priceDir))
+                assets.add(asset)
+                closes = read_price_file(os.path.join(priceDir, name))
+                if not closes:
+                    continue
+                times = sorted(closes)
+                with open(os.path.join(storeDir, asset + PRICE_STORE_SUFFIX), 'wb') as f:
+                    array.array('q', times).tofile(f)
+                    array.array('d', map(closes.__getitem__, times)).tofile(f)
+            return cls(storeDir, owner=True)
+        except BaseException:
+            shutil.rmtree(storeDir, ignore_errors=True)
+            raise
+
+    def price(self, asset, seconds):
+
+        series = self.series.get(asset)
+        if series is None:
+            return None
+        times, closes = series
+        i = bisect_right(times, seconds) - 1
+        if i < 0 or seconds - times[i] > PRICE_MAX_AGE:
+            return None
+        return closes[i]
+
+    def value(self, asset, amount, dateStr):
+
+        if asset == FIAT_CURRENCY:
+            return amount
+        price = self.price(asset, accointing_utc_seconds(dateStr))
+        if price is None:
+            return None
+        try:
+            return FIAT_VALUE_FORMAT.format(float(amount) * price)
+        except ValueError:
+            return None
+
+    def close(self):
+
+        self.series.clear()
+        for mm, views in self.buffers:
+            for view in views:
+                view.release()
+            mm.close()
+        self.buffers.clear()
+        if self.owner:
+            shutil.rmtree(self.storeDir, ignore_errors=True)
+
+
+def fiat_value(prices, date, inAmount, inAsset, outAmount, outAsset, feeAmount, feeAsset, sourceValues):
+
+    # `sourceValues` are the (asset, amount, USD value) of the source row.
+    if inAsset == FIAT_CURRENCY or (inAsset and outAsset != FIAT_CURRENCY):
+        asset, amount = inAsset, inAmount
+    elif outAsset:
+        asset, amount = outAsset, outAmount
+    else:
+        asset, amount = feeAsset, feeAmount
+    if not asset or not amount:
+        return None
+
+    for sourceAsset, sourceAmount, usdValue in sourceValues:
+        if usdValue and sourceAsset == asset and sourceAmount and sourceAmount.lstrip('-') == amount:
+            return usdValue
+    return prices.value(asset, amount, date)
+
+
+def fiat_row_mapper(prices, idTuple, rowmapper):
+
+    # Appends the fiat value to the rows of `rowmapper`.
+    sourceFields = FIAT_SOURCE_VALUE_FIELDS.get(idTuple, ())
+
+    def mapper(tx):
+        row = rowmapper(tx)
+        row.append(fiat_value(prices, *row[1:8], ((tx[asset], tx[amount], tx[usdValue]) for asset, amount, usdValue in sourceFields)))
+        return row
+
+    return update_wrapper(mapper, rowmapper)
+
+
+def fiat_columnar_mapper(prices, idTuple, columnarMapper):
+
+    # Appends the fiat value column to the columns of `columnarMapper`.
+    sourceFields = FIAT_SOURCE_VALUE_FIELDS.get(idTuple, ())
+
+    def mapper(cols):
+        outCols = columnarMapper(cols)
+        sourceRows = zip(*[zip(cols[asset], cols[amount], cols[usdValue]) for asset, amount, usdValue in sourceFields]) if sourceFields else itertools.repeat(())
+        outCols.append([fiat_value(prices, *values, sourceValues) for values, sourceValues in zip(zip(*outCols[1:8]), sourceRows)])
+        return outCols
+
+    return update_wrapper(mapper, columnarMapper)
+
+
+#
+# -------- CONVERSION CONTEXT --------
+#
+# All the state of a conversion lives in a `Converter`: the region with its config maps and dispatch plans, the input
+# timezone with its timestamp conversions, the Binance.US order counter, the trading pairs missing from the pairs
+# config, the price store and a `ConversionRun` with the output options.  Each file context holds its converter, and
+# the mappers and output stages are called with it (see `bind_mapper()`), so independent conversions, with different
+# options, can run in parallel threads, or interleave in async tasks, within one process.  The config maps, dispatch
+# plans and timezone tables that conversions of the same region share are never modified.
+#
+# The script can also be used as a library (loaded with `importlib`, since "to-accointing" is not a module name):
+#
+#   with Converter("us", timezone("US/Eastern"), run=ConversionRun(dedup=DedupIndex())) as conv:
+#       for row in conv.rows(["binance-2023.csv"]):
+#           ...
+#       for row in conv.for_timezone(None).rows(["celsius-2023.csv"]):
+#           ...
+
+# Converter attribute -> datetime format of the `*_dt_xform` functions each converter builds for its timezone.
+CONVERTER_DT_XFORMS = {
+    'binance_us_dt_xform': BINANCE_US_DATETIME_FORMAT,
+    'blockfi_dt_xform': BLOCKFI_DATETIME_FORMAT,
+    'celsius_dt_xform': CELSIUS_DATETIME_FORMAT,
+    'coinbase_dt_xform': COINBASE_DATETIME_FORMAT,
+    'ts_datetime_xform': TS_DATETIME_FORMAT
+}
+
+class ConversionRun:
+
+    # The output options of a conversion, with their state: `dedup` a `DedupIndex` (`--dedup`), `aggregateFills`
+    # (`--aggregate-fills`), `reconciler` a `Reconciler` (`--reconcile`), `lots` a `LotMatcher` (`--gains`), `rejects` a
+    # `RejectLog` (`--keep-going`), `shards` the `ShardWriter` options (`--shard-*`, `--compress`), `arrowOutput` an
+    # `ArrowWriter` (`--arrow-output`) and `stats` the statistics of `new_stats()` (`--stats`).  Every option is off by
+    # default.  A converter and its converters for other timezones share one run.
+
+    def __init__(self, dedup=None, aggregateFills=False, reconciler=None, lots=None, rejects=None, shards=None,
+                 arrowOutput=None, stats=None):
+
+        self.dedup = dedup
+        self.aggregateFills = aggregateFills
+        self.reconciler = reconciler
+        self.lots = lots
+        self.rejects = rejects
+        self.shards = shards
+        self.arrowOutput = arrowOutput
+        self.stats = stats
+
+    def dedup_filter(self, ctx):
+
+        # The dedup predicate for the converted rows of `ctx` (see `DedupIndex.file_filter()`), or `None`.
+        return self.dedup.file_filter((ctx['source'], ctx['type'])) if self.dedup else None
+
+    def close(self):
+
+        # Releases the files (and temporary files) of the run without writing its reports, e.g. after a failed
+        # conversion.  Closing more than once is harmless.
+        if self.dedup:
+            self.dedup.close()
+        if self.rejects:
+            self.rejects.close()
+        if self.lots:
+            self.lots.gainsFile.close()
+        if self.arrowOutput:
+            self.arrowOutput.release()
+
+
+class Converter:
+
+    # `config` is the result of `load_config()` for `region` (loaded if not given), `orderSpillDir` the spill
+    # directory of an order counter to share (see `make_order_counter()`), `prices` a `PriceStore` for the fiat value
+    # column and `run` the `ConversionRun` with the output options (neither is closed by the converter).  The timestamp
+    # conversions are counted in the statistics of `run`, if any.
+
+    def __init__(self, region="us", inputTz=None, orderCountMode='exact', orderSpillDir=None, config=None, prices=None,
+                 run=None):
+
+        self.region = region
+        self.prices = prices
+        self.run = run or ConversionRun()
+        self.config = config or load_config(region)
+        self.classifyMap, self.pairMap, sharedPlans, self.dispatchPlanErrors = self.config
+        self.dispatchPlans = {idTuple: plan.copy() for idTuple, plan in sharedPlans.items()}
+        self.statsCounters = self.run.stats['counters'] if self.run.stats is not None else None
+        self.uniqueOrders = make_order_counter(orderCountMode, orderSpillDir)
+        self.unknownPairs = {}   # Trading pair -> rows, for pairs missing from the pairs config.  See `separate_pair()`.
+        self.timezoneConverters = {}   # Timezone -> converter sharing this one's state.  See `for_timezone()`.
+        self.set_timezone(inputTz)
+
+    def __enter__(self):
+
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+
+        self.close()
+
+    def set_timezone(self, tz):
+
+        # `None` implies pass-through (no conversion).  Cached conversions are only valid for the timezone they were
+        # computed with, so new ones are built.
+        self.inputTz = tz
+        tzTable = build_tz_offset_table(tz)
+        for name, dateTimeFormat in CONVERTER_DT_XFORMS.items():
+            xform = make_dt_xform(dateTimeFormat, tzTable)
+            if self.statsCounters is not None:
+                xform = stats_counter(self.statsCounters, 'timestamp', xform)
+            setattr(self, name, xform)
+
+    def for_timezone(self, tz):
+
+        # Returns a converter for input times in `tz` that shares everything else with this one (config, order counter,
+        # unknown pairs, statistics), so files from different timezones are converted in the same run.  The converters
+        # are cached per timezone and only the one created by the caller is closed.
+        if tz == self.inputTz:
+            return self
+        conv = self.timezoneConverters.get(tz)
+        if conv is None:
+            conv = copy.copy(self)
+            conv.set_timezone(tz)
+            conv = self.timezoneConverters.setdefault(tz, conv)
+        return conv
+
+    def take_unknown_pairs(self):
+
+        # Returns and resets the trading pairs that `separate_pair()` did not find since the last call.
+        pairs = dict(self.unknownPairs)
+        self.unknownPairs.clear()
+        return pairs
+
+    def rows(self, filenames, engine='row'):
+
+        # Yields the converted rows of the input files (in `output_header_row()` order), file by file, with the output
+        # options of `run` applied as on the command line: rows are rejected, deduplicated, aggregated, reconciled,
+        # matched against the lots and written to the Arrow output.  With `lots`, the rows of all files are yielded in
+        # date order instead (as with `--gains`, and read back from the sort files as strings).  The rows are yielded
+        # instead of being written to shards.  Raises an exception for a file that is not recognized and (without
+        # `rejects`) for a row that cannot be converted.  The reports of the run are written by the caller, e.g.
+        # `run.reconciler.write_report()`.
+        rows = self.file_rows(filenames, engine)
+        if self.run.lots:
+            rows = sorted_rows(rows)
+        return arrow_rows(self.run, lot_rows(self.run, rows))
+
+    def file_rows(self, filenames, engine):
+
+        for filename in expand_archives(filenames):
+            ctx = get_file_context(self, filename)
+            if (not ctx['success']):
+                raise Exception("{} -> '{}'".format(ctx['message'], filename))
+            self.take_unknown_pairs()
+            if (engine == 'columnar'):
+                rows = columnar_file_rows(ctx)
+            else:
+                table = stats_row_table(ctx) if self.run.stats else row_table(ctx, input_table(ctx), ctx['rowmapper'])
+                rows = itertools.islice(table, 1, None)
+            yield from run_rows(ctx, rows)
+
+    def close(self):
+
+        self.uniqueOrders.close()
+
+
+def bind_mapper(mapper, conv):
+
+    # Returns `mapper` (a row or columnar mapper) with `conv` bound as its first argument.  Keeps the mapper's name
+    # for `--stats`.
+    return update_wrapper(partial(mapper, conv), mapper)
+
+
+def file_row_mapper(conv, idTuple):
+
+    rowmapper = bind_mapper(ROWMAPPER_MAP[idTuple], conv)
+    return fiat_row_mapper(conv.prices, idTuple, rowmapper) if conv.prices else rowmapper
+
+
+def file_columnar_mapper(conv, idTuple):
+
+    columnarMapper = bind_mapper(COLUMNAR_MAPPER_MAP[idTuple], conv)
+    return fiat_columnar_mapper(conv.prices, idTuple, columnarMapper) if conv.prices else columnarMapper
+
+
+#
+# -------- CONVERSION FUNCTIONS --------
+#
+# Each mapper looks up the raw type value of a row in the dispatch plan compiled for its (TxSource, TxType) by
+# `compile_dispatch_plans()`.  A plan entry is a tuple of (transactionType, direction, classification), where the
+# direction tells the mapper which fields go to the "in" and "out" side of the Accointing row:
+#   'in' / 'out'   - the amount goes in / out
+#   'fee'          - the amount is a fee
+#   'buy' / 'sell' - an order, bought or sold from the point of view of the source's main asset
+#   'convert'      - an order whose details are parsed from the notes (Coinbase)
+#   'sign'         - 'in' or 'out' depending on the sign of the amount
+#   None           - neither (unrecognized type)
+
+class DispatchPlan(dict):
+
+    # Maps a raw type value to its plan entry.  Values that were not anticipated when the plan was compiled are
+    # resolved on first use and then cached, so every row costs a single dict lookup.  The compiled plans of a region
+    # are shared and never modified (see `load_config()`): each converter caches into its own `copy()`.
+
+    def __init__(self, resolver, knownKeys=()):
+        super().__init__()
+        self.resolver = resolver
+        for key in knownKeys:
+            try:
+                self[key] = resolver(key)
+            except Exception:
+                pass   # Leave invalid combinations to raise when (and if) they are seen in an input file.
+
+    def __missing__(self, key):
+        entry = self.resolver(key)
+        self[key] = entry
+        return entry
+
+    def copy(self):
+        plan = DispatchPlan(self.resolver)
+        plan.update(self)
+        return plan
+
+
+# ---- Binance.us ----
+
+
+BINANCE_US_TYPE_MAP = {
+    'Deposit':"deposit",
+    'Distribution':"deposit",
+    'Withdrawal':"withdraw",
+    'Buy':"order",
+    'Convert':"order",
+    'Sell':"order",
+    'Spot Trading':"order"
+}
+
+BINANCE_US_ORDER_DIRECTIONS = {
+    ('Buy', 'Buy'): 'sell',                 # Double-checked
+    ('Sell', 'Sell'): 'sell',               # Double-checked
+    ('Spot Trading', 'Buy'): 'buy',         # Double-checked
+    ('Spot Trading', 'Sell'): 'sell',       # Double-checked
+    ('Convert', 'Convert'): 'sell'
+}
+
+BINANCE_US_COMMENT_PREFIX = "Transaction_Id: "
+
+def split_binance_us_comments(comments):
+
+    # Returns ('Transaction_Id', 'Additional_Note') from the comments written by the Binance.US mappers.
+    txId, _, note = comments[len(BINANCE_US_COMMENT_PREFIX):].partition("; ")
+    return (txId, note)
+
+
+def binance_us_plan_resolver(valueMap):
+
+    # Plan keys are (Category, Operation).  For orders, 'buy' means the base asset comes in and the quote asset goes
+    # out, and 'sell' the opposite.
+    def resolver(key):
+        category, operation = key
+        if category not in BINANCE_US_TYPE_MAP:
+            raise Exception("Unhandled Binance.US 'Category': '{}'".format(category))
+
+        transactionType = BINANCE_US_TYPE_MAP[category]
+        if transactionType == "order":
+            direction = BINANCE_US_ORDER_DIRECTIONS.get(key)
+            if not direction:
+                raise Exception("Unhandled Binance.US 'Category'/'Operation' combination: '{}'/'{}'".format(category, operation))
+        else:
+            direction = 'in' if transactionType == "deposit" else 'out'
+
+        return (transactionType, direction, valueMap.get(operation, None))
+
+    knownKeys = list(BINANCE_US_ORDER_DIRECTIONS.keys())
+    knownKeys += [(category, operation) for category, txType in BINANCE_US_TYPE_MAP.items() if txType != "order" for operation in valueMap]
+    return (resolver, knownKeys)
+
+
+def binance_us_row_mapper(conv, tx):
+
+    transactionType, direction, classification = conv.dispatchPlans[(TxSource.BINANCE_US, TxType.COMMON)][(tx['Category'], tx['Operation'])]
+    txDate = conv.binance_us_dt_xform(tx['Time'])
+
+    if direction == 'in':
+        inBuyAmount = tx['Realized_Amount_For_Primary_Asset']
+        inBuyAsset = tx['Primary_Asset']
+        outSellAmount = None
+        outSellAsset = None
+    elif direction == 'out':
+        inBuyAmount = None
+        inBuyAsset = None
+        outSellAmount = tx['Realized_Amount_For_Primary_Asset']
+        outSellAsset = tx['Primary_Asset']
+    elif direction == 'buy':
+        inBuyAmount = tx['Realized_Amount_For_Base_Asset']
+        inBuyAsset = tx['Base_Asset']
+        outSellAmount = tx['Realized_Amount_For_Quote_Asset']
+        outSellAsset = tx['Quote_Asset']
+    else:
+        inBuyAmount = tx['Realized_Amount_For_Quote_Asset']
+        inBuyAsset = tx['Quote_Asset']
+        outSellAmount = tx['Realized_Amount_For_Base_Asset']
+        outSellAsset = tx['Base_Asset']
+
+    feeAmount = tx['Realized_Amount_For_Fee_Asset']
+    feeAsset = tx['Fee_Asset']
+    operationId = tx['Order_Id']
+    if (tx['Additional_Note']):
+        comments = "{}{}; {}".format(BINANCE_US_COMMENT_PREFIX, tx['Transaction_Id'], tx['Additional_Note'])
+    else:
+        comments = "{}{}".format(BINANCE_US_COMMENT_PREFIX, tx['Transaction_Id'])
+
+    # Since The Binance.US CSV stores multiple fills for a single order, an order counter will be used to determine
+    # the number of unique orders.
+    conv.uniqueOrders.add(tx['Order_Id'])
+
+    return [transactionType, txDate, inBuyAmount, inBuyAsset, outSellAmount, outSellAsset, feeAmount, feeAsset, classification, operationId, comments]
+
+
+# ---- BlockFi ----
+
+
+BLOCKFI_DEPOSIT_TYPES = {'BIA Deposit', 'Bonus Payment', 'Cc Rewards Redemption', 'Crypto Transfer', 'Interest Payment', 'Referral Bonus'}
+BLOCKFI_WITHDRAWAL_TYPES = {'BIA Withdraw', 'Withdrawal'}
+BLOCKFI_TRADE_TYPES = {'Trade'}
+BLOCKFI_FEE_TYPES = {'Withdrawal Fee'}
+
+def blockfi_plan_resolver(valueMap):
+
+    def resolver(txType):
+        if txType in BLOCKFI_DEPOSIT_TYPES:
+            entry = ("deposit", 'in')
+        elif txType in BLOCKFI_WITHDRAWAL_TYPES:
+            entry = ("withdraw", 'out')
+        elif txType in BLOCKFI_FEE_TYPES:
+            entry = ("withdraw", 'fee')
+        elif txType in BLOCKFI_TRADE_TYPES:
+            entry = ("order", 'sign')   # The "in" and "out" sides of a trade are separate lines.
+        else:
+            entry = ("???", None)
+        return entry + (valueMap.get(txType, None),)
+
+    return (resolver, BLOCKFI_DEPOSIT_TYPES | BLOCKFI_WITHDRAWAL_TYPES | BLOCKFI_TRADE_TYPES | BLOCKFI_FEE_TYPES | set(valueMap))
+
+
+def blockfi_row_mapper(conv, tx):
+
+    transactionType, direction, classification = conv.dispatchPlans[(TxSource.BLOCKFI, TxType.COMMON)][tx['Transaction Type']]
+    if direction == 'sign':
+        direction = 'out' if tx['Amount'].startswith('-') else 'in'
+
+    txDate = conv.blockfi_dt_xform(tx['Confirmed At'])
+    inBuyAmount = tx['Amount'] if direction == 'in' else None
+    inBuyAsset = tx['Cryptocurrency'] if direction == 'in' else None
+    outSellAmount = tx['Amount'].lstrip('-') if direction == 'out' else None
+    outSellAsset = tx['Cryptocurrency'] if direction == 'out' else None
+    feeAmount =  tx['Amount'].lstrip('-') if direction == 'fee' else None
+    feeAsset = tx['Cryptocurrency'] if direction == 'fee' else None
+    operationId = None
+    comments = tx['Transaction Type']
+
+    return [transactionType, txDate, inBuyAmount, inBuyAsset, outSellAmount, outSellAsset, feeAmount, feeAsset, classification, operationId, comments]
+
+
+# ---- Celsius ----
+
+
+CELSIUS_DEPOSIT_TYPES = {'Promo Code Reward', 'Referred Award', 'Referrer Award', 'Reward', 'Transfer'}
+CELSIUS_WITHDRAWAL_TYPES = {'Withdrawal'}
+CELSIUS_SIGN_TYPES = {''}   # Rows without a transaction type are deposits or withdrawals depending on the amount's sign.
+
+def celsius_plan_resolver(valueMap):
+
+    def resolver(txType):
+        if txType in CELSIUS_DEPOSIT_TYPES:
+            entry = ("deposit", 'in')
+        elif txType in CELSIUS_WITHDRAWAL_TYPES:
+            entry = ("withdraw", 'out')
+        elif txType in CELSIUS_SIGN_TYPES:
+            entry = (None, 'sign')
+        else:
+            entry = ("???", None)
+        return entry + (valueMap.get(txType, None),)
+
+    return (resolver, CELSIUS_DEPOSIT_TYPES | CELSIUS_WITHDRAWAL_TYPES | CELSIUS_SIGN_TYPES | set(valueMap))
+
+
+def celsius_row_mapper(conv, tx):
+
+    transactionType, direction, classification = conv.dispatchPlans[(TxSource.CELSIUS, TxType.COMMON)][tx['Transaction type']]
+    if direction == 'sign':
+        direction = 'out' if float(tx['Coin amount']) < 0 else 'in'
+        transactionType = "withdraw" if direction == 'out' else "deposit"
+
+    txDate = conv.celsius_dt_xform(tx['Date and time'])
+    inBuyAmount = tx['Coin amount'] if direction == 'in' else None
+    inBuyAsset = tx['Coin type'] if direction == 'in' else None
+    outSellAmount = tx['Coin amount'].lstrip('-') if direction == 'out' else None
+    outSellAsset = tx['Coin type'] if direction == 'out' else None
+    feeAmount = None
+    feeAsset = None
+    operationId = tx['Internal id']
+    comments = tx['Transaction type']
+
+    return [transactionType, txDate, inBuyAmount, inBuyAsset, outSellAmount, outSellAsset, feeAmount, feeAsset, classification, operationId, comments]
+
+
+# ---- Coinbase ----
+
+COINBASE_DEPOSIT_TYPES = {'Learning Reward', 'Receive', 'Rewards Income'}
+COINBASE_WITHDRAWAL_TYPES = {'Send'}
+COINBASE_ORDER_TYPES = {'Buy', 'Convert', 'Sell'}
+COINBASE_ORDER_DIRECTIONS = {'Buy': 'buy', 'Sell': 'sell', 'Convert': 'convert'}
+COINBASE_RECEIVE_TYPE = 'Receive'   # Only classified as income when received from a referral.
+COINBASE_REFERRAL_SUFFIX = "from Coinbase Referral"
+COINBASE_TYPE_ERROR = "Unhandled Coinbase 'Transaction Type': {}"
+COINBASE_NOTES_ERROR = "Could not parse conversion details from Coinbase 'Notes' field: {}"
+
+def coinbase_row_error(message, values):
+
+    # The error for a Coinbase row, the same for both engines (and so in the reject file): `message` with the values of
+    # the row's fields, in field order.
+    return Exception(message.format(tuple(values)))
+
+def coinbase_plan_resolver(valueMap):
+
+    # Coinbase classifications are built in rather than taken from classify.json.
+    def resolver(txType):
+        if txType in COINBASE_DEPOSIT_TYPES:
+            return ("deposit", 'in', "income" if txType != COINBASE_RECEIVE_TYPE else None)
+        if txType in COINBASE_WITHDRAWAL_TYPES:
+            return ("withdraw", 'out', None)
+        if txType in COINBASE_ORDER_TYPES:
+            return ("order", COINBASE_ORDER_DIRECTIONS[txType], None)
+        return None
+
+    return (resolver, COINBASE_DEPOSIT_TYPES | COINBASE_WITHDRAWAL_TYPES | COINBASE_ORDER_TYPES)
+
+
+def coinbase_row_mapper(conv, tx):
+
+    if conv.region != 'us':
+        raise Exception("The coinbase row mapper only supports Coinbase US data currently.")
+
+    entry = conv.dispatchPlans[(TxSource.COINBASE, TxType.COMMON)][tx['Transaction Type']]
+    if not entry:
+        raise coinbase_row_error(COINBASE_TYPE_ERROR, tx)
+
+    transactionType, direction, classification = entry
+    txHasFee = len(tx['Fees and/or Spread']) > 0
+
+    if direction == 'in':
+        inBuyAmount = tx['Quantity Transacted']
+        inBuyAsset = tx['Asset']
+        outSellAmount = None
+        outSellAsset = None
+        if tx['Transaction Type'] == COINBASE_RECEIVE_TYPE and tx['Notes'].endswith(COINBASE_REFERRAL_SUFFIX):
+            classification = "income"
+
+    elif direction == 'out':
+        inBuyAmount = None
+        inBuyAsset = None
+        outSellAmount = tx['Quantity Transacted']
+        outSellAsset = tx['Asset']
+
+    elif direction == 'buy':
+        inBuyAmount = tx['Quantity Transacted']
+        inBuyAsset = tx['Asset']
+        outSellAmount = tx['Subtotal']
+        outSellAsset = tx['Spot Price Currency']
+
+    elif direction == 'sell':
+        inBuyAmount = tx['Subtotal']
+        inBuyAsset = tx['Spot Price Currency']
+        outSellAmount = tx['Quantity Transacted']
+        outSellAsset = tx['Asset']
+
+    else:
+        strippedNotes = re.sub('[$,"]', '', tx['Notes'])  # This function assumes US Coinbase CSV format.
+        match = COINBASE_CONVERTED_US.match(strippedNotes)
+        if not match or len(match.groups()) != 4:
+            raise coinbase_row_error(COINBASE_NOTES_ERROR, tx)
+
+        inBuyAmount = match[3]
+        inBuyAsset = match[4]
+        outSellAmount = match[1]
+        outSellAsset = match[2]
+  
+    txDate = conv.coinbase_dt_xform(tx['Timestamp'])
+    feeAmount = tx['Fees and/or Spread'] if txHasFee else None
+    feeAsset = tx['Spot Price Currency'] if txHasFee else None
+    operationId = None # Coinbase does not provide a transaction id or operation id.
+    comments = tx['Notes']
+
+    return [transactionType, txDate, inBuyAmount, inBuyAsset, outSellAmount, outSellAsset, feeAmount, feeAsset, classification, operationId, comments]
+
+
+# ---- TradeStation ----
+
+def ts_dt_xform(conv, dateStr, timeStr) -> str:
+
+    return conv.ts_datetime_xform("{} {}".format(dateStr, (timeStr if timeStr else TS_NONTRADE_DEFAULT_TIME_STR)))
+
+
+TS_NONTRADE_DEPOSIT_TYPES = {'Deposit', 'Interest'}
+TS_NONTRADE_WITHDRAWAL_TYPES = {'Withdrawal'}
+
+def ts_nontrade_plan_resolver(valueMap):
+
+    def resolver(txType):
+        if txType in TS_NONTRADE_DEPOSIT_TYPES:
+            entry = ("deposit", 'in')
+        elif txType in TS_NONTRADE_WITHDRAWAL_TYPES:
+            entry = ("withdraw", 'out')
+        else:
+            entry = ("???", None)
+        return entry + (valueMap.get(txType, None),)
+
+    return (resolver, TS_NONTRADE_DEPOSIT_TYPES | TS_NONTRADE_WITHDRAWAL_TYPES | set(valueMap))
+
+
+def ts_nontrade_rowmapper(conv, tx):
+
+    transactionType, direction, classification = conv.dispatchPlans[(TxSource.TRADESTATION, TxType.NONTRADE)][tx['Type']]
+
+    txDate = ts_dt_xform(conv, tx['Date'], tx['Time'])
+    inBuyAmount = tx['Amount'] if direction == 'in' else None
+    inBuyAsset = tx['Unit'] if direction == 'in' else None
+    outSellAmount = tx['Amount'] if direction == 'out' else None
+    outSellAsset = tx['Unit'] if direction == 'out' else None
+    feeAmount = None
+    feeAsset = None
+    operationId = tx['TransactionID']
+    comments = "{}; {}".format(tx['Details'], tx['Notes']) if (tx['Notes']) else tx['Details']
+
+    return [transactionType, txDate, inBuyAmount, inBuyAsset, outSellAmount, outSellAsset, feeAmount, feeAsset, classification, operationId, comments]
+
+
+TS_TRADE_DIRECTIONS = {'BOUGHT': 'buy', 'SOLD': 'sell'}
+
+def ts_trade_plan_resolver(valueMap):
+
+    def resolver(boughtSold):
+        if boughtSold not in TS_TRADE_DIRECTIONS:
+            raise Exception("Invalid value '{}' in 'BoughtSold' field.".format(boughtSold))
+        return ('order', TS_TRADE_DIRECTIONS[boughtSold], None)
+
+    return (resolver, TS_TRADE_DIRECTIONS.keys())
+
+
+def ts_trade_rowmapper(conv, tx):
+
+    transactionType, direction, classification = conv.dispatchPlans[(TxSource.TRADESTATION, TxType.TRADE)][tx['BoughtSold']]
+    txDate = ts_dt_xform(conv, tx['Date'], tx['Time'])
+    pair = separate_pair(conv, tx['Symbol'])
+
+    if (direction == 'buy'):
+        inBuyAmount = tx['Quantity']
+        inBuyAsset = pair[0]
+        outSellAmount = tx["Amount"]
+        outSellAsset = pair[1]
+    else:
+        inBuyAmount = tx["Amount"]
+        inBuyAsset = pair[1]
+        outSellAmount = tx['Quantity']
+        outSellAsset = pair[0]
+
+    feeAmount = tx['Fee']
+    feeAsset = tx['FeeUnit']
+    operationId = tx['TransactionID']
+    comments = tx['Notes']
+
+    return [transactionType, txDate, inBuyAmount, inBuyAsset, outSellAmount, outSellAsset, feeAmount, feeAsset, classification, operationId, comments]
+
+
+# ---- Rowmapper Map ----
+
+ROWMAPPER_MAP = {
+    (TxSource.BINANCE_US, TxType.COMMON): binance_us_row_mapper,
+    (TxSource.BLOCKFI, TxType.COMMON): blockfi_row_mapper,
+    (TxSource.CELSIUS, TxType.COMMON): celsius_row_mapper,
+    (TxSource.COINBASE, TxType.COMMON): coinbase_row_mapper,
+    (TxSource.TRADESTATION, TxType.NONTRADE): ts_nontrade_rowmapper,
+    (TxSource.TRADESTATION, TxType.TRADE): ts_trade_rowmapper
+}
+
+
+# ---- Dispatch Plans ----
+
+# (TxSource, TxType) -> (plan resolver factory, classify.json field used for classification or `None`)
+PLAN_RESOLVER_MAP = {
+    (TxSource.BINANCE_US, TxType.COMMON): (binance_us_plan_resolver, 'Operation'),
+    (TxSource.BLOCKFI, TxType.COMMON): (blockfi_plan_resolver, 'Transaction Type'),
+    (TxSource.CELSIUS, TxType.COMMON): (celsius_plan_resolver, 'Transaction type'),
+    (TxSource.COINBASE, TxType.COMMON): (coinbase_plan_resolver, None),
+    (TxSource.TRADESTATION, TxType.NONTRADE): (ts_nontrade_plan_resolver, 'Type'),
+    (TxSource.TRADESTATION, TxType.TRADE): (ts_trade_plan_resolver, None)
+}
+
+def validate_classify_map(classifyMap):
+
+    errors = []
+    sourceNames = {str(txSource): txSource for txSource in TxSource if txSource != TxSource.UNKNOWN}
+
+    if not isinstance(classifyMap, dict):
+        raise Exception("The region in classify.json must map source names to field maps.")
+
+    for sourceName, fieldMap in classifyMap.items():
+        if sourceName not in sourceNames:
+            errors.append("Unknown source '{}' (expected one of: {}).".format(sourceName, ", ".join(sourceNames)))
+            continue
+        if not isinstance(fieldMap, dict):
+            errors.append("Source '{}' must map field names to value maps.".format(sourceName))
+            continue
+
+        sourceFields = {field for header, idTuple in IDENTIFY_MAP.items() if idTuple[0] == sourceNames[sourceName] for field in header}
+        for fieldName, valueMap in fieldMap.items():
+            if fieldName not in sourceFields:
+                errors.append("Field '{}' of source '{}' is not a column of any {} header.".format(fieldName, sourceName, sourceName))
+            elif not isinstance(valueMap, dict):
+                errors.append("Field '{}' of source '{}' must map values to classifications.".format(fieldName, sourceName))
+            else:
+                for value, classification in valueMap.items():
+                    if not isinstance(classification, str) or not classification:
+                        errors.append("Classification of '{}' in field '{}' of source '{}' must be a non-empty string.".format(value, fieldName, sourceName))
+
+    if errors:
+        raise Exception("Invalid classify.json region:\n  " + "\n  ".join(errors))
+
+
+def validate_pair_map(pairMap):
+
+    errors = []
+    if not isinstance(pairMap, dict):
+        raise Exception("pairs.json must map trading pair symbols to [left, right] symbol lists.")
+
+    for pairStr, symbols in pairMap.items():
+        if not (isinstance(symbols, (list, tuple)) and len(symbols) == 2 and all(isinstance(symbol, str) and symbol for symbol in symbols)):
+            errors.append("Pair '{}' must map to a list of two non-empty symbols: {}".format(pairStr, symbols))
+
+    if errors:
+        raise Exception("Invalid pairs.json:\n  " + "\n  ".join(errors))
+
+
+def compile_dispatch_plans(regionStr, classifyMap, pairMap):
+
+    # Validates the classification and pair maps and returns (pairMap, dispatchPlans, dispatchPlanErrors), where
+    # `dispatchPlans` maps (TxSource, TxType) to its DispatchPlan and `dispatchPlanErrors` to a configuration error
+    # that prevents converting the source.  Problems with the configuration are raised here, before any conversion
+    # starts.  A source whose classification field is missing from the region only becomes an error if a file from
+    # that source is identified.
+    validate_classify_map(classifyMap)
+    validate_pair_map(pairMap)
+    pairMap = {pairStr: tuple(symbols) for pairStr, symbols in pairMap.items()}
+
+    dispatchPlans = {}
+    dispatchPlanErrors = {}
+    for idTuple, (resolverFactory, classifyField) in PLAN_RESOLVER_MAP.items():
+        valueMap = {}
+        if classifyField:
+            fieldMap = classifyMap.get(str(idTuple[0]), None)
+            if (not fieldMap):
+                dispatchPlanErrors[idTuple] = "Source '{}' not found in classify.json for region '{}'.".format(str(idTuple[0]), regionStr)
+                continue
+            valueMap = fieldMap.get(classifyField, None)
+            if (not valueMap):
+                dispatchPlanErrors[idTuple] = "Field '{}' not found in classify.json for source '{}'.".format(classifyField, str(idTuple[0]))
+                continue
+
+        resolver, knownKeys = resolverFactory(valueMap)
+        dispatchPlans[idTuple] = DispatchPlan(resolver, knownKeys)
+
+    return (pairMap, dispatchPlans, dispatchPlanErrors)
+
+
+
+def get_file_context(conv, filename):
+
+    fileContextDict = {}
+    fileContextDict['filename'] = filename
+    fileContextDict['converter'] = conv
+
+    # Does the file Exist
+    if (filename != STDIN_INPUT and not os.path.isfile(split_zip_member(filename)[0] or filename)):
+        fileContextDict['success'] = False
+        fileContextDict['message'] = "File does not exist."
+        return fileContextDict
+
+    # Only the header row is read for identification.  Leading and trailing white space is removed from field names.
+    try:
+        fileContextDict['header'] = sniff_header(filename)
+    except INPUT_READ_ERRORS as e:
+        fileContextDict['success'] = False
+        fileContextDict['message'] = "Cannot read header: {}".format(e)
+        return fileContextDict
+
+    # Determine Source Type
+    idTuple = IDENTIFY_MAP.get(fileContextDict['header'], (TxSource.UNKNOWN, TxType.COMMON))
+
+    fileContextDict['source'] = idTuple[0]
+    fileContextDict['type'] = idTuple[1]
+ 
+    if (fileContextDict['source'] == TxSource.UNKNOWN):
+        fileContextDict['success'] = False
+        fileContextDict['message'] = "Unrecognized header in file: '{}'".format(filename)
+        return fileContextDict
+
+    # Create a table.  It is lazy, so the file is not read again until the conversion.  Plain files are memory-mapped
+    # and only the fields the mappers use are read.
+    if (filename != STDIN_INPUT and input_kind(filename) == 'plain'):
+        fileContextDict['table'] = MmapTable(filename, fileContextDict['header'], mapper_fields(conv, idTuple))
+    else:
+        fileContextDict['table'] = etl.transform.headers.setheader(etl.fromcsv(input_source(filename)), list(fileContextDict['header']))
+
+    rowmapper = ROWMAPPER_MAP.get(idTuple, None)
+
+    if (not rowmapper):
+        raise Exception("Missing ROWMAPPER_MAP entry for idTuple ({},{}).".format(TxSource, TxType))
+
+    set_file_converter(fileContextDict, conv)
+
+    if (idTuple in conv.dispatchPlanErrors):
+        fileContextDict['success'] = False
+        fileContextDict['message'] = conv.dispatchPlanErrors[idTuple]
+        return fileContextDict
+
+    fileContextDict['success'] = True
+    fileContextDict['message'] = None
+
+    return fileContextDict
+
+
+def set_file_converter(ctx, conv):
+
+    # Makes `conv` convert the (recognized) file of `ctx`.
+    ctx['converter'] = conv
+    ctx['rowmapper'] = file_row_mapper(conv, (ctx['source'], ctx['type']))
+
+
+# ---- Input Streams ----
+#
+# Besides plain CSV files, an input may be gzip or zstd compressed (detected from the first bytes, so e.g. ".csv.gz"
+# and ".zst" both work), a member of a zip archive ("bundle.zip/member.csv"; a ".zip" input stands for all of its CSV
+# members), or "-" for stdin (which may be compressed as well).  Compressed inputs are decompressed in chunks while
+# they are read, and are never written to disk.
+
+STDIN_INPUT = "-"
+ZIP_MEMBER_SEPARATOR = ".zip/"
+GZIP_MAGIC = b'\x1f\x8b'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+STDIN_STREAM = None        # (Decompressed) stdin, opened once.  See `StdinReader`.
+STDIN_HEAD = bytearray()   # Bytes of stdin read while identifying it, returned again for the conversion.
+
+# Errors that make an input unreadable (rather than a bug).
+INPUT_READ_ERRORS = (OSError, EOFError, KeyError, UnicodeDecodeError, csv.Error, zipfile.BadZipFile) + ((zstandard.ZstdError,) if zstandard else ())
+
+def split_zip_member(filename):
+
+    # "bundle.zip/member.csv" -> ("bundle.zip", "member.csv"), or (None, None) if `filename` is not a zip member.
+    index = filename.lower().find(ZIP_MEMBER_SEPARATOR)
+    while index >= 0:
+        archive = filename[:index + len(ZIP_MEMBER_SEPARATOR) - 1]
+        if os.path.isfile(archive):
+            return (archive, filename[index + len(ZIP_MEMBER_SEPARATOR):])
+        index = filename.lower().find(ZIP_MEMBER_SEPARATOR, index + 1)
+    return (None, None)
+
+
+def expand_archives(filenames):
+
+    # Replaces each zip archive with its CSV members, in archive order.  Unreadable archives are kept as they are, so
+    # that they are reported by `get_file_context()`.
+    expanded = []
+    for filename in filenames:
+        if not (filename.lower().endswith(".zip") and os.path.isfile(filename)):
+            expanded.append(filename)
+            continue
+        try:
+            with zipfile.ZipFile(filename) as archive:
+                members = [info.filename for info in archive.infolist() if not info.is_dir() and info.filename.lower().endswith(".csv")]
+        except INPUT_READ_ERRORS:
+            expanded.append(filename)
+            continue
+        expanded += [filename + "/" + member for member in members]
+
+    return expanded
+
+
+def compression_magic(stream):
+
+    # 'gzip', 'zstd' or None from the first bytes of a buffered binary stream (which are not consumed).
+    magic = stream.peek(len(ZSTD_MAGIC))[:len(ZSTD_MAGIC)]
+    if magic.startswith(GZIP_MAGIC):
+        return 'gzip'
+    if magic.startswith(ZSTD_MAGIC):
+        return 'zstd'
+    return None
+
+
+def input_kind(filename):
+
+    # 'stdin', 'zip' (a zip member), 'gzip', 'zstd' or 'plain'.
+    if filename == STDIN_INPUT:
+        return 'stdin'
+    if split_zip_member(filename)[0]:
+        return 'zip'
+    with open(filename, 'rb') as f:
+        return compression_magic(f) or 'plain'
+
+
+def zstd_reader(stream):
+
+    if zstandard is None:
+        raise OSError("The zstandard module is required to read zstd-compressed input (pip install zstandard).")
+    return zstandard.ZstdDecompressor().stream_reader(stream, read_across_frames=True, closefd=True)
+
+
+def open_input(filename):
+
+    # Binary stream of the (decompressed) content of an input.
+    kind = input_kind(filename)
+    if kind == 'stdin':
+        return io.BufferedReader(StdinReader(replay=True))
+    if kind == 'zip':
+        archive, member = split_zip_member(filename)
+        with zipfile.ZipFile(archive) as zipFile:
+            return zipFile.open(member)   # The archive file stays open until the member is closed.
+    if kind == 'gzip':
+        return gzip.open(filename, 'rb')
+    if kind == 'zstd':
+        return zstd_reader(open(filename, 'rb'))
+    return open(filename, 'rb')
+
+
+def open_input_text(filename):
+
+    if filename != STDIN_INPUT and input_kind(filename) == 'plain':
+        return open(filename, newline='')
+    return io.TextIOWrapper(open_input(filename), newline='')
+
+
+def input_source(filename):
+
+    # Source for `etl.fromcsv()`: plain files are read by petl itself.
+    if filename != STDIN_INPUT and input_kind(filename) == 'plain':
+        return filename
+    return InputSource(filename)
+
+
+class InputSource:
+
+    # petl source for a compressed input, a zip member or stdin.
+
+    def __init__(self, filename):
+        self.filename = filename
+
+    @contextmanager
+    def open(self, mode):
+        if not mode.startswith('r'):
+            raise Exception("InputSource is read-only.")
+        stream = open_input(self.filename)
+        try:
+            yield stream
+        finally:
+            stream.close()
+
+
+class StdinReader(io.RawIOBase):
+
+    # Raw reader over (decompressed) stdin, which can only be read once.  Identification reads the header through a
+    # reader with `replay=False`, which keeps the bytes it reads in STDIN_HEAD; the conversion's reader (`replay=True`)
+    # returns those bytes first and then continues with the rest of stdin.
+
+    def __init__(self, replay):
+        global STDIN_STREAM
+        if STDIN_STREAM is None:
+            STDIN_STREAM = sys.stdin.buffer
+            compression = compression_magic(STDIN_STREAM)
+            if compression == 'gzip':
+                STDIN_STREAM = gzip.GzipFile(fileobj=STDIN_STREAM, mode='rb')
+            elif compression == 'zstd':
+                STDIN_STREAM = zstd_reader(STDIN_STREAM)
+        self.replay = replay
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        if self.replay and self.position < len(STDIN_HEAD):
+            count = min(len(buffer), len(STDIN_HEAD) - self.position)
+            buffer[:count] = STDIN_HEAD[self.position:self.position + count]
+            self.position += count
+            return count
+        data = STDIN_STREAM.read1(len(buffer))
+        if not self.replay:
+            STDIN_HEAD.extend(data)
+        buffer[:len(data)] = data
+        return len(data)
+
+
+# ---- Memory-Mapped Reader ----
+#
+# Plain input files are read through a memory map instead of petl's `fromcsv`.  Records are scanned straight from the
+# mapped file a chunk at a time, and only the fields in MAPPER_FIELDS_MAP are kept, so the rows handed to the mappers
+# (and the memory they take) don't grow with the columns the mappers never read.  Chunks without quotes are split with
+# `str.split`; chunks with quoted fields are parsed with the csv module.  Both give the same values as `csv.reader`.
+# Chunks are decoded as a whole, which is faster than decoding the kept fields one by one.
+
+MMAP_CHUNK_SIZE = 4 << 20   # Bytes scanned at a time; a chunk always ends at a record boundary.
+SPLIT_MIN_BYTES = 8 << 20   # Minimum size of the byte ranges a large file is split into for `--jobs`.
+
+# Fields read by the row mappers, the columnar mappers and the dispatch plans of each source, in header order.
+MAPPER_FIELDS_MAP = {
+    (TxSource.BINANCE_US, TxType.COMMON): ('Time', 'Category', 'Operation', 'Order_Id', 'Transaction_Id', 'Primary_Asset',
+                                           'Realized_Amount_For_Primary_Asset', 'Base_Asset', 'Realized_Amount_For_Base_Asset',
+                                           'Quote_Asset', 'Realized_Amount_For_Quote_Asset', 'Fee_Asset',
+                                           'Realized_Amount_For_Fee_Asset', 'Additional_Note'),
+    (TxSource.BLOCKFI, TxType.COMMON): BLOCKFI_HEADER,
+    (TxSource.CELSIUS, TxType.COMMON): ('Internal id', 'Date and time', 'Transaction type', 'Coin type', 'Coin amount'),
+    (TxSource.COINBASE, TxType.COMMON): ('Timestamp', 'Transaction Type', 'Asset', 'Quantity Transacted', 'Spot Price Currency',
+                                         'Subtotal', 'Fees and/or Spread', 'Notes'),
+    (TxSource.TRADESTATION, TxType.NONTRADE): ('Date', 'Time', 'Type', 'Amount', 'Unit', 'Details', 'TransactionID', 'Notes'),
+    (TxSource.TRADESTATION, TxType.TRADE): ('Date', 'Time', 'BoughtSold', 'Quantity', 'Symbol', 'Amount', 'Fee', 'FeeUnit',
+                                            'TransactionID', 'Notes')
+}
+
+# The fields read with a fiat value column, which adds the fields of FIAT_SOURCE_VALUE_FIELDS.
+FIAT_MAPPER_FIELDS_MAP = {
+    idTuple: tuple(field for field in header if field in MAPPER_FIELDS_MAP[idTuple] or
+                   any(field in fields for fields in FIAT_SOURCE_VALUE_FIELDS.get(idTuple, ())))
+    for header, idTuple in IDENTIFY_MAP.items()
+}
+
+def mapper_fields(conv, idTuple):
+
+    return (FIAT_MAPPER_FIELDS_MAP if conv.prices else MAPPER_FIELDS_MAP)[idTuple]
+
+
+def count_quotes(mm, start, end):
+
+    count = 0
+    for position in range(start, end, MMAP_CHUNK_SIZE):
+        count += mm[position:min(end, position + MMAP_CHUNK_SIZE)].count(b'"')
+    return count
+
+
+def next_record_boundary(mm, start, target, end):
+
+    # `start` is a record boundary.  Returns the first record boundary after `target` (or `end`): the position after a
+    # newline that is not inside a quoted field, i.e. that follows an even number of quotes.
+    if target >= end:
+        return end
+    quoted = count_quotes(mm, start, target) % 2
+    position = target
+    while True:
+        newline = mm.find(b'\n', position, end)
+        if newline < 0:
+            return end
+        quoted ^= count_quotes(mm, position, newline) % 2
+        position = newline + 1
+        if not quoted:
+            return position
+
+
+def parse_chunk(text, project, width):
+
+    # Returns the projected rows of a chunk of whole records.  Short rows are padded with `None`, matching petl.
+    if '"' not in text and '\r' in text:
+        text = text.replace('\r\n', '\n')
+    if '"' in text or '\r' in text:
+        rows = csv.reader(io.StringIO(text, newline=''))
+        return [project(row if len(row) >= width else row + [None] * (width - len(row))) for row in rows]
+
+    lines = text.split('\n')
+    if lines[-1] == '':
+        lines.pop()
+    try:
+        return [project(line.split(',')) for line in lines]
+    except IndexError:
+        rows = [line.split(',') if line else [] for line in lines]
+        return [project(row if len(row) >= width else row + [None] * (width - len(row))) for row in rows]
+
+
+def read_mmap_chunks(filename, header, fields, byteRange=None):
+
+    # Yields the rows of a plain file (a list of tuples of the `fields` values per chunk).  The header row is skipped,
+    # unless `byteRange` starts after it.
+    indexes = [header.index(field) for field in fields]
+    project = operator.itemgetter(*indexes) if len(indexes) > 1 else lambda row: (row[indexes[0]],)
+    width = max(indexes) + 1
+    encoding = locale.getpreferredencoding(False)
+
+    with open(filename, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        start, end = byteRange if byteRange else (0, size)
+        if size == 0 or start >= end:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            position = next_record_boundary(mm, 0, 0, end) if start == 0 else start
+            while position < end:
+                chunkEnd = next_record_boundary(mm, position, position + MMAP_CHUNK_SIZE, end)
+                text = mm[position:chunkEnd].decode(encoding)
+                position = chunkEnd
+                yield parse_chunk(text, project, width)
+
+
+def split_input_ranges(filename, count):
+
+    # Splits a plain file into up to `count` byte ranges of about the same size that start and end at record
+    # boundaries.  The first range includes the header row.
+    with open(filename, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return [(0, 0)]
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            bounds = [0]
+            for i in range(1, count):
+                boundary = next_record_boundary(mm, bounds[-1], max(size * i // count, bounds[-1]), size)
+                if boundary >= size:
+                    break
+                bounds.append(boundary)
+    bounds.append(size)
+    return list(zip(bounds, bounds[1:]))
+
+
+class MmapTable(etl.Table):
+
+    # petl table over (a byte range of) a plain file, read by `read_mmap_chunks()`.  Its header is `fields`.
+
+    def __init__(self, filename, header, fields, byteRange=None):
+        self.filename = filename
+        self.header = header
+        self.fields = fields
+        self.byteRange = byteRange
+
+    def __iter__(self):
+        yield tuple(self.fields)
+        for rows in read_mmap_chunks(self.filename, self.header, self.fields, self.byteRange):
+            yield from rows
+
+
+# ---- Input Discovery ----
+
+# Header line as written by each source -> stripped header.  Lets most files be identified without parsing the line.
+HEADER_SIGNATURE_MAP = {",".join(header): header for header in IDENTIFY_MAP}
+
+DEFAULT_INPUT_GLOB = "*.csv"
+IDENTIFY_THREADS = 16
+
+def sniff_header(filename):
+
+    # Returns the stripped field names of the header row of `filename` (an empty tuple for an empty file).
+    inFile = io.TextIOWrapper(io.BufferedReader(StdinReader(replay=False)), newline='') if filename == STDIN_INPUT else open_input_text(filename)
+    with inFile:
+        line = inFile.readline()
+        header = HEADER_SIGNATURE_MAP.get(line.rstrip('\r\n'), None)
+        if header:
+            return header
+
+        row = next(csv.reader(itertools.chain([line], inFile)), [])
+        return tuple(v.strip() for v in row)
+
+
+def find_input_files(inputDirs, patterns):
+
+    # Files matching any of the glob `patterns` in each input directory, sorted per directory.  Patterns may contain
+    # "**" to match subdirectories.
+    filenames = []
+    for inputDir in inputDirs:
+        matches = set()
+        for pattern in patterns:
+            matches.update(glob.glob(os.path.join(glob.escape(inputDir), pattern), recursive=True))
+        filenames += sorted(match for match in matches if os.path.isfile(match))
+
+    return filenames
+
+
+def identify_files(conv, filenames):
+
+    # Identifies the files concurrently (reading a header is mostly waiting on I/O) and returns their contexts in the
+    # order of `filenames`.
+    if len(filenames) < 2:
+        return [get_file_context(conv, filename) for filename in filenames]
+
+    with ThreadPoolExecutor(max_workers=min(IDENTIFY_THREADS, len(filenames))) as executor:
+        return list(executor.map(partial(get_file_context, conv), filenames))
+
+
+def write_identify_report(ctxList):
+
+    # Groups the files by source and type, followed by the unrecognized files.
+    groups = OrderedDict()
+    unrecognized = []
+    for ctx in sorted(ctxList, key=lambda ctx: (ctx.get('source', TxSource.UNKNOWN).value, ctx.get('type', TxType.COMMON).value)):
+        if ctx.get('source', TxSource.UNKNOWN) != TxSource.UNKNOWN:
+            groups.setdefault("{} {}".format(ctx['source'], ctx['type']), []).append(ctx['filename'])
+        elif 'header' in ctx:
+            unrecognized.append(ctx['filename'])
+    if unrecognized:
+        groups["Unrecognized"] = unrecognized
+
+    sys.stderr.write("Input files: {}\n".format(len(ctxList)))
+    for group, filenames in groups.items():
+        sys.stderr.write("  {}: {} file(s)\n".format(group, len(filenames)))
+        for filename in filenames:
+            sys.stderr.write("    '{}'\n".format(filename))
+
+
+# ---- Input Timezones ----
+#
+# The times of each input file are converted from the first timezone found in: a `--file-timezone FILE=TZ` option, a
+# filename pattern in the `--timezone-map` file, a source entry in that file (e.g. "TxSource.BLOCKFI"), `--timezone`, and
+# the source's default in TZ_DEFAULT_MAP.  Patterns may use shell wildcards and are matched against the input name as
+# given and against its base name.  "UTC" means no conversion, like `None` in TZ_DEFAULT_MAP.
+
+def parse_timezone(name):
+
+    # Raises `pytz.exceptions.UnknownTimeZoneError` for an unknown name.
+    return timezone(name) if name != "UTC" else None
+
+
+def timezone_name(tz):
+
+    return str(tz) if tz else "UTC"
+
+
+def load_timezone_map(filename):
+
+    # Returns ([(pattern, tz), ...], {TxSource: tz}) for a JSON object of filename patterns and sources to timezone
+    # names.  Raises ValueError for invalid content.
+    with open(filename) as f:
+        content = json.load(f)
+    if not isinstance(content, dict):
+        raise ValueError("expected a JSON object of filename patterns (or sources) to timezones")
+
+    patterns = []
+    sourceTimezones = {}
+    for key, name in content.items():
+        if not isinstance(name, str):
+            raise ValueError("timezone for '{}' is not a string".format(key))
+        try:
+            tz = parse_timezone(name)
+        except pytz.exceptions.UnknownTimeZoneError:
+            raise ValueError("unknown timezone for '{}': '{}'".format(key, name))
+        if key.startswith("TxSource."):
+            source = TxSource.__members__.get(key[len("TxSource."):])
+            if source in (None, TxSource.UNKNOWN):
+                raise ValueError("unknown source: '{}'".format(key))
+            sourceTimezones[source] = tz
+        else:
+            patterns.append((key, tz))
+
+    return (patterns, sourceTimezones)
+
+
+def timezone_rules(timezoneName, fileTimezones, timezoneMapFilename):
+
+    # Returns the ([(pattern, tz), ...], {TxSource: tz}) that `resolve_file_timezones()` applies, from the `--timezone`,
+    # `--file-timezone` and `--timezone-map` options.  Raises ValueError for invalid options.
+    patterns = []
+    for value in (fileTimezones or []):
+        pattern, sep, name = value.rpartition("=")
+        if not sep or not pattern:
+            raise ValueError("Specified file timezone is not FILE=TZ: '{}'.".format(value))
+        try:
+            patterns.append((pattern, parse_timezone(name)))
+        except pytz.exceptions.UnknownTimeZoneError:
+            raise ValueError("Specified timezone is unknown (check spelling): '{}'.".format(name))
+
+    sourceTimezones = dict(TZ_DEFAULT_MAP)
+    if timezoneName:
+        try:
+            sourceTimezones = dict.fromkeys(TxSource, parse_timezone(timezoneName))
+        except pytz.exceptions.UnknownTimeZoneError:
+            raise ValueError("Specified timezone is unknown (check spelling): '{}'.".format(timezoneName))
+
+    if timezoneMapFilename:
+        try:
+            mapPatterns, mapSourceTimezones = load_timezone_map(timezoneMapFilename)
+        except (OSError, ValueError) as e:
+            raise ValueError("Cannot use timezone map '{}': {}.".format(timezoneMapFilename, e))
+        patterns += mapPatterns
+        sourceTimezones.update(mapSourceTimezones)
+
+    return (patterns, sourceTimezones)
+
+
+def resolve_file_timezones(ctxList, conv, patterns, sourceTimezones):
+
+    # Gives each (recognized) file context the converter for its timezone.
+    for ctx in ctxList:
+        tz = sourceTimezones.get(ctx['source'], None)
+        basename = os.path.basename(ctx['filename'])
+        for pattern, patternTz in patterns:
+            if fnmatch.fnmatchcase(ctx['filename'], pattern) or fnmatch.fnmatchcase(basename, pattern):
+                tz = patternTz
+                break
+        set_file_converter(ctx, conv.for_timezone(tz))
+
+
+def write_timezone_report(ctxList):
+
+    # One line when all files share a timezone, otherwise the files grouped by timezone.
+    groups = OrderedDict()
+    for ctx in ctxList:
+        groups.setdefault(ctx['converter'].inputTz, []).append(ctx['filename'])
+
+    if len(groups) == 1:
+        tz = next(iter(groups))
+        sys.stderr.write("Input timezone: {}.\n".format(tz if tz else "None (UTC assumed)"))
+        return
+
+    sys.stderr.write("Input timezones:\n")
+    for tz, filenames in groups.items():
+        sys.stderr.write("  {}: {} file(s)\n".format(tz if tz else "None (UTC assumed)", len(filenames)))
+        for filename in filenames:
+            sys.stderr.write("    '{}'\n".format(filename))
+
+
+class ConcatTable(etl.Table):
+
+    # Like `etl.stack()` for tables that share `header`, but only opens one table at a time and does not nest, so it
+    # scales to thousands of input files.
+
+    def __init__(self, header, tables):
+        self.header = header
+        self.tables = tables
+
+    def __iter__(self):
+        yield tuple(self.header)
+        for table in self.tables:
+            it = iter(table)
+            next(it, None)
+            for row in it:
+                yield tuple(row)
+
+
+#
+# -------- COLUMNAR ENGINE --------
+#
+# With `--engine columnar` a file is converted a chunk of rows at a time: the chunk is transposed into column lists,
+# each output column is computed from whole input columns (type masks, set-membership tests, sign checks), and the chunk
+# is written with a single `writerows`.  This avoids a petl row object and a field-name lookup per value.  The column
+# operations are still Python list comprehensions over string values, not vectorized array operations: reading and
+# writing the CSV take most of the time, so the engine is only a modest gain (about 2-3x for the mappers, 1.2-2x end to
+# end; see bench-accointing.py).  The row mappers above remain the reference implementation, and both engines produce
+# identical CSVs.
+
+COLUMNAR_CHUNK_SIZE = 65536
+
+def read_columns(filename, header, byteRange=None, fields=None):
+
+    # Yields one {fieldName: [values]} dict per chunk.  Short rows are padded with `None`, matching petl's handling.
+    # With `fields`, plain files are memory-mapped and only those fields are read.
+    if fields and filename != STDIN_INPUT and input_kind(filename) == 'plain':
+        for rows in read_mmap_chunks(filename, header, fields, byteRange):
+            if rows:
+                yield dict(zip(fields, zip(*rows)))
+        return
+
+    width = len(header)
+    with open_text_range(filename, byteRange) as inFile:
+        reader = csv.reader(inFile)
+        if byteRange is None or byteRange[0] == 0:
+            next(reader, None)
+        while True:
+            chunk = list(itertools.islice(reader, COLUMNAR_CHUNK_SIZE))
+            if not chunk:
+                return
+            chunk = [row if len(row) >= width else row + [None] * (width - len(row)) for row in chunk]
+            yield dict(zip(header, zip(*chunk)))
+
+
+def select_values(mask, values):
+
+    return [value if selected else None for selected, value in zip(mask, values)]
+
+
+def plan_entries(conv, idTuple, keys):
+
+    # Looks up the dispatch plan entries of a chunk and splits them into (transactionType, direction, classification)
+    # columns.
+    entries = list(map(conv.dispatchPlans[idTuple].__getitem__, keys))
+    return ([entry[0] for entry in entries], [entry[1] for entry in entries], [entry[2] for entry in entries])
+
+
+# ---- Binance.us ----
+
+# Plan direction -> (inBuyAmount, inBuyAsset, outSellAmount, outSellAsset) field names.
+BINANCE_US_COLUMNAR_FIELDS = {
+    'in': ('Realized_Amount_For_Primary_Asset', 'Primary_Asset', None, None),
+    'out': (None, None, 'Realized_Amount_For_Primary_Asset', 'Primary_Asset'),
+    'buy': ('Realized_Amount_For_Base_Asset', 'Base_Asset', 'Realized_Amount_For_Quote_Asset', 'Quote_Asset'),
+    'sell': ('Realized_Amount_For_Quote_Asset', 'Quote_Asset', 'Realized_Amount_For_Base_Asset', 'Base_Asset')
+}
+
+def binance_us_columnar_mapper(conv, cols):
+
+    transactionType, directions, classification = plan_entries(conv, (TxSource.BINANCE_US, TxType.COMMON), zip(cols['Category'], cols['Operation']))
+    fields = [BINANCE_US_COLUMNAR_FIELDS[direction] for direction in directions]
+
+    def field_column(slot):
+        return [cols[field[slot]][i] if field[slot] else None for i, field in enumerate(fields)]
+
+    comments = ["{}{}; {}".format(BINANCE_US_COMMENT_PREFIX, txId, note) if note else "{}{}".format(BINANCE_US_COMMENT_PREFIX, txId)
+                for txId, note in zip(cols['Transaction_Id'], cols['Additional_Note'])]
+
+    for orderId in cols['Order_Id']:
+        conv.uniqueOrders.add(orderId)
+
+    return [transactionType, list(map(conv.binance_us_dt_xform, cols['Time'])), field_column(0), field_column(1),
+            field_column(2), field_column(3), cols['Realized_Amount_For_Fee_Asset'], cols['Fee_Asset'],
+            classification, cols['Order_Id'], comments]
+
+
+# ---- BlockFi ----
+
+def blockfi_columnar_mapper(conv, cols):
+
+    txTypes = cols['Transaction Type']
+    amounts = cols['Amount']
+    assets = cols['Cryptocurrency']
+
+    transactionType, directions, classification = plan_entries(conv, (TxSource.BLOCKFI, TxType.COMMON), txTypes)
+    directions = [('out' if amount.startswith('-') else 'in') if direction == 'sign' else direction
+                  for direction, amount in zip(directions, amounts)]
+
+    isInbound = [direction == 'in' for direction in directions]
+    isOutbound = [direction == 'out' for direction in directions]
+    isFee = [direction == 'fee' for direction in directions]
+    outSellAmount = [amount.lstrip('-') if outbound else None for outbound, amount in zip(isOutbound, amounts)]
+    feeAmount = [amount.lstrip('-') if fee else None for fee, amount in zip(isFee, amounts)]
+
+    return [transactionType, list(map(conv.blockfi_dt_xform, cols['Confirmed At'])), select_values(isInbound, amounts),
+            select_values(isInbound, assets), outSellAmount, select_values(isOutbound, assets), feeAmount,
+            select_values(isFee, assets), classification, [None] * len(txTypes), txTypes]
+
+
+# ---- Celsius ----
+
+def celsius_columnar_mapper(conv, cols):
+
+    txTypes = cols['Transaction type']
+    amounts = cols['Coin amount']
+    coins = cols['Coin type']
+
+    transactionType, directions, classification = plan_entries(conv, (TxSource.CELSIUS, TxType.COMMON), txTypes)
+
+    # The sign of 'Coin amount' is only consulted for rows without a transaction type.
+    directions = [('out' if float(amount) < 0 else 'in') if direction == 'sign' else direction
+                  for direction, amount in zip(directions, amounts)]
+    transactionType = [("withdraw" if direction == 'out' else "deposit") if txType is None else txType
+                       for txType, direction in zip(transactionType, directions)]
+
+    isDeposit = [direction == 'in' for direction in directions]
+    isWithdrawal = [direction == 'out' for direction in directions]
+    outSellAmount = [amount.lstrip('-') if withdrawal else None for withdrawal, amount in zip(isWithdrawal, amounts)]
+
+    return [transactionType, list(map(conv.celsius_dt_xform, cols['Date and time'])), select_values(isDeposit, amounts),
+            select_values(isDeposit, coins), outSellAmount, select_values(isWithdrawal, coins), [None] * len(txTypes),
+            [None] * len(txTypes), classification, cols['Internal id'], txTypes]
+
+
+# ---- Coinbase ----
+
+def coinbase_columnar_mapper(conv, cols):
+
+    if conv.region != 'us':
+        raise Exception("The coinbase row mapper only supports Coinbase US data currently.")
+
+    txTypes = cols['Transaction Type']
+    quantities = cols['Quantity Transacted']
+    assets = cols['Asset']
+    subtotals = cols['Subtotal']
+    currencies = cols['Spot Price Currency']
+    notes = cols['Notes']
+    fees = cols['Fees and/or Spread']
+
+    plan = conv.dispatchPlans[(TxSource.COINBASE, TxType.COMMON)]
+    for i, txType in enumerate(txTypes):
+        if not plan[txType]:
+            raise coinbase_row_error(COINBASE_TYPE_ERROR, [values[i] for values in cols.values()])
+
+    transactionType, directions, classification = plan_entries(conv, (TxSource.COINBASE, TxType.COMMON), txTypes)
+
+    # Conversion details are only parsed for "convert" rows: row index -> (outAmount, outAsset, inAmount, inAsset).
+    converts = {}
+    for i, direction in enumerate(directions):
+        if direction == 'convert':
+            match = COINBASE_CONVERTED_US.match(re.sub('[$,"]', '', notes[i]))
+            if not match or len(match.groups()) != 4:
+                raise coinbase_row_error(COINBASE_NOTES_ERROR, [values[i] for values in cols.values()])
+            converts[i] = match.groups()
+
+    hasFee = [len(fee) > 0 for fee in fees]
+
+    inBuyAmount = [quantities[i] if direction in ('in', 'buy') else (subtotals[i] if direction == 'sell' else
+                   (converts[i][2] if direction == 'convert' else None)) for i, direction in enumerate(directions)]
+    inBuyAsset = [assets[i] if direction in ('in', 'buy') else (currencies[i] if direction == 'sell' else
+                  (converts[i][3] if direction == 'convert' else None)) for i, direction in enumerate(directions)]
+    outSellAmount = [quantities[i] if direction in ('out', 'sell') else (subtotals[i] if direction == 'buy' else
+                     (converts[i][0] if direction == 'convert' else None)) for i, direction in enumerate(directions)]
+    outSellAsset = [assets[i] if direction in ('out', 'sell') else (currencies[i] if direction == 'buy' else
+                    (converts[i][1] if direction == 'convert' else None)) for i, direction in enumerate(directions)]
+    classification = ["income" if (txType == COINBASE_RECEIVE_TYPE and note.endswith(COINBASE_REFERRAL_SUFFIX)) else value
+                      for value, txType, note in zip(classification, txTypes, notes)]
+
+    return [transactionType, list(map(conv.coinbase_dt_xform, cols['Timestamp'])), inBuyAmount, inBuyAsset, outSellAmount,
+            outSellAsset, select_values(hasFee, fees), select_values(hasFee, currencies), classification,
+            [None] * len(txTypes), notes]
+
+
+# ---- TradeStation ----
+
+def ts_nontrade_columnar_mapper(conv, cols):
+
+    txTypes = cols['Type']
+    amounts = cols['Amount']
+    units = cols['Unit']
+
+    transactionType, directions, classification = plan_entries(conv, (TxSource.TRADESTATION, TxType.NONTRADE), txTypes)
+    isDeposit = [direction == 'in' for direction in directions]
+    isWithdrawal = [direction == 'out' for direction in directions]
+    comments = ["{}; {}".format(details, note) if note else details for details, note in zip(cols['Details'], cols['Notes'])]
+
+    return [transactionType, list(map(partial(ts_dt_xform, conv), cols['Date'], cols['Time'])), select_values(isDeposit, amounts),
+            select_values(isDeposit, units), select_values(isWithdrawal, amounts), select_values(isWithdrawal, units),
+            [None] * len(txTypes), [None] * len(txTypes), classification, cols['TransactionID'], comments]
+
+
+def ts_trade_columnar_mapper(conv, cols):
+
+    transactionType, directions, classification = plan_entries(conv, (TxSource.TRADESTATION, TxType.TRADE), cols['BoughtSold'])
+    isBought = [direction == 'buy' for direction in directions]
+    pairs = list(map(partial(separate_pair, conv), cols['Symbol']))
+    quantities = cols['Quantity']
+    amounts = cols['Amount']
+
+    return [transactionType, list(map(partial(ts_dt_xform, conv), cols['Date'], cols['Time'])),
+            [quantity if bought else amount for bought, quantity, amount in zip(isBought, quantities, amounts)],
+            [pair[0] if bought else pair[1] for bought, pair in zip(isBought, pairs)],
+            [amount if bought else quantity for bought, quantity, amount in zip(isBought, quantities, amounts)],
+            [pair[1] if bought else pair[0] for bought, pair in zip(isBought, pairs)],
+            cols['Fee'], cols['FeeUnit'], classification, cols['TransactionID'], cols['Notes']]
+
+
+# ---- Columnar Mapper Map ----
+
+COLUMNAR_MAPPER_MAP = {
+    (TxSource.BINANCE_US, TxType.COMMON): binance_us_columnar_mapper,
+    (TxSource.BLOCKFI, TxType.COMMON): blockfi_columnar_mapper,
+    (TxSource.CELSIUS, TxType.COMMON): celsius_columnar_mapper,
+    (TxSource.COINBASE, TxType.COMMON): coinbase_columnar_mapper,
+    (TxSource.TRADESTATION, TxType.NONTRADE): ts_nontrade_columnar_mapper,
+    (TxSource.TRADESTATION, TxType.TRADE): ts_trade_columnar_mapper
+}
+
+def columnar_rows(ctx, outCols, keep, reconciler, arrowWriter):
+
+    rows = filter(keep, zip(*outCols)) if keep else zip(*outCols)
+    if reconciler:
+        rows = reconciler.observe(ctx, rows)
+    return arrowWriter.tee(rows) if arrowWriter else rows
+
+
+def columnar_chunks(ctx):
+
+    # Yields the ({fieldName: [values]}, lineNumbers) chunks of `ctx`.  The line numbers of the rows are only read with
+    # `--keep-going` (and are `None` otherwise).
+    if ctx['converter'].run.rejects:
+        return read_numbered_columns(ctx)
+    return ((cols, None) for cols in read_columns(ctx['filename'], ctx['header'], ctx.get('byteRange'),
+                                                  mapper_fields(ctx['converter'], (ctx['source'], ctx['type']))))
+
+
+def columnar_file_rows(ctx):
+
+    # The converted rows of `ctx` from the columnar engine, without rejected rows (see `Converter.rows()`).
+    columnarMapper = file_columnar_mapper(ctx['converter'], (ctx['source'], ctx['type']))
+    for cols, lineNumbers in columnar_chunks(ctx):
+        yield from zip(*(reject_columns(ctx, columnarMapper, cols, lineNumbers) if lineNumbers is not None else columnarMapper(cols)))
+
+
+def convert_columnar(ctx, outFile, keep=None, reconciler=None, arrowWriter=None):
+
+    # `keep` is an optional row predicate (see `DedupIndex.file_filter()`), `reconciler` an optional `Reconciler` and
+    # `arrowWriter` an optional `ArrowWriter`.
+    conv = ctx['converter']
+    rejects = conv.run.rejects
+    stats = conv.run.stats
+    columnarMapper = file_columnar_mapper(conv, (ctx['source'], ctx['type']))
+    writer = csv.writer(outFile, quoting=QUOTE_NONNUMERIC)
+    if reconciler:
+        conv.take_unknown_pairs()
+    chunks = columnar_chunks(ctx)
+
+    if not stats:
+        for cols, lineNumbers in chunks:
+            rowCount = len(next(iter(cols.values())))
+            if rejects:
+                outCols = reject_columns(ctx, columnarMapper, cols, lineNumbers)
+            else:
+                outCols = columnarMapper(cols)
+            writer.writerows(columnar_rows(ctx, outCols, keep, reconciler, arrowWriter))
+            if 'rowsConverted' in ctx:
+                ctx['rowsConverted'] += rowCount
+        if reconciler:
+            reconciler.add_unknown_pairs(ctx, conv.take_unknown_pairs())
+        return
+
+    perf = time.perf_counter
+    fileStats = new_file_stats(stats, ctx['filename'], ctx.get('byteRange'))
+    counter = stats['mappers'].setdefault(columnarMapper.__name__, {'calls': 0, 'seconds': 0.0})
+    fileStart = perf()
+    while True:
+        start = perf()
+        cols, lineNumbers = next(chunks, (None, None))
+        mapStart = perf()
+        fileStats['readSeconds'] += mapStart - start
+        if cols is None:
+            break
+        rowCount = len(next(iter(cols.values())))
+        if rejects:
+            outCols = reject_columns(ctx, columnarMapper, cols, lineNumbers)
+        else:
+            outCols = columnarMapper(cols)
+        writeStart = perf()
+        writer.writerows(columnar_rows(ctx, outCols, keep, reconciler, arrowWriter))
+        end = perf()
+        counter['calls'] += 1
+        counter['seconds'] += writeStart - mapStart
+        fileStats['mapSeconds'] += writeStart - mapStart
+        fileStats['writeSeconds'] += end - writeStart
+        fileStats['rowsIn'] += rowCount
+        fileStats['rowsOut'] += len(outCols[0])
+        if 'rowsConverted' in ctx:
+            ctx['rowsConverted'] += rowCount
+    fileStats['seconds'] = perf() - fileStart
+    if reconciler:
+        reconciler.add_unknown_pairs(ctx, conv.take_unknown_pairs())
+
+
+def write_columnar(ctxList, output, append=False):
+
+    # Same encoding and line endings as `etl.io.csv.tocsv`.
+    conv = ctxList[0]['converter']
+    outFile = open(output, 'a' if append else 'w', newline='') if output else io.TextIOWrapper(sys.stdout.buffer, newline='')
+    try:
+        if not append:
+            csv.writer(outFile, quoting=QUOTE_NONNUMERIC).writerow(output_header_row(conv))
+        for ctx in ctxList:
+            convert_columnar(ctx, outFile, conv.run.dedup_filter(ctx), conv.run.reconciler, conv.run.arrowOutput)
+    finally:
+        if output:
+            outFile.close()
+        else:
+            outFile.flush()
+            outFile.detach()
 
-UNIQUE_ORDERS = set()
 
 #
-# -------- CONFIG FUNCTIONS --------
+# -------- INCREMENTAL CONVERSION --------
 #
+# With `--manifest`, a JSON manifest next to the output records, for each input file, its identified source and type,
+# the number of bytes (and rows) already converted and a hash of that prefix.  When every input still starts with its
+# recorded prefix, only the new tail of each file is converted and appended to the existing output.  Otherwise (or when
+# the output, region or the timezone of a file changed) the whole output is rebuilt.
+
+MANIFEST_VERSION = 2   # Version 2 records the timezone of each file.
+MANIFEST_HASH_CHUNK_SIZE = 1 << 20
+
+class FileRangeReader(io.RawIOBase):
+
+    # Raw reader over bytes [start, end) of a file, so that rows appended while converting are left for the next run.
+
+    def __init__(self, filename, start, end):
+        self.file = open(filename, 'rb')
+        self.file.seek(start)
+        self.remaining = end - start
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        if self.remaining <= 0:
+            return 0
+        count = self.file.readinto(memoryview(buffer)[:min(len(buffer), self.remaining)])
+        self.remaining -= count
+        return count
+
+    def close(self):
+        self.file.close()
+        super().close()
+
+
+def open_text_range(filename, byteRange):
+
+    if byteRange is None:
+        return open_input_text(filename)
+    return io.TextIOWrapper(io.BufferedReader(FileRangeReader(filename, byteRange[0], byteRange[1])), newline='')
+
+
+def apply_file_range(ctx, byteRange):
+
+    # Restrict the conversion of `ctx` (a plain file) to a byte range.  A range that starts past the header is read as
+    # rows only; the mappers still see the usual field names.
+    ctx['byteRange'] = byteRange
+    ctx['table'] = MmapTable(ctx['filename'], ctx['header'], mapper_fields(ctx['converter'], (ctx['source'], ctx['type'])), byteRange)
+
+    # Count the converted rows for the manifest.
+    ctx['rowsConverted'] = 0
+    rowmapper = ctx['rowmapper']
+    def counted(tx):
+        ctx['rowsConverted'] += 1
+        return rowmapper(tx)
+    counted.__name__ = rowmapper.__name__
+    ctx['rowmapper'] = counted
+
+
+def hash_file_prefixes(filename, prefixBytes, totalBytes):
+
+    # Returns (hash of bytes [0, prefixBytes), hash of bytes [0, totalBytes)) in a single pass.
+    hasher = hashlib.blake2b()
+    prefixHash = None
+    position = 0
+    with open(filename, 'rb') as f:
+        while position < totalBytes:
+            if prefixHash is None and position == prefixBytes:
+                prefixHash = hasher.hexdigest()
+            limit = prefixBytes if (prefixHash is None and prefixBytes > position) else totalBytes
+            data = f.read(min(MANIFEST_HASH_CHUNK_SIZE, limit - position))
+            if not data:
+                break
+            hasher.update(data)
+            position += len(data)
+    if prefixHash is None and position == prefixBytes:
+        prefixHash = hasher.hexdigest()
+    return (prefixHash, hasher.hexdigest())
+
+
+def load_manifest(manifestFilename):
+
+    if not os.path.isfile(manifestFilename):
+        return None
+    try:
+        with open(manifestFilename) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return manifest if manifest.get('version') == MANIFEST_VERSION else None
+
+
+def plan_incremental(ctxList, manifest, output, settings):
+
+    # Decides, for each input, which byte range to convert and returns (append, newManifest).  `append` is False when
+    # a full conversion is required.
+    entries = {}
+    reasons = []
+    if not manifest:
+        reasons.append("no usable manifest")
+    elif not os.path.isfile(output) or manifest.get('output') != os.path.abspath(output):
+        reasons.append("output file does not match the manifest")
+    elif manifest.get('settings') != settings:
+        reasons.append("region or price directory changed")
+
+    previousFiles = manifest.get('files', {}) if manifest else {}
+    for ctx in ctxList:
+        path = os.path.abspath(ctx['filename'])
+        totalBytes = os.path.getsize(ctx['filename'])
+        previous = previousFiles.get(path)
+        prefixBytes = previous['bytes'] if (previous and previous['bytes'] <= totalBytes) else 0
+        prefixHash, totalHash = hash_file_prefixes(ctx['filename'], prefixBytes, totalBytes)
+
+        if previous:
+            if (previous['source'] != str(ctx['source'])) or (previous['type'] != str(ctx['type'])):
+                reasons.append("'{}' is now identified as a different source".format(ctx['filename']))
+            elif previous['timezone'] != timezone_name(ctx['converter'].inputTz):
+                reasons.append("timezone of '{}' changed".format(ctx['filename']))
+            elif (previous['bytes'] > totalBytes) or (previous['hash'] != prefixHash):
+                reasons.append("previously converted content of '{}' changed".format(ctx['filename']))
+
+        entries[path] = {'ctx': ctx, 'previous': previous, 'bytes': totalBytes, 'hash': totalHash}
+
+    append = not reasons
+    if not append:
+        sys.stderr.write("Full conversion: {}.\n".format("; ".join(reasons)))
+
+    newManifest = {'version': MANIFEST_VERSION, 'output': os.path.abspath(output), 'settings': settings,
+                   'files': dict(previousFiles) if append else {}}
+    for path, entry in entries.items():
+        ctx = entry['ctx']
+        previous = entry['previous'] if append else None
+        start = previous['bytes'] if previous else 0
+        if start > 0:
+            start = skip_line_terminator(ctx['filename'], start, entry['bytes'])
+        apply_file_range(ctx, (start, entry['bytes']))
+        ctx['manifestEntry'] = {'source': str(ctx['source']), 'type': str(ctx['type']), 'timezone': timezone_name(ctx['converter'].inputTz), 'bytes': entry['bytes'],
+                                'rows': previous['rows'] if previous else 0, 'hash': entry['hash']}
+        newManifest['files'][path] = ctx['manifestEntry']
+        if append:
+            sys.stderr.write("Incremental: '{}' has {} new bytes after {} converted bytes.\n".format(
+                ctx['filename'], entry['bytes'] - start, start))
+
+    return (append, newManifest)
+
+
+def skip_line_terminator(filename, start, end):
+
+    # A prefix that did not end with a newline gets one when the file grows; skip it so no empty row is produced.
+    with open(filename, 'rb') as f:
+        f.seek(start)
+        head = f.read(min(2, end - start))
+    if head.startswith(b'\r\n'):
+        return start + 2
+    if head.startswith(b'\n') or head.startswith(b'\r'):
+        return start + 1
+    return start
+
+
+def write_manifest(manifestFilename, newManifest, ctxList):
 
-def get_classify_map(regionStr):
+    for ctx in ctxList:
+        ctx['manifestEntry']['rows'] += ctx['rowsConverted']
 
-    f = open('config/classify.json')
-    jsonDict = json.load(f)
-    f.close()
+    tempFilename = manifestFilename + ".tmp"
+    with open(tempFilename, 'w') as f:
+        json.dump(newManifest, f, indent=4)
+    os.replace(tempFilename, manifestFilename)
 
-    if not regionStr in jsonDict:
-        raise Exception("Specified region '{}' not found in classify.json".format(regionStr))
 
-    return jsonDict[regionStr]
+#
+# -------- FILL AGGREGATION --------
+#
+# With `--aggregate-fills` the fills of each Binance.US order are collapsed into one order row: amounts are summed
+# exactly (Decimal), the date is the first fill's date, and the comments list the merged 'Transaction_Id's.  Fills of
+# an order with different assets (e.g. fees paid in BNB for some fills and in USD for others) stay in separate rows.
+# When the fills of every order are contiguous in the input, orders are aggregated as they stream by.  Otherwise the
+# partial orders are held in memory up to AGGREGATE_SPILL_SIZE and then spilled to sorted runs on disk.  Either way, an
+# aggregated row takes the place of the order's first fill.  Fills are aggregated per input file.
+
+# Output columns used by the aggregation.
+AGG_IN_AMOUNT, AGG_IN_ASSET, AGG_OUT_AMOUNT, AGG_OUT_ASSET, AGG_FEE_AMOUNT, AGG_FEE_ASSET = range(2, 8)
+AGG_OPERATION_ID, AGG_COMMENTS = 9, 10
+AGG_AMOUNT_COLUMNS = (AGG_IN_AMOUNT, AGG_OUT_AMOUNT, AGG_FEE_AMOUNT)
+AGG_FIAT_VALUE = 11   # Summed as well with `--prices`.
+
+def fills_are_contiguous(ctx):
+
+    # Checks the input's 'Order_Id' column: the fills of an order are contiguous if no order id comes back after a
+    # different one.  Seen ids go into a (spilling) DedupIndex, so memory stays bounded.
+    seen = DedupIndex()
+    try:
+        previous = None
+        for cols in read_columns(ctx['filename'], ctx['header'], ctx.get('byteRange'), ('Category', 'Order_Id')):
+            for category, orderId in zip(cols['Category'], cols['Order_Id']):
+                if BINANCE_US_TYPE_MAP.get(category, None) != "order" or orderId == previous:
+                    continue
+                previous = orderId
+                if not seen.add(hashlib.blake2b(orderId.encode('utf-8'), digest_size=DEDUP_KEY_BYTES).digest()):
+                    return False
+        return True
+    finally:
+        seen.close()
+
+
+def fill_group_key(row):
+
+    # Fills are grouped by order and assets.  `None` for rows that are not order fills, and for fills with an amount
+    # that does not parse, which are written as they were converted.
+    if row[0] != "order" or not row[AGG_OPERATION_ID]:
+        return None
+    try:
+        for column in fill_amount_columns(row):
+            if row[column]:
+                parse_decimal(row[column])
+    except ValueError:
+        return None
+    return (row[AGG_OPERATION_ID], row[AGG_IN_ASSET], row[AGG_OUT_ASSET], row[AGG_FEE_ASSET])
+
+
+def fill_amount_columns(row):
+
+    return AGG_AMOUNT_COLUMNS + (AGG_FIAT_VALUE,) if len(row) > AGG_FIAT_VALUE else AGG_AMOUNT_COLUMNS
+
+
+def new_fill_group(row, seq):
+
+    txId, note = split_binance_us_comments(row[AGG_COMMENTS])
+    return {'seq': seq, 'row': list(row), 'count': 1, 'txIds': [txId], 'notes': [note] if note else [],
+            'amounts': [str(Decimal(row[column])) if row[column] else None for column in fill_amount_columns(row)]}
+
+
+def add_fill_group(group, other):
+
+    # Adds the fills of `other` (a later group with the same key) to `group`.
+    group['count'] += other['count']
+    group['txIds'].extend(other['txIds'])
+    group['notes'].extend(note for note in other['notes'] if note not in group['notes'])
+    group['amounts'] = [str(Decimal(amount) + Decimal(otherAmount)) if amount and otherAmount else (amount or otherAmount)
+                        for amount, otherAmount in zip(group['amounts'], other['amounts'])]
+
+
+def fill_group_row(group):
+
+    # A single fill is written as it was converted.
+    if group['count'] == 1:
+        return group['row']
+
+    row = list(group['row'])
+    for column, amount in zip(fill_amount_columns(row), group['amounts']):
+        row[column] = format(Decimal(amount), 'f') if amount else None
+    comments = BINANCE_US_COMMENT_PREFIX + ", ".join(group['txIds'])
+    row[AGG_COMMENTS] = "; ".join([comments] + group['notes'])
+    return row
+
+
+def aggregate_contiguous_fills(rows):
+
+    groups = OrderedDict()   # Fills of the current order by key.
+    currentOrder = None
+    for row in rows:
+        key = fill_group_key(row)
+        if key is None or key[0] != currentOrder:
+            for group in groups.values():
+                yield fill_group_row(group)
+            groups.clear()
+            currentOrder = key[0] if key else None
+        if key is None:
+            yield row
+        elif key in groups:
+            add_fill_group(groups[key], new_fill_group(row, None))
+        else:
+            groups[key] = new_fill_group(row, None)
+
+    for group in groups.values():
+        yield fill_group_row(group)
+
+
+def write_fill_run(records, tempDir):
+
+    # `records` are JSON-serializable; one per line.
+    fd, runFilename = tempfile.mkstemp(prefix="fills-", suffix=".jsonl", dir=tempDir)
+    with os.fdopen(fd, 'w') as runFile:
+        runFile.writelines(json.dumps(record) + "\n" for record in records)
+    return runFilename
+
+
+def read_fill_run(runFilename):
+
+    with open(runFilename, 'r') as runFile:
+        for line in runFile:
+            yield json.loads(line)
+
+
+def combine_fill_runs(runFilenames):
+
+    # Merges runs of [key, group] records sorted by key, combining the groups of each key in run (i.e. fill) order.
+    current = None
+    for key, group in heapq.merge(*map(read_fill_run, runFilenames), key=lambda record: record[0]):
+        if current and current[0] == key:
+            add_fill_group(current[1], group)
+            continue
+        if current:
+            yield current[1]
+        current = [key, group]
+    if current:
+        yield current[1]
+
+
+def aggregate_scattered_fills(rows):
+
+    with tempfile.TemporaryDirectory(prefix="to-accointing-fills-") as tempDir:
+        # Rows that are not fills wait on disk (with their position) until the orders before them are complete.
+        otherFilename = os.path.join(tempDir, "other.jsonl")
+        groups = OrderedDict()
+        runFilenames = []
+        with open(otherFilename, 'w') as otherFile:
+            for seq, row in enumerate(rows):
+                key = fill_group_key(row)
+                if key is None:
+                    otherFile.write(json.dumps([seq, row]) + "\n")
+                    continue
+                group = new_fill_group(row, seq)
+                if key in groups:
+                    add_fill_group(groups[key], group)
+                else:
+                    groups[key] = group
+                if len(groups) >= AGGREGATE_SPILL_SIZE:
+                    runFilenames.append(write_fill_run(sorted([list(key), group] for key, group in groups.items()), tempDir))
+                    groups = OrderedDict()
+
+        if runFilenames:
+            # Complete the spilled orders, then put them back in the order of their first fills with sorted runs.
+            runFilenames.append(write_fill_run(sorted([list(key), group] for key, group in groups.items()), tempDir))
+            completed = combine_fill_runs(runFilenames)
+            seqRunFilenames = []
+            while True:
+                run = list(itertools.islice(completed, SORT_RUN_SIZE))
+                if not run:
+                    break
+                seqRunFilenames.append(write_fill_run(sorted(([group['seq'], fill_group_row(group)] for group in run), key=lambda record: record[0]), tempDir))
+            aggregated = heapq.merge(*map(read_fill_run, seqRunFilenames), key=lambda record: record[0])
+        else:
+            aggregated = ([group['seq'], fill_group_row(group)] for group in groups.values())
 
+        for seq, row in heapq.merge(read_fill_run(otherFilename), aggregated, key=lambda record: record[0]):
+            yield row
 
-def get_pair_map():
-    
-    f = open('config/pairs.json')
-    jsonDict = json.load(f)
-    f.close()
 
-    return jsonDict
+def aggregate_fills(ctx, rows):
+
+    # Stdin cannot be read twice, so its fills are always treated as scattered.
+    if ctx['filename'] != STDIN_INPUT and fills_are_contiguous(ctx):
+        return aggregate_contiguous_fills(rows)
+    return aggregate_scattered_fills(rows)
+
 
 #
-# -------- UTILITY FUNCTIONS --------
+# -------- PARALLEL FUNCTIONS --------
 #
+# With `--jobs N` each input file is converted by a worker process into a headerless CSV part.  The parts are then
+# concatenated in input order behind a single header, which yields the same bytes as the sequential `etl.stack` path.
+# Parts are also used without `--jobs` when the converted rows need another pass (e.g. `--aggregate-fills`).
+
+WORKER_CONVERTER = None   # The converter of a worker process, set up like the parent's.  See `init_worker()`.
+
+def init_worker(region, classifyMap, pairMap, orderCountMode, orderSpillDir, statsEnabled, priceStoreDir):
+
+    # The worker's run has no output options: deduplication (and reconciliation, etc.) is done by the parent while
+    # reading the parts, and the reject log is set for each part.
+    global WORKER_CONVERTER
+    prices = PriceStore(priceStoreDir) if priceStoreDir else None   # The parent's store files, mapped again.
+    config = (classifyMap,) + compile_dispatch_plans(region, classifyMap, pairMap)
+    WORKER_CONVERTER = Converter(region, None, orderCountMode, orderSpillDir, config, prices,
+                                 ConversionRun(stats=new_stats() if statsEnabled else None))
+
+
+def write_part(ctx, partFilename, engine):
+
+    # Converts `ctx` into a headerless CSV part (without deduplication).  The trading pairs missing from the pairs config
+    # are kept in `ctx` for the reconciliation, which is done when the part is read back.
+    ctx['converter'].take_unknown_pairs()
+    if (engine == 'columnar'):
+        with open(partFilename, 'w', newline='') as partFile:
+            convert_columnar(ctx, partFile)
+    else:
+        if ctx['converter'].run.stats:
+            outTable = stats_row_table(ctx)
+        else:
+            outTable = row_table(ctx, input_table(ctx), ctx['rowmapper'])
+        etl.io.csv.tocsv(outTable, partFilename, write_header=False, quoting=QUOTE_NONNUMERIC)
+    ctx['unknownPairs'] = ctx['converter'].take_unknown_pairs()
+
+
+def convert_file_part(filename, inputTz, partFilename, engine, byteRange, keepGoing):
+
+    ctx = get_file_context(WORKER_CONVERTER.for_timezone(inputTz), filename)
+    if (not ctx['success']):
+        raise Exception("{} -> '{}'".format(ctx['message'], filename))
+    if byteRange:
+        apply_file_range(ctx, byteRange)
+
+    # Rejected rows go to a file next to the part, which the parent appends to the reject file.
+    run = WORKER_CONVERTER.run
+    rejects = run.rejects = RejectLog(reject_part_filename(partFilename), header=False) if keepGoing else None
+    try:
+        write_part(ctx, partFilename, engine)
+    finally:
+        run.rejects = None
+        if rejects:
+            rejects.close()
+
+    # Hand the order counter state and statistics back to the parent.  Exporting resets them, since a worker process
+    # may convert several files.
+    return (WORKER_CONVERTER.uniqueOrders.export_state(), export_stats(run.stats) if run.stats else None, ctx.get('rowsConverted'),
+            ctx['unknownPairs'], rejects.count if rejects else 0)
+
+
+def reject_part_filename(partFilename):
+
+    return partFilename + ".rejects"
+
+
+def read_csv_rows(filename):
+
+    with open(filename, 'r', newline='') as inFile:
+        yield from csv.reader(inFile)
+
+
+def run_rows(ctx, rows):
+
+    # `rows` (the converted rows of `ctx`) with the deduplication, fill aggregation and reconciliation of its run
+    # applied.  Each file's rows must only be passed through here once.
+    run = ctx['converter'].run
+    keep = run.dedup_filter(ctx)
+    if keep:
+        rows = filter(keep, rows)
+    if run.aggregateFills and ctx['source'] == TxSource.BINANCE_US:
+        rows = aggregate_fills(ctx, rows)
+    if run.reconciler:
+        rows = reconcile_rows(ctx, rows)
+    return rows
 
-def separate_pair(tradingPairStr):
 
-    return PAIR_MAP.get(tradingPairStr, ("???", "???"))
+def reconcile_rows(ctx, rows):
 
+    # Adds `rows` to the balances, then the trading pairs missing from the pairs config: those kept with a part (see
+    # `write_part()`), or else those the converter found while converting `rows`.
+    conv = ctx['converter']
+    yield from conv.run.reconciler.observe(ctx, rows)
+    conv.run.reconciler.add_unknown_pairs(ctx, ctx['unknownPairs'] if 'unknownPairs' in ctx else conv.take_unknown_pairs())
+
+
+def part_rows(ctx, partFilename):
+
+    # Reads a part back with deduplication, fill aggregation and reconciliation applied.  Each part must only be read
+    # this way once.
+    return run_rows(ctx, read_csv_rows(partFilename))
+
+
+def merge_part_rows(ctx, partFilename, outFile):
+
+    # Appends the rows of a part after deduplication and fill aggregation (and writes them to `--arrow-output`).  Re-writing the parsed rows gives the same
+    # bytes, since every value in a part is a quoted string.
+    textFile = io.TextIOWrapper(outFile, newline='', write_through=True)
+    try:
+        csv.writer(textFile, quoting=QUOTE_NONNUMERIC).writerows(arrow_rows(ctx['converter'].run, part_rows(ctx, partFilename)))
+    finally:
+        textFile.detach()
+
+
+def split_large_inputs(ctxList, jobs):
+
+    # Splits large plain files into byte ranges (at record boundaries) that are converted by different workers.  The
+    # ranges keep their order, so the output is unchanged.
+    splitCtxList = []
+    for ctx in ctxList:
+        if ctx['filename'] == STDIN_INPUT or input_kind(ctx['filename']) != 'plain':
+            splitCtxList.append(ctx)
+            continue
+        count = min(jobs, max(1, os.path.getsize(ctx['filename']) // SPLIT_MIN_BYTES))
+        if count < 2:
+            splitCtxList.append(ctx)
+            continue
+        for byteRange in split_input_ranges(ctx['filename'], count):
+            rangeCtx = dict(ctx)
+            apply_file_range(rangeCtx, byteRange)
+            splitCtxList.append(rangeCtx)
+
+    return splitCtxList
+
+
+def convert_parts(ctxList, jobs, partFilenames, orderCountMode, engine):
+
+    if jobs == 1:
+        for ctx, partFilename in zip(ctxList, partFilenames):
+            write_part(ctx, partFilename, engine)
+        return
+
+    conv = ctxList[0]['converter']
+    run = conv.run
+    with ProcessPoolExecutor(max_workers=jobs, initializer=init_worker,
+                             initargs=(conv.region, conv.classifyMap, conv.pairMap, orderCountMode,
+                                       conv.uniqueOrders.spill_dir(), run.stats is not None,
+                                       conv.prices.storeDir if conv.prices else None)) as executor:
+        futures = [executor.submit(convert_file_part, ctx['filename'], ctx['converter'].inputTz, partFilename, engine, ctx.get('byteRange'),
+                                   run.rejects is not None)
+                   for ctx, partFilename in zip(ctxList, partFilenames)]
+
+        # Collect in input order so that the merged state is independent of worker scheduling.
+        for ctx, partFilename, future in zip(ctxList, partFilenames, futures):
+            orderState, workerStats, rowsConverted, ctx['unknownPairs'], rejectCount = future.result()
+            conv.uniqueOrders.merge_state(orderState)
+            if run.rejects:
+                run.rejects.append_part(reject_part_filename(partFilename), rejectCount)
+            if rowsConverted is not None:
+                ctx['rowsConverted'] = rowsConverted
+            if workerStats:
+                merge_stats(run.stats, workerStats)
+
+
+def convert_parallel(ctxList, jobs, output, orderCountMode, engine, append=False):
+
+    with tempfile.TemporaryDirectory(prefix="to-accointing-") as tempDir:
+        partFilenames = [os.path.join(tempDir, "part-{:06d}.csv".format(i)) for i in range(len(ctxList))]
+        convert_parts(ctxList, jobs, partFilenames, orderCountMode, engine)
+
+        conv = ctxList[0]['converter']
+        run = conv.run
+        outputStart = time.perf_counter()
+        if run.shards:
+            with ShardWriter(output, output_header_row(conv), **run.shards) as shards:
+                for ctx, partFilename in zip(ctxList, partFilenames):
+                    shards.write_rows(arrow_rows(run, part_rows(ctx, partFilename)))
+            return time.perf_counter() - outputStart
+
+        # Write the header, then append the parts in input order.
+        if not append:
+            etl.io.csv.tocsv([output_header_row(conv)], output if output else etl.io.sources.StdoutSource(), quoting=QUOTE_NONNUMERIC)
+        if output:
+            outFile = open(output, 'ab')
+        else:
+            sys.stdout.flush()
+            outFile = sys.stdout.buffer
+        for ctx, partFilename in zip(ctxList, partFilenames):
+            if run.dedup or run.aggregateFills or run.reconciler or run.arrowOutput:
+                merge_part_rows(ctx, partFilename, outFile)
+                continue
+            with open(partFilename, 'rb') as partFile:
+                shutil.copyfileobj(partFile, outFile)
+        outFile.flush()
+        if output:
+            outFile.close()
+
+    return time.perf_counter() - outputStart
 
 
 #
-# -------- CONVERSION FUNCTIONS --------
+# -------- DATE SORTING --------
 #
+# With `--sort-by-date` each input file is converted into a headerless CSV part as with `--jobs`.  Parts whose rows are
+# already in date order are merged as they are; other parts are first split into sorted runs of SORT_RUN_SIZE rows.
+# A streaming heap merge on the UTC date then writes a single time-ordered output.  Rows with the same date keep
+# their input order.
 
-def classify_tx(txSource, txField, tx):
+def date_sort_key(row):
 
-    fieldMap = CLASSIFY_MAP.get(str(txSource), None)
-    if (not fieldMap):
-        raise Exception("Source '{}' not found in CLASSIFY_MAP.".format(str(txSource)))
-    
-    valueMap = fieldMap.get(txField, None)
-    if (not valueMap):
-        raise Exception("Field '{}' not found in field map for source '{}'.".format(txField, str(txSource)))
-    
-    return valueMap.get(tx[txField], None)
+    # ACCOINTING_DATETIME_FORMAT ("%m/%d/%Y %H:%M:%S") reordered to sort as a string.
+    date = row[1]
+    return date[6:10] + date[0:2] + date[3:5] + date[10:]
 
 
-# ---- Binance.us ----
+def part_is_sorted(partFilename):
 
-binance_us_dt_parser = etl.util.parsers.datetimeparser(BINANCE_US_DATETIME_FORMAT)
+    previous = ""
+    for row in read_csv_rows(partFilename):
+        key = date_sort_key(row)
+        if key < previous:
+            return False
+        previous = key
+    return True
 
-def binance_us_dt_xform(dateTimeStr) -> str:
 
-    if (INPUT_TZ == None):
-        return binance_us_dt_parser(dateTimeStr).strftime(ACCOINTING_DATETIME_FORMAT) 
+def write_sort_run(rows, tempDir):
 
-    loc_dt = binance_us_dt_parser(dateTimeStr)
-    INPUT_TZ.localize(loc_dt, is_dst=True)
-    utc_dt = loc_dt.astimezone(pytz.utc)
-    return utc_dt.strftime(ACCOINTING_DATETIME_FORMAT)
+    fd, runFilename = tempfile.mkstemp(prefix="run-", suffix=".csv", dir=tempDir)
+    with os.fdopen(fd, 'w', newline='') as runFile:
+        csv.writer(runFile, quoting=QUOTE_NONNUMERIC).writerows(rows)
+    return runFilename
 
 
-def binance_us_row_mapper(tx):
+def sort_runs(rows, tempDir):
 
-    typeMap = {
-        'Deposit':"deposit",
-        'Distribution':"deposit",
-        'Withdrawal':"withdraw",
-        'Buy':"order", 
-        'Convert':"order", 
-        'Sell':"order", 
-        'Spot Trading':"order"
-    }
+    # Returns the sources (see `sort_sources()`) of `rows`: sorted runs of SORT_RUN_SIZE rows.
+    sources = []
+    while True:
+        run = list(itertools.islice(rows, SORT_RUN_SIZE))
+        if not run:
+            break
+        run.sort(key=date_sort_key)
+        sources.append((write_sort_run(run, tempDir), None))
+    return sources
 
-    txIsDeposit =  typeMap[tx['Category']] == "deposit"
-    txIsWithdrawal = typeMap[tx['Category']] == "withdraw"
-    txIsOrder = typeMap[tx['Category']] == "order"
 
-    transactionType = typeMap.get(tx['Category'], "???")
-    txDate = binance_us_dt_xform(tx['Time'])
+def sort_sources(ctxList, partFilenames, tempDir):
 
-    if txIsDeposit:
-        inBuyAmount = tx['Realized_Amount_For_Primary_Asset']
-        inBuyAsset = tx['Primary_Asset']
-        outSellAmount = None
-        outSellAsset = None
+    # Returns (filename, ctx) for every sorted file to merge, in input order: `ctx` for a part (read with `part_rows()`
+    # when merged), `None` for a sorted run.  Neither deduplication nor fill aggregation changes whether a part is sorted.
+    sources = []
+    for ctx, partFilename in zip(ctxList, partFilenames):
+        if part_is_sorted(partFilename):
+            sources.append((partFilename, ctx))
+        else:
+            sources.extend(sort_runs(part_rows(ctx, partFilename), tempDir))
 
-    if txIsWithdrawal:
-        inBuyAmount = None
-        inBuyAsset = None
-        outSellAmount = tx['Realized_Amount_For_Primary_Asset']
-        outSellAsset = tx['Primary_Asset']
+    return sources
 
-    if txIsOrder:
-
-        if (tx['Category'] == 'Buy' and tx['Operation'] == 'Buy'):   # Double-checked
-            inBuyAmount = tx['Realized_Amount_For_Quote_Asset']
-            inBuyAsset = tx['Quote_Asset']
-            outSellAmount = tx['Realized_Amount_For_Base_Asset']
-            outSellAsset = tx['Base_Asset']
-
-        if (tx['Category'] == 'Sell' and tx['Operation'] == 'Sell'):  # Double-checked
-            inBuyAmount = tx['Realized_Amount_For_Quote_Asset']
-            inBuyAsset = tx['Quote_Asset']
-            outSellAmount = tx['Realized_Amount_For_Base_Asset']
-            outSellAsset = tx['Base_Asset']
-
-        if (tx['Category'] == 'Spot Trading' and tx['Operation'] == 'Buy'):  # Double-checked
-            inBuyAmount = tx['Realized_Amount_For_Base_Asset']
-            inBuyAsset = tx['Base_Asset']
-            outSellAmount = tx['Realized_Amount_For_Quote_Asset']
-            outSellAsset = tx['Quote_Asset']
-        
-        if (tx['Category'] == 'Spot Trading' and tx['Operation'] == 'Sell'):  # Double-checked
-            inBuyAmount = tx['Realized_Amount_For_Quote_Asset']
-            inBuyAsset = tx['Quote_Asset']
-            outSellAmount = tx['Realized_Amount_For_Base_Asset']
-            outSellAsset = tx['Base_Asset']
-
-        if (tx['Category'] == 'Convert' and tx['Operation'] == 'Convert'):  #
-            inBuyAmount = tx['Realized_Amount_For_Quote_Asset']
-            inBuyAsset = tx['Quote_Asset']
-            outSellAmount = tx['Realized_Amount_For_Base_Asset']
-            outSellAsset = tx['Base_Asset']
 
-    feeAmount = tx['Realized_Amount_For_Fee_Asset']
-    feeAsset = tx['Fee_Asset']
-    classification = classify_tx(TxSource.BINANCE_US, 'Operation', tx)
-    operationId = tx['Order_Id']
-    if (tx['Additional_Note']):
-        comments = "Transaction_Id: {}; {}".format(tx['Transaction_Id'], tx['Additional_Note'])
-    else:
-        comments = "Transaction_Id: {}".format(tx['Transaction_Id'])
+def reduce_sources(sources, tempDir):
 
-    # Since The Binance.US CSV stores multiple fills for a single order, a set will be used to determine the
-    # number of unique orders.
-    global UNIQUE_ORDERS
-    UNIQUE_ORDERS.add(tx['Order_Id'])
+    # Merges groups of consecutive sources (which keeps the order of equal dates) until few enough are left.
+    while len(sources) > SORT_MAX_MERGE:
+        sources = [(write_sort_run(merge_sources(sources[i:i + SORT_MAX_MERGE]), tempDir), None)
+                   for i in range(0, len(sources), SORT_MAX_MERGE)]
+    return sources
 
-    return [transactionType, txDate, inBuyAmount, inBuyAsset, outSellAmount, outSellAsset, feeAmount, feeAsset, classification, operationId, comments]
 
+def merge_sources(sources):
 
-# ---- BlockFi ----
+    return heapq.merge(*[part_rows(ctx, filename) if ctx else read_csv_rows(filename) for filename, ctx in sources], key=date_sort_key)
 
-blockfi_dt_parser = etl.util.parsers.datetimeparser(BLOCKFI_DATETIME_FORMAT)
 
-def blockfi_dt_xform(dateTimeStr) -> str:
+def sorted_rows(rows):
 
-    if (INPUT_TZ == None):
-        return blockfi_dt_parser(dateTimeStr).strftime(ACCOINTING_DATETIME_FORMAT)
+    # Yields `rows` (converted rows) in date order, sorting them on disk as with `--sort-by-date`.
+    with tempfile.TemporaryDirectory(prefix="to-accointing-sort-") as tempDir:
+        yield from merge_sources(reduce_sources(sort_runs(rows, tempDir), tempDir))
 
-    loc_dt = blockfi_dt_parser(dateTimeStr)
-    INPUT_TZ.localize(loc_dt, is_dst=True)
-    utc_dt = loc_dt.astimezone(pytz.utc)
-    return utc_dt.strftime(ACCOINTING_DATETIME_FORMAT)
 
+def convert_sorted(ctxList, jobs, output, orderCountMode, engine, append=False):
 
-def blockfi_row_mapper(tx):
+    with tempfile.TemporaryDirectory(prefix="to-accointing-sort-") as tempDir:
+        partFilenames = [os.path.join(tempDir, "part-{:06d}.csv".format(i)) for i in range(len(ctxList))]
+        convert_parts(ctxList, jobs, partFilenames, orderCountMode, engine)
 
-    blockFiDepositTypes = {'BIA Deposit', 'Bonus Payment', 'Cc Rewards Redemption', 'Crypto Transfer', 'Interest Payment', 'Referral Bonus'}
-    blockFiWithdrawalTypes = {'BIA Withdraw', 'Withdrawal'}
-    blockFiTradeTypes = {'Trade'}
-    blockFiFeeTypes = {'Withdrawal Fee'}
+        outputStart = time.perf_counter()
+        sources = sort_sources(ctxList, partFilenames, tempDir)
 
-    txIsDeposit =  tx['Transaction Type'] in blockFiDepositTypes
-    txIsWithdrawal = tx['Transaction Type'] in blockFiWithdrawalTypes
-    txIsTrade = tx['Transaction Type'] in blockFiTradeTypes
-    txIsFee = tx['Transaction Type'] in blockFiFeeTypes
+        sources = reduce_sources(sources, tempDir)
 
-    txIsInbound = ( txIsDeposit or (txIsTrade and not tx['Amount'].startswith('-')) )
-    txIsOutbound = ( txIsWithdrawal or (txIsTrade and tx['Amount'].startswith('-')) )
+        conv = ctxList[0]['converter']
+        run = conv.run
+        if run.shards:
+            with ShardWriter(output, output_header_row(conv), **run.shards) as shards:
+                shards.write_rows(arrow_rows(run, lot_rows(run, merge_sources(sources))))
+            return time.perf_counter() - outputStart
 
-    transactionType = "deposit" if txIsDeposit else ( "withdraw" if (txIsWithdrawal or txIsFee) else ( "order" if txIsTrade else "???") )
-    txDate = blockfi_dt_xform(tx['Confirmed At'])
-    inBuyAmount = tx['Amount'] if txIsInbound else None
-    inBuyAsset = tx['Cryptocurrency'] if txIsInbound else None
-    outSellAmount = tx['Amount'].lstrip('-') if txIsOutbound else None
-    outSellAsset = tx['Cryptocurrency'] if txIsOutbound else None
-    feeAmount =  tx['Amount'].lstrip('-') if txIsFee else None
-    feeAsset = tx['Cryptocurrency'] if txIsFee else None
-    classification = classify_tx(TxSource.BLOCKFI, 'Transaction Type', tx)
-    operationId = None
-    comments = tx['Transaction Type']
+        # Same encoding and line endings as `etl.io.csv.tocsv`.
+        outFile = open(output, 'a' if append else 'w', newline='') if output else io.TextIOWrapper(sys.stdout.buffer, newline='')
+        try:
+            writer = csv.writer(outFile, quoting=QUOTE_NONNUMERIC)
+            if not append:
+                writer.writerow(output_header_row(conv))
+            writer.writerows(arrow_rows(run, lot_rows(run, merge_sources(sources))))
+        finally:
+            if output:
+                outFile.close()
+            else:
+                outFile.flush()
+                outFile.detach()
 
-    return [transactionType, txDate, inBuyAmount, inBuyAsset, outSellAmount, outSellAsset, feeAmount, feeAsset, classification, operationId, comments]
+    return time.perf_counter() - outputStart
 
 
-# ---- Celsius ----
+#
+# -------- SHARDED OUTPUT --------
+#
+# With `--shard-rows`, `--shard-bytes` or `--shard-by`, the output is split into several CSV files ("shards") that each
+# start with the Accointing header, and an index file lists every shard with its row count and date range.  With
+# `--compress`, the output (sharded or not) is written gzip or zstd compressed.  The converted rows go through the same
+# parts as with `--jobs`, so sharding combines with `--sort-by-date`, `--dedup` and `--aggregate-fills`.
+#
+# The converting thread formats rows into a text buffer per shard.  Full buffers are compressed and written by a pool of
+# SHARD_WRITERS threads (zlib and zstd release the GIL while compressing); all buffers of a shard go to the same thread,
+# which keeps them in order.
 
-celsius_dt_parser = etl.util.parsers.datetimeparser(CELSIUS_DATETIME_FORMAT)
+SHARD_COMPRESS_SUFFIXES = {'gzip': ".gz", 'zstd': ".zst"}
+SHARD_SIZE_UNITS = {'': 1, 'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30}
+SHARD_INDEX_VERSION = 1
+SHARD_GZIP_LEVEL = 6   # zlib's default; level 9 (gzip's default) is much slower for little gain on CSV.
 
-def celsius_dt_xform(dateTimeStr) -> str:
-    
-    if (INPUT_TZ == None):
-        return celsius_dt_parser(dateTimeStr).strftime(ACCOINTING_DATETIME_FORMAT)
+def parse_size(sizeStr):
 
-    loc_dt = celsius_dt_parser(dateTimeStr)
-    INPUT_TZ.localize(loc_dt, is_dst=True)
-    utc_dt = loc_dt.astimezone(pytz.utc)
-    return utc_dt.strftime(ACCOINTING_DATETIME_FORMAT)
+    # "500000", "64K", "256M", "1G" -> bytes.  Used as an argparse type.
+    match = re.fullmatch(r'(\d+)([KMG]?)B?', sizeStr.strip().upper())
+    if not match or int(match.group(1)) < 1:
+        raise argparse.ArgumentTypeError("invalid size: '{}' (e.g. 500000, 64K, 256M, 1G)".format(sizeStr))
+    return int(match.group(1)) * SHARD_SIZE_UNITS[match.group(2)]
 
 
-def celsius_row_mapper(tx):
+def open_shard_file(filename, compress):
 
-    celsiusDepositTypes = {'Promo Code Reward', 'Referred Award', 'Referrer Award', 'Reward', 'Transfer'}
-    celsiusWithdrawalTypes = {'Withdrawal'}
+    # Same encoding and line endings as `etl.io.csv.tocsv`.
+    if compress == 'gzip':
+        return gzip.open(filename, 'wt', compresslevel=SHARD_GZIP_LEVEL, newline='')
+    if compress == 'zstd':
+        return zstandard.open(filename, 'wt', newline='')
+    return open(filename, 'w', newline='')
 
-    txIsDeposit = ( tx['Transaction type'] in celsiusDepositTypes ) or ( tx['Transaction type'] == "" and float(tx['Coin amount']) >= 0 )
-    txIsWithdrawal = ( tx['Transaction type'] in celsiusWithdrawalTypes ) or ( tx['Transaction type'] == "" and float(tx['Coin amount']) < 0 )
 
-    transactionType = "deposit" if txIsDeposit else ( "withdraw" if txIsWithdrawal else "???" )
-    txDate = celsius_dt_xform(tx['Date and time'])
-    inBuyAmount = tx['Coin amount'] if txIsDeposit else None
-    inBuyAsset = tx['Coin type'] if txIsDeposit else None
-    outSellAmount = tx['Coin amount'].lstrip('-') if txIsWithdrawal else None
-    outSellAsset = tx['Coin type'] if txIsWithdrawal else None
-    feeAmount = None
-    feeAsset = None
-    classification = classify_tx(TxSource.CELSIUS, 'Transaction type', tx)
-    operationId = tx['Internal id']
-    comments = tx['Transaction type']
+def shard_period(row, shardBy):
 
-    return [transactionType, txDate, inBuyAmount, inBuyAsset, outSellAmount, outSellAsset, feeAmount, feeAsset, classification, operationId, comments]
+    # ACCOINTING_DATETIME_FORMAT ("%m/%d/%Y %H:%M:%S") -> "YYYY-MM" (month) or "YYYY" (year).
+    date = row[1]
+    return date[6:10] + "-" + date[0:2] if shardBy == 'month' else date[6:10]
 
 
-# ---- Coinbase ----
+class ShardWriter:
 
-coinbase_dt_parser = etl.util.parsers.datetimeparser(COINBASE_DATETIME_FORMAT)
+    # Writes rows into shards of `output`, e.g. "out.csv" -> "out-0001.csv", "out-2023-01.csv" or "out-2023-01-0001.csv"
+    # (plus ".gz"/".zst"), and the index to "out.index.json".  Without a shard option, `output` is the only shard.
 
-def coinbase_dt_xform(dateTimeStr) -> str:
+    def __init__(self, output, header, shardBy=None, maxRows=None, maxBytes=None, compress=None):
 
-    if (INPUT_TZ == None):
-        return coinbase_dt_parser(dateTimeStr).strftime(ACCOINTING_DATETIME_FORMAT) 
+        suffix = SHARD_COMPRESS_SUFFIXES.get(compress, "")
+        if suffix and output.endswith(suffix):
+            output = output[:-len(suffix)]
+        self.output = output
+        self.suffix = suffix
+        self.base, self.ext = os.path.splitext(output)
+        self.shardBy = shardBy
+        self.maxRows = maxRows
+        self.maxBytes = maxBytes
+        self.compress = compress
+        self.sharded = bool(shardBy or maxRows or maxBytes)
+        self.encoding = locale.getpreferredencoding(False)
 
-    loc_dt = coinbase_dt_parser(dateTimeStr)
-    INPUT_TZ.localize(loc_dt, is_dst=True)
-    utc_dt = loc_dt.astimezone(pytz.utc)
-    return utc_dt.strftime(ACCOINTING_DATETIME_FORMAT)
+        self.shards = []
+        self.current = {}        # Period -> the shard rows of that period are written to.
+        self.periodCounts = {}   # Period -> number of shards started for that period.
+        self.errors = []
 
-def coinbase_row_mapper(tx):
+        self.text = io.StringIO()
+        self.writer = csv.writer(self.text, quoting=QUOTE_NONNUMERIC)
+        self.header = self.format_row(header)
 
-    global REGION
-    if REGION != 'us':
-        raise Exception("The coinbase row mapper only supports Coinbase US data currently.")
+        self.queues = [queue.Queue(SHARD_QUEUE_SIZE) for _ in range(SHARD_WRITERS)]
+        self.threads = [threading.Thread(target=self.run_writer, args=(q,), daemon=True) for q in self.queues]
+        for thread in self.threads:
+            thread.start()
 
-    strippedNotes = re.sub('[$,"]', '', tx['Notes'])  # This function assumes US Coinbase CSV format.
+    def __enter__(self):
 
-    coinbaseDepositTypes = {'Learning Reward', 'Receive', 'Rewards Income'}
-    coinbaseWithdrawalTypes = {'Send'}
-    coinbaseOrderTypes = {'Buy', 'Convert', 'Sell'}
+        return self
 
-    txIsDeposit = tx['Transaction Type'] in coinbaseDepositTypes
-    txIsWithdrawal = tx['Transaction Type'] in coinbaseWithdrawalTypes
-    txIsOrder = tx['Transaction Type'] in coinbaseOrderTypes
-    txHasFee = len(tx['Fees and/or Spread']) > 0
+    def __exit__(self, excType, excValue, traceback):
 
-    if not (txIsDeposit or txIsWithdrawal or txIsOrder):
-        raise Exception("Unhandled Coinbase 'Transaction Type': {}".format(tx))
+        if excType is None:
+            self.close()
+        else:
+            self.stop()
 
-    if txIsDeposit:
-        transactionType = "deposit"
-        inBuyAmount = tx['Quantity Transacted']
-        inBuyAsset = tx['Asset']
-        outSellAmount = None
-        outSellAsset = None
-        classification = "income" if tx['Transaction Type'] != "Receive" else ( "income" if tx['Notes'].endswith("from Coinbase Referral") else None )
+    def format_row(self, row):
 
-    if txIsWithdrawal:
-        transactionType = "withdraw"
-        inBuyAmount = None
-        inBuyAsset = None
-        outSellAmount = tx['Quantity Transacted']
-        outSellAsset = tx['Asset']
-        classification = None
-
-    if txIsOrder:
-        transactionType = "order"
-        classification = None
-
-        if tx['Transaction Type'] == "Buy":
-            inBuyAmount = tx['Quantity Transacted']
-            inBuyAsset = tx['Asset']
-            outSellAmount = tx['Subtotal']
-            outSellAsset = tx['Spot Price Currency']
-
-        if tx['Transaction Type'] == "Sell":
-            inBuyAmount = tx['Subtotal']
-            inBuyAsset = tx['Spot Price Currency']
-            outSellAmount = tx['Quantity Transacted']
-            outSellAsset = tx['Asset']
-
-        if tx['Transaction Type'] == "Convert":
-            match = COINBASE_CONVERTED_US.match(strippedNotes)
-            if not match or len(match.groups()) != 4:
-                raise Exception("Could not parse conversion details from Coinbase 'Notes' field: {}".format(tx))
+        self.text.seek(0)
+        self.text.truncate()
+        self.writer.writerow(row)
+        return self.text.getvalue()
 
-            inBuyAmount = match[3]
-            inBuyAsset = match[4]
-            outSellAmount = match[1]
-            outSellAsset = match[2]
-  
-    txDate = coinbase_dt_xform(tx['Timestamp'])
-    feeAmount = tx['Fees and/or Spread'] if txHasFee else None
-    feeAsset = tx['Spot Price Currency'] if txHasFee else None
-    # Note: classification is set above.
-    operationId = None # Coinbase does not provide a transaction id or operation id.
-    comments = tx['Notes']
+    def text_bytes(self, text):
 
-    return [transactionType, txDate, inBuyAmount, inBuyAsset, outSellAmount, outSellAsset, feeAmount, feeAsset, classification, operationId, comments]
+        return len(text) if text.isascii() else len(text.encode(self.encoding))
 
+    def shard_filename(self, period, number):
 
-# ---- TradeStation ----
+        parts = [self.base] + ([period] if period else []) + (["{:04d}".format(number)] if self.maxRows or self.maxBytes else [])
+        return ("-".join(parts) + self.ext if self.sharded else self.output) + self.suffix
 
-ts_dt_parser = etl.util.parsers.datetimeparser(TS_DATETIME_FORMAT)
+    def new_shard(self, period):
 
-def ts_dt_xform(dateStr, timeStr) -> str:
+        previous = self.current.get(period)
+        if previous:
+            self.close_shard(previous)
 
-    dateTimeStr = "{} {}".format(dateStr, (timeStr if timeStr else TS_NONTRADE_DEFAULT_TIME_STR) )
+        number = self.periodCounts[period] = self.periodCounts.get(period, 0) + 1
+        shard = {'filename': self.shard_filename(period, number), 'queue': self.queues[len(self.shards) % SHARD_WRITERS],
+                 'rows': 0, 'bytes': 0, 'size': self.text_bytes(self.header), 'firstKey': None, 'lastKey': None,
+                 'dateFrom': None, 'dateTo': None, 'buffer': io.StringIO()}
+        shard['writer'] = csv.writer(shard['buffer'], quoting=QUOTE_NONNUMERIC)
+        shard['buffer'].write(self.header)
+        # 'bytes' counts the text handed to the writer thread; 'size' counts each row as it is added (`--shard-bytes`).
+        self.shards.append(shard)
+        self.current[period] = shard
+        return shard
 
-    if (INPUT_TZ == None):
-        return ts_dt_parser(dateTimeStr).strftime(ACCOINTING_DATETIME_FORMAT)
+    def write_rows(self, rows):
 
-    loc_dt = ts_dt_parser(dateTimeStr)
-    INPUT_TZ.localize(loc_dt, is_dst=True)
-    utc_dt = loc_dt.astimezone(pytz.utc)
-    return utc_dt.strftime(ACCOINTING_DATETIME_FORMAT)
+        for row in rows:
+            period = shard_period(row, self.shardBy) if self.shardBy else ""
+            shard = self.current.get(period)
 
+            # Only `--shard-bytes` needs the size of each row before it is written.
+            if self.maxBytes:
+                text = self.format_row(row)
+                size = self.text_bytes(text)
+            if (shard is None or (self.maxRows and shard['rows'] >= self.maxRows)
+                    or (self.maxBytes and shard['rows'] and shard['size'] + size > self.maxBytes)):
+                shard = self.new_shard(period)
 
-def ts_nontrade_rowmapper(tx):
+            if self.maxBytes:
+                shard['buffer'].write(text)
+                shard['size'] += size
+            else:
+                shard['writer'].writerow(row)
+            shard['rows'] += 1
+
+            # Date range (the rows need not be in date order).
+            key = date_sort_key(row)
+            if shard['firstKey'] is None or key < shard['firstKey']:
+                shard['firstKey'], shard['dateFrom'] = key, row[1]
+            if shard['lastKey'] is None or key > shard['lastKey']:
+                shard['lastKey'], shard['dateTo'] = key, row[1]
+
+            if shard['buffer'].tell() >= SHARD_BUFFER_SIZE:
+                self.flush_shard(shard)
+
+    def flush_shard(self, shard):
+
+        if self.errors:
+            raise self.errors[0]
+        text = shard['buffer'].getvalue()
+        if text:
+            shard['queue'].put((shard['filename'], text))
+            shard['bytes'] += self.text_bytes(text)
+            shard['buffer'].seek(0)
+            shard['buffer'].truncate()
+
+    def close_shard(self, shard):
+
+        self.flush_shard(shard)
+        shard['queue'].put((shard['filename'], None))
+
+    def run_writer(self, jobQueue):
+
+        # Writer thread: (filename, text) appends to a shard, (filename, None) closes it and `None` stops the thread.
+        # After an error the queue is still drained, so that the converting thread never blocks.
+        files = {}
+        while True:
+            item = jobQueue.get()
+            if item is None:
+                break
+            filename, text = item
+            if self.errors:
+                continue
+            try:
+                if text is None:
+                    files.pop(filename).close()
+                    continue
+                if filename not in files:
+                    files[filename] = open_shard_file(filename, self.compress)
+                files[filename].write(text)
+            except Exception as e:
+                self.errors.append(e)
 
-    tsDepositTypes = {'Deposit', 'Interest'}
-    tsWithdrawalTypes = {'Withdrawal'}
+        for f in files.values():
+            f.close()
 
-    txIsDeposit = ( tx['Type'] in tsDepositTypes )
-    txIsWithdrawal = ( tx['Type'] in tsWithdrawalTypes )
+    def stop(self):
 
-    transactionType = "deposit" if txIsDeposit else ( "withdraw" if txIsWithdrawal else "???" )
-    txDate = ts_dt_xform(tx['Date'], tx['Time'])
-    inBuyAmount = tx['Amount'] if (tx['Type'] == "Deposit" or tx['Type'] == "Interest") else None
-    inBuyAsset = tx['Unit'] if (tx['Type'] == "Deposit" or tx['Type'] == "Interest") else None
-    outSellAmount = tx['Amount'] if (tx['Type'] == "Withdrawal") else None
-    outSellAsset = tx['Unit'] if (tx['Type'] == "Withdrawal") else None
-    feeAmount = None
-    feeAsset = None
-    classification = classify_tx(TxSource.TRADESTATION, 'Type', tx)
-    operationId = tx['TransactionID']
-    comments = "{}; {}".format(tx['Details'], tx['Notes']) if (tx['Notes']) else tx['Details']
+        for jobQueue in self.queues:
+            jobQueue.put(None)
+        for thread in self.threads:
+            thread.join()
 
-    return [transactionType, txDate, inBuyAmount, inBuyAsset, outSellAmount, outSellAsset, feeAmount, feeAsset, classification, operationId, comments]
+    def close(self):
 
+        # An unsharded output is written even when there are no rows.
+        if not self.sharded and not self.shards:
+            self.new_shard("")
+        for shard in self.current.values():
+            self.close_shard(shard)
+        self.stop()
+        if self.errors:
+            raise self.errors[0]
 
-def ts_trade_rowmapper(tx):
+        if self.sharded:
+            self.write_index()
+            sys.stderr.write("Output written to {} shard(s), see index: '{}'.\n".format(len(self.shards), self.index_filename()))
 
-    if not (tx['BoughtSold'] == "BOUGHT" or tx['BoughtSold'] == "SOLD"):
-        raise Exception("Invalid value '{}' in 'BoughtSold' field.".format(tx['BoughtSold']))
+    def index_filename(self):
 
-    transactionType = 'order'
-    txDate = ts_dt_xform(tx['Date'], tx['Time'])
+        return self.base + ".index.json"
 
-    if (tx['BoughtSold'] == "BOUGHT"):
-        inBuyAmount = tx['Quantity']
-        inBuyAsset = separate_pair(tx['Symbol'])[0]
-        outSellAmount = tx["Amount"]
-        outSellAsset = separate_pair(tx['Symbol'])[1]
+    def write_index(self):
 
-    if (tx['BoughtSold'] == "SOLD"):
-        inBuyAmount = tx["Amount"]
-        inBuyAsset = separate_pair(tx['Symbol'])[1]
-        outSellAmount = tx['Quantity']
-        outSellAsset = separate_pair(tx['Symbol'])[0]
+        index = {
+            'version': SHARD_INDEX_VERSION,
+            'rows': sum(shard['rows'] for shard in self.shards),
+            'shards': [{'file': os.path.basename(shard['filename']), 'rows': shard['rows'], 'bytes': shard['bytes'],
+                        'dateFrom': shard['dateFrom'], 'dateTo': shard['dateTo']} for shard in self.shards]
+        }
+        with open(self.index_filename(), 'w') as f:
+            json.dump(index, f, indent=4)
 
-    feeAmount = tx['Fee']
-    feeAsset = tx['FeeUnit']
-    classification = None
-    operationId = tx['TransactionID']
-    comments = tx['Notes']
 
-    return [transactionType, txDate, inBuyAmount, inBuyAsset, outSellAmount, outSellAsset, feeAmount, feeAsset, classification, operationId, comments]
+#
+# -------- ARROW OUTPUT --------
+#
+# With `--arrow-output FILE`, the converted rows are also written to a Parquet file ('.parquet') or an Arrow IPC file
+# (any other extension, e.g. '.arrow' or '.feather'), with the columns of `output_header_row()`: 'date' as a UTC
+# timestamp, the amounts as decimals, the asset and classification columns dictionary encoded and the other columns
+# as strings.  Empty values are nulls, as are amounts that do not parse or do not fit the decimal type (more than
+# ARROW_AMOUNT_PRECISION digits once rounded to ARROW_AMOUNT_SCALE decimals), which are counted as invalid amounts.  The
+# rows are taken from the final output stream, after deduplication, fill aggregation and sorting, and written in record
+# batches of ARROW_BATCH_SIZE rows, so both files hold the same rows in the same order.
+
+ARROW_PARQUET_SUFFIXES = (".parquet", ".pq")
+ARROW_AMOUNT_COLUMNS = {'inBuyAmount', 'outSellAmount', 'feeAmount (optional)', FIAT_VALUE_COLUMN}
+ARROW_DICTIONARY_COLUMNS = {'transactionType', 'inBuyAsset', 'outSellAsset', 'feeAsset (optional)', 'classification (optional)'}
+ARROW_AMOUNT_PRECISION = 38
+ARROW_AMOUNT_SCALE = 18   # Enough for the smallest unit of any asset (wei).
+ARROW_AMOUNT_CONTEXT = Context(prec=ARROW_AMOUNT_PRECISION)
+ARROW_AMOUNT_QUANTUM = Decimal(1).scaleb(-ARROW_AMOUNT_SCALE)
+
+def arrow_schema(header):
+
+    fields = []
+    for name in header:
+        if name == 'date':
+            fieldType = pyarrow.timestamp('s', tz='UTC')
+        elif name in ARROW_AMOUNT_COLUMNS:
+            fieldType = pyarrow.decimal128(ARROW_AMOUNT_PRECISION, ARROW_AMOUNT_SCALE)
+        elif name in ARROW_DICTIONARY_COLUMNS:
+            fieldType = pyarrow.dictionary(pyarrow.int32(), pyarrow.string())
+        else:
+            fieldType = pyarrow.string()
+        fields.append(pyarrow.field(name, fieldType))
+    return pyarrow.schema(fields)
 
 
-# ---- Rowmapper Map ----
+class ArrowWriter:
 
-ROWMAPPER_MAP = {
-    (TxSource.BINANCE_US, TxType.COMMON): binance_us_row_mapper,
-    (TxSource.BLOCKFI, TxType.COMMON): blockfi_row_mapper,
-    (TxSource.CELSIUS, TxType.COMMON): celsius_row_mapper,
-    (TxSource.COINBASE, TxType.COMMON): coinbase_row_mapper,
-    (TxSource.TRADESTATION, TxType.NONTRADE): ts_nontrade_rowmapper,
-    (TxSource.TRADESTATION, TxType.TRADE): ts_trade_rowmapper
+    # The file is only opened when the first batch (or the end of an empty output) is written, so that it is never
+    # inherited open by the `--jobs` worker processes.
+
+    def __init__(self, filename, header):
+
+        self.filename = filename
+        self.parquet = filename.lower().endswith(ARROW_PARQUET_SUFFIXES)
+        self.schema = arrow_schema(header)
+        self.sink = None
+        self.writer = None
+        self.rows = []
+        self.count = 0
+        self.invalidAmounts = 0
+        # Column -> {value: index}.  Each batch extends the dictionary of the previous one, since an Arrow IPC file
+        # only allows dictionary deltas between batches.
+        self.dictionaries = {name: {} for name in ARROW_DICTIONARY_COLUMNS}
+
+    def tee(self, rows):
+
+        # Yields `rows` (converted rows, with `None` or "" for empty values) while writing them in batches.
+        batch = self.rows
+        for row in rows:
+            batch.append(row)
+            if len(batch) >= ARROW_BATCH_SIZE:
+                self.write_batch()
+            yield row
+
+    def open(self):
+
+        if self.parquet:
+            self.writer = pyarrow.parquet.ParquetWriter(self.filename, self.schema)
+        else:
+            self.sink = pyarrow.OSFile(self.filename, 'wb')
+            self.writer = pyarrow.ipc.new_file(self.sink, self.schema, options=pyarrow.ipc.IpcWriteOptions(emit_dictionary_deltas=True))
+
+    def column_array(self, field, values):
+
+        strings = pyarrow.array([value or None for value in values], pyarrow.string())
+        if field.name == 'date':
+            return pyarrow.compute.strptime(strings, format=ACCOINTING_DATETIME_FORMAT, unit='s').cast(field.type)
+        if field.name in ARROW_AMOUNT_COLUMNS:
+            try:
+                return strings.cast(field.type)
+            except pyarrow.ArrowInvalid:   # Some value does not parse or fit: convert the batch's values one by one.
+                return pyarrow.array([self.amount_value(value) for value in values], field.type)
+        if field.name in ARROW_DICTIONARY_COLUMNS:
+            # Map the batch's own dictionary onto the column's dictionary.
+            encoded = strings.dictionary_encode()
+            known = self.dictionaries[field.name]
+            batchValues = encoded.dictionary.to_pylist()
+            for value in batchValues:
+                known.setdefault(value, len(known))
+            indices = pyarrow.array([known[value] for value in batchValues], pyarrow.int32()).take(encoded.indices)
+            return pyarrow.DictionaryArray.from_arrays(indices, pyarrow.array(list(known), pyarrow.string()))
+        return strings
+
+    def amount_value(self, value):
+
+        # `value` as a Decimal of the amount type, or `None` if it is empty or invalid.
+        if not value:
+            return None
+        try:
+            return ARROW_AMOUNT_CONTEXT.quantize(parse_decimal(value), ARROW_AMOUNT_QUANTUM)
+        except (ValueError, InvalidOperation):
+            self.invalidAmounts += 1
+            return None
+
+    def write_batch(self):
+
+        if self.writer is None:
+            self.open()
+        if not self.rows:
+            return
+        columns = list(zip(*self.rows))
+        arrays = [self.column_array(field, values) for field, values in zip(self.schema, columns)]
+        self.writer.write_batch(pyarrow.record_batch(arrays, schema=self.schema))
+        self.count += len(self.rows)
+        self.rows.clear()
+
+    def close(self):
+
+        self.write_batch()
+        self.release()
+
+    def release(self):
+
+        # Closes the writer and its file without writing the pending rows (e.g. after a failed conversion).
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+        if self.sink:
+            self.sink.close()
+            self.sink = None
+        self.rows.clear()
+
+
+def arrow_rows(run, rows):
+
+    # The final output rows, also written to `--arrow-output` if given.
+    return run.arrowOutput.tee(rows) if run.arrowOutput else rows
+
+
+class ArrowTable(etl.Table):
+
+    def __init__(self, table, run):
+        self.table = table
+        self.run = run
+
+    def __iter__(self):
+        it = iter(self.table)
+        header = next(it, None)
+        if header is None:
+            return
+        yield header
+        yield from arrow_rows(self.run, it)
+
+
+#
+# -------- SERVER MODE --------
+#
+# With `--serve`, the script runs as a long-lived process that accepts conversion jobs as JSON lines, either on
+# stdin/stdout (`--serve -`) or on a Unix socket (`--serve PATH`, one or more jobs per connection).  A job is an object
+# whose keys mirror the command line options, e.g.:
+#
+#   {"id": 1, "input": ["a.csv", "b.csv"], "region": "us", "timezone": "US/Eastern", "output": "out.csv"}
+#
+# Jobs run concurrently in a pool of worker processes that keep the imported modules, loaded config, compiled dispatch
+# plans and timezone tables warm between jobs.  Each job gets one response line, in completion order:
+#
+#   {"id": 1, "status": "ok", "exitCode": 0, "messages": [...], "stats": {...}}
+
+# Job key -> command line option.  List values repeat the option; `true` adds a flag.
+SERVER_JOB_OPTIONS = {
+    'input': '--input',
+    'inputDir': '--input-dir',
+    'glob': '--glob',
+    'region': '--region',
+    'timezone': '--timezone',
+    'fileTimezone': '--file-timezone',
+    'timezoneMap': '--timezone-map',
+    'output': '--output',
+    'orderCount': '--order-count',
+    'engine': '--engine',
+    'manifest': '--manifest',
+    'jobs': '--jobs',
+    'dedup': '--dedup',
+    'sortByDate': '--sort-by-date',
+    'aggregateFills': '--aggregate-fills',
+    'shardRows': '--shard-rows',
+    'shardBytes': '--shard-bytes',
+    'shardBy': '--shard-by',
+    'compress': '--compress',
+    'reconcile': '--reconcile',
+    'arrowOutput': '--arrow-output',
+    'keepGoing': '--keep-going',
+    'rejects': '--rejects',
+    'prices': '--prices',
+    'gains': '--gains',
+    'openLots': '--open-lots',
+    'lotMethod': '--lot-method'
 }
 
-def get_file_context(filename):
+def job_argv(job):
 
-    fileContextDict = {}
-    fileContextDict['filename'] = filename
+    if not job.get('output'):
+        raise ValueError("A job requires an 'output' file.")
+    if STDIN_INPUT in (job.get('input') if isinstance(job.get('input'), list) else [job.get('input')]):
+        raise ValueError("A job cannot read its input from stdin.")
 
-    # Does the file Exist
-    if (not os.path.isfile(filename)):
-        fileContextDict['success'] = False
-        fileContextDict['message'] = "File does not exist."
-        return fileContextDict
+    argv = ['--stats']
+    for key, value in job.items():
+        if key == 'id':
+            continue
+        if key not in SERVER_JOB_OPTIONS:
+            raise ValueError("Unknown job key: '{}'.".format(key))
+        if isinstance(value, bool):   # Flags, e.g. "dedup": true.
+            argv += [SERVER_JOB_OPTIONS[key]] if value else []
+            continue
+        for v in (value if isinstance(value, list) else [value]):
+            argv += [SERVER_JOB_OPTIONS[key], str(v)]
 
-    # Create a table
-    fileContextDict['table'] = etl.fromcsv(filename)
+    return argv
 
-    # Remove leading and trailing white space from field names in the header for identification.
-    stripped = [v.strip() for v in etl.header(fileContextDict['table'])]
-    fileContextDict['table'] = etl.transform.headers.setheader(fileContextDict['table'], stripped)
 
-    # Determine Source Type
-    idTuple = IDENTIFY_MAP.get(etl.header(fileContextDict['table']), (TxSource.UNKNOWN, TxType.COMMON))
+def warm_up(region):
 
-    fileContextDict['source'] = idTuple[0]
-    fileContextDict['type'] = idTuple[1]
- 
-    if (fileContextDict['source'] == TxSource.UNKNOWN):
-        fileContextDict['success'] = False
-        fileContextDict['message'] = "Unrecognized header in file: '{}'".format(filename)
-        return fileContextDict
+    # Loads everything a conversion needs that does not depend on the job.  Used by the server and its workers.
+    load_config(region)
+    for tz in TZ_DEFAULT_MAP.values():
+        build_tz_offset_table(tz)
 
-    fileContextDict['rowmapper'] = ROWMAPPER_MAP.get(idTuple, None)
 
-    if (not fileContextDict['rowmapper']):
-        raise Exception("Missing ROWMAPPER_MAP entry for idTuple ({},{}).".format(TxSource, TxType))
+def init_server_worker(region):
 
-    fileContextDict['success'] = True
-    fileContextDict['message'] = None
+    # Interrupting the server (Ctrl+C) is handled by the server process alone.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    warm_up(region)
 
-    return fileContextDict
+
+def run_job(job):
+
+    # Runs one job in a server worker process.  The conversion's messages to stderr are captured for the response.
+    # Each job has its own run, which `run_command()` closes even if the job fails.
+    run = ConversionRun()
+    stderr = sys.stderr
+    sys.stderr = messages = io.StringIO()
+    try:
+        exitCode = run_command(parse_args(job_argv(job)), run)
+    except SystemExit as e:   # Invalid options (from argparse).
+        exitCode = e.code
+    except Exception as e:
+        exitCode = 1
+        messages.write("ERROR: {}\n".format(e))
+    finally:
+        sys.stderr = stderr
+
+    return {'id': job.get('id'), 'status': "ok" if exitCode == 0 else "error", 'exitCode': exitCode,
+            'messages': messages.getvalue().splitlines(), 'stats': run.stats if exitCode == 0 else None}
+
+
+def serve_stream(inFile, outFile, executor):
+
+    # Reads jobs from `inFile` until EOF and writes their responses to `outFile` as they finish.
+    lock = threading.Lock()
+    responded = threading.Semaphore(0)   # Callbacks can run after `wait()` returns, so count the responses instead.
+    jobCount = 0
+
+    def respond(response):
+        with lock:
+            outFile.write(json.dumps(response) + "\n")
+            outFile.flush()
+
+    def job_done(jobId, future):
+        try:
+            respond(future.result())
+        except Exception as e:
+            respond({'id': jobId, 'status': "error", 'exitCode': 1, 'messages': ["ERROR: {}".format(e)], 'stats': None})
+        finally:
+            responded.release()
+
+    for line in inFile:
+        if not line.strip():
+            continue
+        try:
+            job = json.loads(line)
+            if not isinstance(job, dict):
+                raise ValueError("A job must be a JSON object.")
+        except ValueError as e:
+            respond({'id': None, 'status': "error", 'exitCode': 1, 'messages': ["Invalid job: {}".format(e)], 'stats': None})
+            continue
+
+        executor.submit(run_job, job).add_done_callback(partial(job_done, job.get('id')))
+        jobCount += 1
+
+    for _ in range(jobCount):
+        responded.acquire()
+
+
+def serve_socket(path, executor):
+
+    class JobHandler(socketserver.StreamRequestHandler):
+
+        def handle(self):
+            serve_stream(io.TextIOWrapper(self.rfile, encoding='utf-8'),
+                         io.TextIOWrapper(self.wfile, encoding='utf-8', write_through=True), executor)
+
+    # Replace a socket left behind by a previous server, but never some other file.
+    if os.path.exists(path) and stat.S_ISSOCK(os.stat(path).st_mode):
+        os.remove(path)
+
+    with socketserver.ThreadingUnixStreamServer(path, JobHandler) as server:
+        try:
+            server.serve_forever()
+        finally:
+            os.remove(path)
+
+
+def serve(address, workers, region):
+
+    # Configuration errors are reported once, before any job is accepted.
+    warm_up(region)
+    sys.stderr.write("Serving conversion jobs on {} with {} worker processes.\n".format("stdin/stdout" if address == '-' else "'{}'".format(address), workers))
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_server_worker, initargs=(region,)) as executor:
+        try:
+            if address == '-':
+                serve_stream(sys.stdin, sys.stdout, executor)
+            else:
+                serve_socket(address, executor)
+        except KeyboardInterrupt:
+            pass
+
+    return 0
 
 
 #
 # -------- MAIN --------
 #
 
-def main() -> int:
+def parse_args(argv=None):
 
     parser = argparse.ArgumentParser()
     parser.add_argument("-r", "--region", help="Specify which region within 'classify.json' is used for classifications.")
     parser.add_argument("-t", "--timezone", help="Specify the timezone for times within the input files.")
-    parser.add_argument("-i", "--input", help="Specify -i/--input for each input file.", action="extend", nargs="+", required=True)
+    parser.add_argument("--file-timezone", help="Specify the timezone for times within the input files matching FILE (a name or wildcard pattern).  May be repeated.", metavar="FILE=TZ", action="append")
+    parser.add_argument("--timezone-map", help="JSON file mapping input filename patterns (or sources, e.g. 'TxSource.BLOCKFI') to timezones.", metavar="FILE")
+    parser.add_argument("-i", "--input", help="Specify -i/--input for each input file ('-' for stdin).  Files may be gzip/zstd compressed or zip archives.", action="extend", nargs="+")
+    parser.add_argument("--input-dir", help="Convert the files in this directory that match --glob.  May be repeated.", action="append")
+    parser.add_argument("--glob", help="Glob pattern for files in --input-dir (default: '{}').  May be repeated; '**' matches subdirectories.".format(DEFAULT_INPUT_GLOB), action="append")
     parser.add_argument("-o", "--output", help="The output filename.")
+    parser.add_argument("--order-count", help="How unique Binance.US orders are counted: 'exact' (spills to disk) or 'approx' (HyperLogLog, +/-1.6%%).", choices=list(ORDER_COUNTER_MAP.keys()), default='exact')
+    parser.add_argument("-e", "--engine", help="Conversion engine: 'row' (petl row mappers) or 'columnar' (chunked column lists; a modest speedup, about 1.2-2x end to end).", choices=['row', 'columnar'], default='row')
+    parser.add_argument("--stats", help="Write per-file and per-stage timing and throughput statistics to stderr.", action="store_true")
+    parser.add_argument("--stats-file", help="Also write the statistics to the given JSON file (implies --stats).")
+    parser.add_argument("-m", "--manifest", help="Manifest file for incremental conversion: only rows added since the last run are converted and appended to the output.")
+    parser.add_argument("-j", "--jobs", help="Number of worker processes used to convert input files in parallel.", type=int, default=1)
+    parser.add_argument("--sort-by-date", help="Write the rows of all input files in date order (merging them on disk, so memory use stays bounded).", action="store_true")
+    parser.add_argument("--aggregate-fills", help="Collapse the fills of each Binance.US order into a single order row.", action="store_true")
+    parser.add_argument("--dedup", help="Drop converted rows that were already converted from another input file (e.g. overlapping exports).", action="store_true")
+    parser.add_argument("--shard-rows", help="Split the output into files of at most this many rows each.", type=int)
+    parser.add_argument("--shard-bytes", help="Split the output into files of at most this size each (uncompressed), e.g. '256M'.", type=parse_size)
+    parser.add_argument("--shard-by", help="Split the output into one file per month or year of the transaction dates.", choices=['month', 'year'])
+    parser.add_argument("--compress", help="Write the output file(s) compressed.  'zstd' requires the zstandard module.", choices=list(SHARD_COMPRESS_SUFFIXES.keys()))
+    parser.add_argument("--reconcile", help="Write a per-asset balance reconciliation report to the given file (JSON if it ends with '.json', otherwise CSV).", metavar="REPORT")
+    parser.add_argument("--arrow-output", help="Also write the converted rows with typed columns to a Parquet file ('.parquet') or an Arrow IPC file (any other extension, e.g. '.arrow').  Requires the pyarrow module.", metavar="FILE")
+    parser.add_argument("--prices", help="Add a fiat (USD) value column, valuing assets without a USD value in the source with the local price files (<ASSET>.csv) in this directory.", metavar="DIR")
+    parser.add_argument("--gains", help="Match the converted rows against tax lots and write the realized gains to the given CSV file (implies --sort-by-date).", metavar="REPORT")
+    parser.add_argument("--open-lots", help="Open lot report for --gains (default: the gains filename with '.lots.csv').", metavar="FILE")
+    parser.add_argument("--lot-method", help="Order in which lots are taken for --gains: first in, last in or highest cost first (default: fifo).", choices=LOT_METHODS, default='fifo')
+    parser.add_argument("--keep-going", help="Skip the rows that cannot be converted (or convert to '???') instead of aborting, and list them in the reject file.", action="store_true")
+    parser.add_argument("--rejects", help="Reject file for --keep-going (default: the output filename with '.rejects.csv').", metavar="FILE")
+    parser.add_argument("--serve", help="Run as a server accepting JSON conversion jobs on a Unix socket at the given path, or on stdin/stdout for '-'.", metavar="ADDRESS")
+    parser.add_argument("--workers", help="Number of conversion jobs run concurrently with --serve (default: number of CPUs).", type=int, default=os.cpu_count() or 1)
+
+    return parser.parse_args(argv)
+
+
+def main(argv=None) -> int:
+
+    args = parse_args(argv)
+
+    if (args.serve):
+        if (args.workers < 1):
+            sys.stderr.write("Specified number of workers must be at least 1: '{}'.\n".format(args.workers))
+            return 1
+        return serve(args.serve, args.workers, args.region.lower() if args.region else "us")
+
+    return run_command(args, ConversionRun())
+
+
+def run_command(args, run) -> int:
+
+    # Validates the command line `args` and converts its inputs, setting the output options of `run` (a new
+    # `ConversionRun`).  The run is closed when the conversion ends; its statistics (if any) are kept.
+    startTime = time.perf_counter()
+    run.stats = new_stats() if (args.stats or args.stats_file) else None
+
+    if (args.jobs < 1):
+        sys.stderr.write("Specified number of jobs must be at least 1: '{}'.\n".format(args.jobs))
+        return 1
 
-    args = parser.parse_args()
+    if (not args.input and not args.input_dir):
+        sys.stderr.write("At least one input file (-i/--input) or input directory (--input-dir) is required.\n")
+        return 1
 
-    global REGION
-    if (args.region):
-        REGION = args.region.lower()
-        sys.stderr.write("Using supplied region: '{}'\n".format(REGION))
-    else:
-        REGION = "us"
-        sys.stderr.write("Using default region: '{}'\n".format(REGION))
+    if (args.manifest and not args.output):
+        sys.stderr.write("An output file (-o/--output) is required with --manifest.\n")
+        return 1
+
+    stdinCount = (args.input or []).count(STDIN_INPUT)
+    if (stdinCount > 1):
+        sys.stderr.write("Standard input (-i -) can only be given once.\n")
+        return 1
 
-    global CLASSIFY_MAP
-    CLASSIFY_MAP = get_classify_map(REGION)
+    if (stdinCount and (args.jobs > 1 or args.manifest)):
+        sys.stderr.write("Standard input (-i -) cannot be combined with -j/--jobs or -m/--manifest.\n")
+        return 1
+
+    sharding = args.shard_rows is not None or args.shard_bytes or args.shard_by
+    if (args.shard_rows is not None and args.shard_rows < 1):
+        sys.stderr.write("Specified number of rows per shard must be at least 1: '{}'.\n".format(args.shard_rows))
+        return 1
+
+    if ((sharding or args.compress) and not args.output):
+        sys.stderr.write("An output file (-o/--output) is required with --shard-rows, --shard-bytes, --shard-by and --compress.\n")
+        return 1
+
+    if ((sharding or args.compress) and args.manifest):
+        sys.stderr.write("--manifest cannot be combined with --shard-rows, --shard-bytes, --shard-by or --compress.\n")
+        return 1
+
+    if (args.compress == 'zstd' and zstandard is None):
+        sys.stderr.write("The zstandard module is required for --compress zstd (pip install zstandard).\n")
+        return 1
+
+    if (args.arrow_output and args.manifest):
+        sys.stderr.write("--manifest cannot be combined with --arrow-output.\n")
+        return 1
+
+    if (args.arrow_output and pyarrow is None):
+        sys.stderr.write("The pyarrow module is required for --arrow-output (pip install pyarrow).\n")
+        return 1
+
+    if (args.gains and args.manifest):
+        sys.stderr.write("--manifest cannot be combined with --gains.\n")
+        return 1
 
-    global PAIR_MAP
-    PAIR_MAP = get_pair_map()
+    if (args.keep_going and not (args.rejects or args.output)):
+        sys.stderr.write("A reject file (--rejects) or an output file (-o/--output) is required with --keep-going.\n")
+        return 1
 
-    # Validate that the user-supplied timezone (if present) is valid for pytz (if not "UTC").
+    if (args.region):
+        region = args.region.lower()
+        sys.stderr.write("Using supplied region: '{}'\n".format(region))
+    else:
+        region = "us"
+        sys.stderr.write("Using default region: '{}'\n".format(region))
+
+    # Configuration errors are reported here, before any input file is read.
+    classifyMap = load_config(region)[0]
+    if (args.gains):
+        try:
+            lot_classification_kinds(classifyMap)
+        except ValueError as e:
+            sys.stderr.write("{}.\n".format(e))
+            return 1
+
+    # Validate that the user-supplied timezones (if present) are valid for pytz (if not "UTC").
+    try:
+        timezoneRules = timezone_rules(args.timezone, args.file_timezone, args.timezone_map)
+    except ValueError as e:
+        sys.stderr.write("{}\n".format(e))
+        return 1
     if (args.timezone):
-        if args.timezone != "UTC":
-            try:
-                user_tz = timezone(args.timezone)
-                sys.stderr.write("Using specified timezone for times within input files: '{}'.\n".format(user_tz))
-            except pytz.exceptions.UnknownTimeZoneError:
-                sys.stderr.write("Specified timezone is unknown (check spelling): '{}'.\n".format(args.timezone))
-                return 1
-        else:
-            sys.stderr.write("Using specified timezone for times within input files: 'UTC'.\n")
+        sys.stderr.write("Using specified timezone for times within input files: '{}'.\n".format(timezone_name(parse_timezone(args.timezone))))
+
+    prices = None
+    if (args.prices):
+        try:
+            prices = PriceStore.build(args.prices)
+        except (OSError, ValueError) as e:
+            sys.stderr.write("Cannot read price files: {}.\n".format(e))
+            return 1
+        sys.stderr.write("Prices: {} asset(s) from '{}'.\n".format(len(prices.series), args.prices))
+
+    try:
+        with Converter(region, orderCountMode=args.order_count, prices=prices, run=run) as conv:
+            return convert_inputs(args, conv, timezoneRules, startTime)
+    finally:
+        run.close()
+        if prices:
+            prices.close()
+
+
+def convert_inputs(args, conv, timezoneRules, startTime) -> int:
+
+    # Identifies and converts the inputs of the validated command line `args` with `conv` and the output options of
+    # `args` (set on its run), converting the times of each file from the timezone given by `timezoneRules` (see
+    # `timezone_rules()`).
+    identifyStart = time.perf_counter()
+    dirFilenames = []
+    for inputDir in (args.input_dir or []):
+        if (not os.path.isdir(inputDir)):
+            sys.stderr.write("Input directory does not exist: '{}'.\n".format(inputDir))
+            return 1
+    if (args.input_dir):
+        dirFilenames = find_input_files(args.input_dir, args.glob or [DEFAULT_INPUT_GLOB])
+        if (not dirFilenames):
+            sys.stderr.write("No files in the input directories match: {}.\n".format(", ".join(args.glob or [DEFAULT_INPUT_GLOB])))
+            return 1
+
+    inputFilenames = expand_archives(args.input or [])
+    allCtxList = identify_files(conv, inputFilenames + expand_archives(dirFilenames))
+    write_identify_report(allCtxList)
 
-    
     ctxList = []
     inputError = False
     sourceSet = set()
-    for filename in args.input:
-        ctx = get_file_context(filename)
-        
+    skipCount = 0
+    for index, ctx in enumerate(allCtxList):
+        # Unrecognized files found in an input directory are skipped (they are listed in the report above).
+        if (not ctx["success"]) and index >= len(inputFilenames) and ctx.get('source') == TxSource.UNKNOWN:
+            skipCount += 1
+            continue
+
         inputError |= not ctx["success"]
         if (not ctx["success"]):
             sys.stderr.write("ERROR: {0} -> '{1}'\n".format(ctx["message"], ctx["filename"]))
         else:
             sourceSet.add(ctx["source"])
-            if (len(sourceSet) > 1):
-                inputError = True
-                sys.stderr.write("ERROR: File is from a different source. -> '{0}'\n".format(ctx["filename"]))
-            else:
-                ctxList.append(ctx)
-                sys.stderr.write("Identified '{0}' as {1}\n".format(ctx['filename'], ctx['source']))
+            ctxList.append(ctx)
+
+    if (skipCount):
+        sys.stderr.write("Skipping {} unrecognized file(s) found in the input directories.\n".format(skipCount))
 
     if (inputError):
         sys.stderr.write("Conversion aborted.  See above input errors.\n")
         return 1
 
-    # Make final determination of timezone for input files.
-    global INPUT_TZ
-    if (args.timezone):
-        INPUT_TZ = timezone(args.timezone) if (args.timezone != "UTC") else None
-    else:
-        INPUT_TZ = TZ_DEFAULT_MAP.get(list(sourceSet)[0], None) if (len(sourceSet) > 0) else None
+    if (not ctxList):
+        sys.stderr.write("Conversion aborted.  None of the input files were recognized.\n")
+        return 1
 
-    sys.stderr.write("Input timezone: {}.\n".format(INPUT_TZ if INPUT_TZ else "None (UTC assumed)"))
+    # Each file gets the converter for its timezone.  Files of different sources and timezones are converted into the
+    # same output.
+    resolve_file_timezones(ctxList, conv, *timezoneRules)
+    write_timezone_report(ctxList)
+
+    # Byte ranges (and the hashes of converted content) are only meaningful for plain files.
+    for ctx in (ctxList if args.manifest else []):
+        if (input_kind(ctx['filename']) != 'plain'):
+            sys.stderr.write("Compressed or archived inputs cannot be converted incrementally with --manifest: '{}'.\n".format(ctx['filename']))
+            return 1
+
+    identifySeconds = time.perf_counter() - identifyStart
+
+    run = conv.run
+    run.dedup = DedupIndex() if args.dedup else None
+    run.aggregateFills = args.aggregate_fills
+    run.reconciler = Reconciler() if args.reconcile else None
+
+    rejectsFilename = args.rejects or (os.path.splitext(args.output)[0] + ".rejects.csv" if args.output else None)
+    run.rejects = RejectLog(rejectsFilename) if args.keep_going else None
+
+    run.arrowOutput = ArrowWriter(args.arrow_output, output_header_row(conv)) if args.arrow_output else None
+
+    openLotsFilename = args.open_lots or (os.path.splitext(args.gains)[0] + ".lots.csv" if args.gains else None)
+    run.lots = LotMatcher(args.lot_method, args.gains, openLotsFilename, conv.prices, conv.classifyMap) if args.gains else None
+
+    run.shards = None
+    if (args.shard_rows is not None or args.shard_bytes or args.shard_by or args.compress):
+        run.shards = {'shardBy': args.shard_by, 'maxRows': args.shard_rows, 'maxBytes': args.shard_bytes, 'compress': args.compress}
+
+    append = False
+    if (args.manifest):
+
+        settings = {'region': conv.region, 'prices': os.path.abspath(args.prices) if args.prices else None}
+        append, newManifest = plan_incremental(ctxList, load_manifest(args.manifest), args.output, settings)
+
+    # Large files are split between the workers, unless rows must be compared within each whole file.
+    if (args.jobs > 1 and not (args.manifest or args.dedup or args.aggregate_fills)):
+        ctxList = split_large_inputs(ctxList, args.jobs)
+
+    outputSeconds = 0.0
+    # Lots are matched in date order.
+    if (args.sort_by_date or args.gains):
+        if (args.jobs > 1):
+            sys.stderr.write("Converting with {} worker processes.\n".format(min(args.jobs, len(ctxList))))
+        outputSeconds = convert_sorted(ctxList, min(args.jobs, len(ctxList)), args.output, args.order_count, args.engine, append)
+    elif (args.jobs > 1 or args.aggregate_fills or run.shards):
+        if (args.jobs > 1):
+            sys.stderr.write("Converting with {} worker processes.\n".format(min(args.jobs, len(ctxList))))
+        outputSeconds = convert_parallel(ctxList, min(args.jobs, len(ctxList)), args.output, args.order_count, args.engine, append)
+    elif (args.engine == 'columnar'):
+        write_columnar(ctxList, args.output, append)
+    else:
+        # Convert each file and concatenate them onto the resultTable.
+        outTables = []
+        for ctx in ctxList:
+            if run.stats:
+                outTable = stats_row_table(ctx)
+            else:
+                outTable = row_table(ctx, input_table(ctx), ctx['rowmapper'])
+            if run.dedup:
+                outTable = DedupTable(outTable, ctx)
+            if run.reconciler:
+                outTable = ReconcileTable(outTable, ctx)
+            outTables.append(outTable)
+        resultTable = ConcatTable(output_header_row(conv), outTables)
+        if run.arrowOutput:
+            resultTable = ArrowTable(resultTable, run)
+
+        # Write the csv to the specified output, or to stdout if no output was specified.
+        if (append):
+            etl.io.csv.appendcsv(resultTable, args.output, quoting=QUOTE_NONNUMERIC)
+        else:
+            etl.io.csv.tocsv(resultTable, args.output if args.output else etl.io.sources.StdoutSource(), quoting=QUOTE_NONNUMERIC)
 
-    # Convert each file and stack it onto the resultTable
-    resultTable = [ACCOINTING_HEADER_ROW]
-    for ctx in ctxList:
-        outTable = etl.rowmap(ctx['table'], ctx['rowmapper'], header=ACCOINTING_HEADER_ROW, failonerror=True)
-        resultTable = etl.stack(resultTable, outTable)
+    if (args.manifest):
+        write_manifest(args.manifest, newManifest, ctxList)
 
-    # Write the csv to the specified output, or to stdout if no output was specified.
-    etl.io.csv.tocsv(resultTable, args.output if args.output else etl.io.sources.StdoutSource(), quoting=QUOTE_NONNUMERIC)
+    if run.arrowOutput:
+        run.arrowOutput.close()
+        sys.stderr.write("Arrow output: {} row(s) written to '{}'.\n".format(run.arrowOutput.count, args.arrow_output))
+        if run.arrowOutput.invalidAmounts:
+            sys.stderr.write("Arrow output: {} invalid amount(s) written as null.\n".format(run.arrowOutput.invalidAmounts))
 
     # Special case output for Binance.US: Show the number of unique orders.
-    if (list(sourceSet)[0] == TxSource.BINANCE_US):
-        global UNIQUE_ORDERS
-        sys.stderr.write("Unique order count: {}\n".format(len(UNIQUE_ORDERS)))
+    if (TxSource.BINANCE_US in sourceSet):
+        sys.stderr.write("Unique order count: {}{}{}\n".format(conv.uniqueOrders.count(), " (approximate)" if args.order_count == 'approx' else "",
+                                                              " (newly converted rows only)" if append else ""))
+
+    if run.dedup:
+        sys.stderr.write("Duplicate rows removed: {}\n".format(run.dedup.duplicates))
+        run.dedup.close()
+
+    if run.lots:
+        run.lots.close()
+        sys.stderr.write("Gains ({}): {}.  Reports: '{}', '{}'.\n".format(args.lot_method.upper(), run.lots.summary(), args.gains, openLotsFilename))
+
+    if run.reconciler:
+        run.reconciler.write_report(args.reconcile)
+        sys.stderr.write("Reconciliation: {}{}.  Report: '{}'.\n".format(run.reconciler.summary(), " (newly converted rows only)" if append else "", args.reconcile))
+
+    if run.stats:
+        finish_stats(run.stats, time.perf_counter() - startTime, identifySeconds, outputSeconds)
+        write_stats_summary(run.stats)
+        if args.stats_file:
+            with open(args.stats_file, 'w') as f:
+                json.dump(run.stats, f, indent=4)
+
+    if run.rejects:
+        run.rejects.close()
+        sys.stderr.write("Rejected rows: {}.  See: '{}'.\n".format(run.rejects.count, rejectsFilename))
+        if run.rejects.count:
+            return REJECT_EXIT_CODE
 
     return 0
 